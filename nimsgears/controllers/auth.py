@@ -5,6 +5,7 @@ from tg.i18n import ugettext as _, lazy_ugettext as l_
 from repoze.what import predicates
 
 import os
+import datetime
 from collections import OrderedDict
 
 import nimsutil
@@ -83,7 +84,7 @@ class AuthController(BaseController):
 
         failed_jobs = Job.query.filter(Job.status == u'failed').order_by(Job.id).all()
         active_jobs = Job.query.filter(Job.status == u'running').order_by(Job.id).all()
-        queued_jobs = Job.query.filter(Job.status == u'pending').order_by(Job.id).limit(200).all()
+        queued_jobs = Job.query.filter(Job.status == u'pending').order_by(Job.priority.desc(), Job.id).limit(200).all()
         return dict(
                 page='status',
                 failed_jobs=failed_jobs,
@@ -91,6 +92,40 @@ class AuthController(BaseController):
                 queued_jobs=queued_jobs,
                 )
 
+    @expose('nimsgears.templates.metrics')
+    def metrics(self, days=7):
+        user = request.identity['user']
+        if not user.is_superuser:
+            flash(l_('Only administrators can view job metrics.'))
+            redirect('/auth/status')
+        days = int(days)
+        since = datetime.datetime.now() - datetime.timedelta(days=days)
+        return dict(
+                page='admin',
+                days=days,
+                percentiles=StageMetric.percentiles,
+                stage_summary=StageMetric.summary(since),
+                psd_summary=StageMetric.summary(since, by_psd=True),
+                hrsize=nimsutil.hrsize,
+                )
+
+    @expose('nimsgears.templates.latency')
+    def latency(self, days=7, epoch=None):
+        user = request.identity['user']
+        if not user.is_superuser:
+            flash(l_('Only administrators can view pipeline latency.'))
+            redirect('/auth/status')
+        days = int(days)
+        since = datetime.datetime.now() - datetime.timedelta(days=days)
+        epochs = [Epoch.get(int(epoch))] if epoch else TraceEvent.recent(since, limit=50)
+        return dict(
+                page='admin',
+                days=days,
+                percentiles=TraceEvent.percentiles,
+                summary=TraceEvent.summary(since),
+                waterfalls=[(e, TraceEvent.waterfall(e)) for e in epochs if e],
+                )
+
     @expose('nimsgears.templates.admin')
     def admin(self):
         return dict(page='admin', params={})
@@ -99,6 +99,21 @@ class BrowseController(NimsController):
             transaction.abort()
         return json.dumps(result)
 
+    @expose()
+    def expedite(self, **kwargs):
+        user = request.identity['user']
+        id_list = kwargs.get('sess', [])
+        id_list = id_list if isinstance(id_list, list) else [id_list]
+        sessions = Session.query.filter(Session.id.in_(id_list)).all() if id_list else []
+        result = {'success': False}
+        if sessions and all([user.has_access_to(sess, u'Read-Write') for sess in sessions]):
+            result['count'] = sum([len(Job.expedite(sess)) for sess in sessions])
+            result['success'] = True
+            transaction.commit()
+        else:
+            transaction.abort()
+        return json.dumps(result)
+
     @expose()
     def transfer_sessions(self, **kwargs):
         user = request.identity['user']
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 """The application's model objects"""
 
+import time
+
+from sqlalchemy import event
 from zope.sqlalchemy import ZopeTransactionExtension
 from sqlalchemy.orm import scoped_session, sessionmaker
 #from sqlalchemy import MetaData
 from sqlalchemy.ext.declarative import declarative_base
 
+import nimsutil
+
 # Global session manager: DBSession() returns the Thread-local
 # session object appropriate for the current web request.
 maker = sessionmaker(autoflush=True, autocommit=False, extension=ZopeTransactionExtension())
@@ -30,6 +35,7 @@ metadata = DeclarativeBase.metadata
 def init_model(engine):
     """Call me before using any of the tables or classes in the model."""
     DBSession.configure(bind=engine)
+    time_queries(engine)
 
     # If you are using reflection to introspect your database and create
     # table objects for you, your tables must be defined and mapped inside
@@ -48,6 +54,20 @@ def init_model(engine):
     #mapper(Reflected, t_reflected)
 
 
+def time_queries(engine):
+    """Observe the execution time of every query on engine in the nims_db_query_seconds histogram."""
+    histogram = nimsutil.metrics_registry.histogram('nims_db_query_seconds', 'Time spent executing database queries')
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_start_time = time.time()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        histogram.observe(time.time() - context._query_start_time)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
 # Import your model modules here.
 import elixir
 
@@ -22,6 +22,7 @@ __metadata__ = metadata
 
 __all__  = ['Group', 'User', 'Permission', 'Message', 'Job', 'Access', 'AccessPrivilege']
 __all__ += ['ResearchGroup', 'Person', 'Subject', 'DataContainer', 'Experiment', 'Session', 'Epoch', 'Dataset']
+__all__ += ['MuxCalibration', 'StageMetric', 'TraceEvent']
 
 
 class Group(Entity):
@@ -298,15 +299,141 @@ class Job(Entity):
     needs_rerun = Field(Boolean, default=False)
     progress = Field(Integer)
     activity = Field(Unicode(255))
+    lease_owner = Field(Unicode(255))
+    lease_expiry = Field(DateTime, index=True)
+    priority = Field(Integer, default=0, index=True)
+    agetime = Field(DateTime, default=datetime.datetime.now)    # last time the priority was raised by aging
+    notbefore = Field(DateTime)                                 # not to be claimed before this time
+    trace = Field(Unicode(63))                                  # trace of the data this job was queued for
 
     data_container = ManyToOne('DataContainer', inverse='jobs')
 
+    notify_channel = 'nims_job'
+    backfill_priority = -10
+    default_priority = 0
+    fastlane_priority = 100
+
     def __repr__(self):
         return ('<Job %d: %s, %s>' % (self.id, self.task, self.status)).encode('utf-8')
 
     def __unicode__(self):
         return u'%s %s' % (self.data_container, self.task)
 
+    @classmethod
+    def notify(cls):
+        """Wake up listening processors once the current transaction commits (PostgreSQL only)."""
+        if DBSession.bind.dialect.name == 'postgresql':
+            DBSession.execute('NOTIFY %s' % cls.notify_channel)
+
+    @classmethod
+    def claim(cls, query, count, owner, lease_time, accept=None):
+        """
+        Atomically claim up to count pending jobs from query, in query order.
+
+        Claimed jobs are marked running and leased to owner until lease_time from now. On
+        PostgreSQL, rows locked by another claimant are skipped rather than waited for, so that
+        several processors can claim from the same queue concurrently. If given, accept is
+        called with each candidate in turn and only those for which it returns True are
+        claimed. The transaction is committed before returning the claimed jobs.
+        """
+        query = (query
+                .filter(cls.status == u'pending')
+                .filter((cls.notbefore == None) | (cls.notbefore <= datetime.datetime.now()))
+                .limit(count))
+        if DBSession.bind.dialect.name == 'postgresql':
+            statement = query.with_entities(cls.id).statement.compile(bind=DBSession.bind)
+            sql = '%s FOR UPDATE OF %s SKIP LOCKED' % (statement, cls.table.name)
+            ids = [row[0] for row in DBSession.connection().execute(sql, statement.params)]
+            jobs = sorted(cls.query.filter(cls.id.in_(ids)).all(), key=lambda job: ids.index(job.id)) if ids else []
+        else:
+            jobs = query.with_lockmode('update').all()
+        if accept:
+            jobs = [job for job in jobs if accept(job)]
+        lease_expiry = datetime.datetime.now() + lease_time
+        for job in jobs:
+            job.status = u'running'
+            job.lease_owner = owner
+            job.lease_expiry = lease_expiry
+        transaction.commit()
+        return jobs
+
+    @classmethod
+    def renew_lease(cls, job_id, owner, lease_time):
+        """Extend the lease on a running job; return False if owner no longer holds it."""
+        renewed = (cls.query
+                .filter(cls.id == job_id)
+                .filter(cls.lease_owner == owner)
+                .filter(cls.status == u'running')
+                .update({'lease_expiry': datetime.datetime.now() + lease_time}, synchronize_session=False))
+        transaction.commit()
+        return bool(renewed)
+
+    @classmethod
+    def finish(cls, job_id, owner, status, activity):
+        """Record the outcome of a running job and release it; return False if owner no longer holds its lease."""
+        finished = (cls.query
+                .filter(cls.id == job_id)
+                .filter(cls.lease_owner == owner)
+                .filter(cls.status == u'running')
+                .update({'status': status, 'activity': activity, 'lease_owner': None, 'lease_expiry': None},
+                        synchronize_session=False))
+        transaction.commit()
+        return bool(finished)
+
+    @classmethod
+    def reclaim_expired(cls):
+        """Reset running jobs with an expired lease to pending and return them."""
+        jobs = cls.query.filter(cls.status == u'running').filter(cls.lease_expiry < datetime.datetime.now()).all()
+        for job in jobs:
+            job.status = u'pending'
+            job.activity = (u'lease of %s expired, reset to pending' % job.lease_owner)[:255]
+            job.lease_owner = None
+            job.lease_expiry = None
+        if jobs:
+            cls.notify()
+        transaction.commit()
+        return jobs
+
+    @classmethod
+    def age(cls, interval):
+        """
+        Raise the priority of jobs that have waited another interval, short of the fast lane.
+
+        Backfill jobs age no further than just below the default priority, so they never
+        catch up with newly acquired data, however long the backlog.
+        """
+        now = datetime.datetime.now()
+        return (cls.query
+                .filter(cls.status == u'pending')
+                .filter((cls.priority < cls.default_priority - 1)
+                        | ((cls.priority >= cls.default_priority) & (cls.priority < cls.fastlane_priority - 1)))
+                .filter(cls.agetime < now - interval)
+                .update({'priority': cls.priority + 1, 'agetime': now}, synchronize_session=False))
+
+    @classmethod
+    def expedite(cls, session):
+        """Move the pending or to-be-rerun jobs of a session into the fast lane and return them."""
+        jobs = (cls.query.join(DataContainer).join(Epoch)
+                .filter(Epoch.session == session)
+                .filter((cls.status == u'pending') | (cls.needs_rerun == True))
+                .all())
+        for job in jobs:
+            job.priority = cls.fastlane_priority
+            job.agetime = datetime.datetime.now()
+        if jobs:
+            cls.notify()
+        return jobs
+
+    def queue(self, priority):
+        """Set the priority for a newly queued run, without taking the job out of the fast lane."""
+        if self.priority is None or self.priority < self.fastlane_priority:
+            self.priority = priority
+        self.agetime = datetime.datetime.now()
+
+    def release(self):
+        self.lease_owner = None
+        self.lease_expiry = None
+
 
 class AccessPrivilege(object):
 
@@ -507,9 +634,16 @@ class Subject(DataContainer):
     def __unicode__(self):
         return u'%s, %s' % (self.lastname, self.firstname)
 
+    # patient id -> (subject code, group, experiment); expires so that new research groups are matched
+    parsed_patient_ids = nimsutil.LRUCache(256, ttl=300)
+
     @classmethod
     def from_mrfile(cls, mrfile):
-        subj_code, group_name, exp_name = nimsutil.parse_patient_id(mrfile.patient_id, ResearchGroup.all_ids())
+        parsed = cls.parsed_patient_ids.get(mrfile.patient_id)
+        if not parsed:
+            parsed = nimsutil.parse_patient_id(mrfile.patient_id, ResearchGroup.all_ids())
+            cls.parsed_patient_ids.put(mrfile.patient_id, parsed)
+        subj_code, group_name, exp_name = parsed
         query = cls.query.join(Experiment, cls.experiment).filter(Experiment.name == exp_name)
         query = query.join(ResearchGroup, Experiment.owner).filter(ResearchGroup.gid == group_name)
         if subj_code:
@@ -697,6 +831,7 @@ class Epoch(DataContainer):
     slice_encode_undersample = Field(Float)
     acquisition_matrix = Field(Unicode(255))
     num_mux_cal_cycle = Field(Integer)
+    slice_order = Field(Integer)    # NIfTI slice order code, set by the processor
 
     session = ManyToOne('Session')
 
@@ -705,10 +840,18 @@ class Epoch(DataContainer):
 
     @classmethod
     def from_mrfile(cls, mrfile):
+        """
+        Return the epoch of mrfile, creating it if there is none.
+
+        The sorter routes files with a header-only parse, which may lack what only a full parse
+        determines, e.g. the size and the multiband fields of a PFile. These are left unset here
+        and filled in by update_from_mrfile() once the processor has parsed the file in full.
+        """
         uid = nimsutil.pack_dicom_uid(mrfile.series_uid)
         epoch = cls.query.filter_by(uid=uid).filter_by(acq=mrfile.acq_no).first()
         if not epoch:
             session = Session.from_mrfile(mrfile)
+            size = getattr(mrfile, 'size', None) or (None, None)
             if session.timestamp is None or (mrfile.timestamp is not None and session.timestamp > mrfile.timestamp):
                 session.timestamp = mrfile.timestamp
             epoch = cls(
@@ -735,22 +878,29 @@ class Epoch(DataContainer):
                     num_receivers = mrfile.num_receivers,
                     protocol_name = unicode(mrfile.protocol_name),
                     scanner_name = unicode(mrfile.scanner_name),
-                    size_x = mrfile.size[0],
-                    size_y = mrfile.size[1],
+                    size_x = size[0],
+                    size_y = size[1],
                     fov = unicode(str(mrfile.fov)),
                     mm_per_vox = unicode(str(mrfile.mm_per_vox)),
                     scan_type = unicode(mrfile.scan_type),
-                    num_bands = mrfile.num_bands,
+                    num_bands = getattr(mrfile, 'num_bands', None),
                     effective_echo_spacing = mrfile.effective_echo_spacing,
                     phase_encode_undersample = mrfile.phase_encode_undersample,
                     slice_encode_undersample = mrfile.slice_encode_undersample,
                     acquisition_matrix = unicode(str(mrfile.acquisition_matrix)),
-                    num_mux_cal_cycle = mrfile.num_mux_cal_cycle if mrfile.filetype == u'pfile' else None,    # hack for pfile
+                    num_mux_cal_cycle = getattr(mrfile, 'num_mux_cal_cycle', None) if mrfile.filetype == u'pfile' else None,    # hack for pfile
                     qa_status = u'pending',
                     # to unpack fov, mm_per_vox, and acquisition_matrix: np.fromstring(str(mm)[1:-1],sep=',')
                     )
         return epoch
 
+    def update_from_mrfile(self, mrfile):
+        """Save the fields that from_mrfile() may have left unset, from a full parse of the epoch's primary file."""
+        self.size_x, self.size_y = mrfile.size[0], mrfile.size[1]
+        self.num_bands = mrfile.num_bands
+        if mrfile.filetype == u'pfile':
+            self.num_mux_cal_cycle = mrfile.num_mux_cal_cycle
+
     @classmethod
     def toplevel_query(cls):
         return (Epoch.query
@@ -800,6 +950,9 @@ class Dataset(Entity):
             u'json':    u'QA',
             }
 
+    # (series uid, acquisition, filetype) -> dataset id, so that the files of a series resolve without joins
+    resolved = nimsutil.LRUCache(1024)
+
     label = Field(Unicode(63))  # informational only
     offset = Field(Interval, default=datetime.timedelta())
     trashtime = Field(DateTime)
@@ -814,6 +967,7 @@ class Dataset(Entity):
     compressed = Field(Boolean, default=False)
     archived = Field(Boolean, default=False, index=True)
     _filenames = Field(String, default='', colname='filenames', synonym='filenames')
+    trace = Field(Unicode(63))  # trace of the stage item this dataset was last sorted from
 
     container = ManyToOne('DataContainer')
     parents = ManyToMany('Dataset')
@@ -835,6 +989,13 @@ class Dataset(Entity):
     @classmethod
     def from_mrfile(cls, mrfile, nims_path, archived=True):
         series_uid = nimsutil.pack_dicom_uid(mrfile.series_uid)
+        key = (series_uid, mrfile.acq_no, mrfile.filetype)
+        dataset_id = cls.resolved.get(key)
+        if dataset_id:
+            dataset = cls.get(dataset_id)   # from the identity map when the session already holds it
+            if dataset and dataset.filetype == mrfile.filetype:
+                return dataset
+            cls.resolved.discard(key)
         dataset = (cls.query.join(Epoch)
                 .filter(Epoch.uid == series_uid)
                 .filter(Epoch.acq == mrfile.acq_no)
@@ -868,6 +1029,7 @@ class Dataset(Entity):
             transaction.commit()
             DBSession.add(dataset)
             nimsutil.make_joined_path(nims_path, dataset.relpath)
+        cls.resolved.put(key, dataset.id)
         return dataset
 
     @classmethod
@@ -938,3 +1100,238 @@ class Dataset(Entity):
 
     def datatype_from_mrfile(self, mrfile):
         return u'unknown'
+
+
+class MuxCalibration(Entity):
+
+    """
+    Candidate calibration scan (aux_file) for the recon of multiband PFiles.
+
+    One is recorded by the sorter for every mux PFile dataset, so that the processor can pick a
+    calibration scan from the database alone, without globbing the candidates' dataset directories.
+    """
+
+    series = Field(Integer)
+    size_x = Field(Integer)
+    size_y = Field(Integer)
+    num_bands = Field(Integer)
+    num_mux_cal_cycle = Field(Integer)
+    phase_encode_direction = Field(Integer)
+    archive_path = Field(Unicode(255))  # relative to the data path
+
+    session = ManyToOne('Session', column_kwargs=dict(index=True))
+    dataset = ManyToOne('Dataset', column_kwargs=dict(index=True))
+
+    def __unicode__(self):
+        return u'<%s %s>' % (self.__class__.__name__, self.archive_path)
+
+    @classmethod
+    def from_mrfile(cls, mrfile, dataset, filename):
+        calibration = cls.query.filter_by(dataset=dataset).first() or cls(dataset=dataset)
+        calibration.session = dataset.container.session
+        calibration.series = mrfile.series_no
+        size = getattr(mrfile, 'size', None) or (None, None)    # unset by a header-only parse; see Epoch.from_mrfile
+        calibration.size_x = size[0]
+        calibration.size_y = size[1]
+        calibration.num_bands = getattr(mrfile, 'num_bands', None)
+        calibration.num_mux_cal_cycle = getattr(mrfile, 'num_mux_cal_cycle', None)
+        calibration.phase_encode_direction = getattr(mrfile, 'phase_encode_direction', None)
+        calibration.archive_path = unicode(os.path.join(dataset.relpath, filename))
+        return calibration
+
+    @classmethod
+    def candidates(cls, epoch, size_x, size_y):
+        """Return the calibration candidates of size_x by size_y for an epoch, excluding itself and trash."""
+        cls.backfill(epoch.session)
+        return (cls.query
+                .join(Dataset, cls.dataset)
+                .join(Epoch, Dataset.container)
+                .filter(cls.session == epoch.session)
+                .filter(Epoch.id != epoch.id)
+                .filter(Epoch.trashtime == None)
+                .filter(cls.size_x == size_x)
+                .filter(cls.size_y == size_y)
+                .all())
+
+    @classmethod
+    def backfill(cls, session):
+        """
+        Record the candidates of a session that were sorted before they were recorded by the sorter.
+
+        Each mux PFile dataset of the session that has no candidate yet is recorded, so that a
+        session sorted partly before candidates were recorded gets its older scans too. The phase
+        encode direction is taken from the description, as 'pe1' for scans acquired with the phase
+        encode direction reversed, since the headers are not parsed here.
+        """
+        recorded = set(id_ for id_, in DBSession.query(cls.table.c.dataset_id).filter(cls.table.c.session_id == session.id))
+        datasets = (Dataset.query
+                .join(Epoch, Dataset.container)
+                .filter(Epoch.session == session)
+                .filter(Epoch.psd.like(u'mux%'))
+                .filter(Dataset.kind == u'primary')
+                .filter(Dataset.filetype == u'pfile')
+                .all())
+        for dataset in [ds for ds in datasets if ds.id not in recorded]:
+            epoch = dataset.container
+            filenames = [fn for fn in dataset.filenames if fn.endswith('_pfile.tgz')] or [fn for fn in dataset.filenames if re.match(r'P\d{5}\.7', fn)]
+            if filenames:
+                cls(session=session, dataset=dataset,
+                        series = epoch.series,
+                        size_x = epoch.size_x,
+                        size_y = epoch.size_y,
+                        num_bands = epoch.num_bands,
+                        num_mux_cal_cycle = epoch.num_mux_cal_cycle,
+                        phase_encode_direction = 1 if u'pe1' in (epoch.description or u'') else 0,
+                        archive_path = unicode(os.path.join(dataset.relpath, filenames[0])),
+                        )
+
+
+class StageMetric(Entity):
+
+    """Resources used by one stage of a job, or of the work of a daemon, as measured by nimsutil.StageTimer."""
+
+    percentiles = (50, 90, 99)
+    summary_fields = ('wall_time', 'cpu_time', 'max_rss', 'read_bytes', 'write_bytes')
+
+    stage = Field(Unicode(63), index=True)
+    timestamp = Field(DateTime, default=datetime.datetime.now, index=True)
+    psd = Field(Unicode(255))
+    wall_time = Field(Float)        # seconds
+    cpu_time = Field(Float)         # seconds
+    max_rss = Field(Integer)        # kB, peak of the whole process
+    read_bytes = Field(BigInteger)
+    write_bytes = Field(BigInteger)
+    failed = Field(Boolean, default=False)
+
+    job = ManyToOne('Job')
+
+    def __unicode__(self):
+        return u'<%s %s %.1fs>' % (self.__class__.__name__, self.stage, self.wall_time)
+
+    @classmethod
+    def measure(cls, stage, job=None, psd=None):
+        """Return a StageTimer that records a StageMetric on exit, to be committed with the caller's transaction."""
+        return nimsutil.StageTimer(stage, lambda timer: cls.from_timer(timer, job), psd=psd)
+
+    @classmethod
+    def from_timer(cls, timer, job=None):
+        return cls(
+                stage = unicode(timer.stage),
+                psd = timer.info.get('psd'),
+                wall_time = timer.wall_time,
+                cpu_time = timer.cpu_time,
+                max_rss = timer.max_rss,
+                read_bytes = timer.read_bytes,
+                write_bytes = timer.write_bytes,
+                failed = timer.failed,
+                job = job,
+                )
+
+    @classmethod
+    def summary(cls, since, by_psd=False):
+        """Return (stage, psd, count, {field: values at percentiles}) for the metrics recorded since then."""
+        groups = {}
+        for row in DBSession.query(cls.stage, cls.psd, *[getattr(cls, f) for f in cls.summary_fields]).filter(cls.timestamp >= since):
+            groups.setdefault((row[0], row[1] if by_psd else None), []).append(row[2:])
+        summary = []
+        for (stage, psd), rows in sorted(groups.iteritems()):
+            values = {}
+            for i, field in enumerate(cls.summary_fields):
+                column = sorted(row[i] for row in rows if row[i] is not None)
+                values[field] = [column[min(len(column) - 1, len(column) * p / 100)] if column else None for p in cls.percentiles]
+            summary.append((stage, psd, len(rows), values))
+        return summary
+
+
+class TraceEvent(Entity):
+
+    """
+    The hand-off of an acquisition from one stage of the pipeline to the next.
+
+    A trace is started when data is reaped, is named by its stage item (see nimsutil.trace_id)
+    and is carried on the Dataset sorted from it and on the Jobs queued for that Dataset. Each
+    stage records the time at which it handed off the data; the latency of a stage is the time
+    since the previous hand-off of the same trace, and 'acquired' is the acquisition time itself.
+    """
+
+    events = (u'acquired', u'reaped', u'sorted', u'cooled', u'compressed', u'queued', u'started', u'processed', u'qa')
+    percentiles = (50, 90, 99)
+
+    trace = Field(Unicode(63), index=True)
+    event = Field(Unicode(31))
+    timestamp = Field(DateTime, default=datetime.datetime.now, index=True)
+
+    container = ManyToOne('DataContainer', column_kwargs=dict(index=True))
+
+    def __unicode__(self):
+        return u'<%s %s %s %s>' % (self.__class__.__name__, self.trace, self.event, self.timestamp)
+
+    @classmethod
+    def record(cls, event, container, trace, timestamp=None, update=False):
+        """
+        Record a hand-off, to be committed with the caller's transaction.
+
+        Only the first hand-off of an event is kept for each trace, unless update is True, in
+        which case the last one is, e.g. for stages that hand off a trace one file at a time.
+        """
+        if trace is None:
+            return None
+        timestamp = timestamp or datetime.datetime.now()
+        trace_event = cls.query.filter_by(trace=trace, event=event, container=container).first()
+        if not trace_event:
+            trace_event = cls(trace=trace, event=event, container=container, timestamp=timestamp)
+        elif update:
+            trace_event.timestamp = timestamp
+        return trace_event
+
+    @classmethod
+    def waterfall(cls, container, trace=None):
+        """Return [(event, timestamp, seconds since the previous hand-off)] for trace, by default the latest of container."""
+        query = cls.query.filter_by(container=container)
+        if trace is None:
+            latest = query.order_by(cls.timestamp.desc()).first()
+            if not latest:
+                return []
+            trace = latest.trace
+        timestamps = dict((te.event, te.timestamp) for te in query.filter_by(trace=trace))
+        timestamps[u'acquired'] = container.timestamp
+        return cls._waterfall(timestamps)
+
+    @classmethod
+    def _waterfall(cls, timestamps):
+        waterfall = []
+        previous = None
+        for event in [e for e in cls.events if timestamps.get(e)]:
+            delta = (timestamps[event] - previous).total_seconds() if previous else None
+            waterfall.append((event, timestamps[event], delta))
+            previous = timestamps[event]
+        return waterfall
+
+    @classmethod
+    def summary(cls, since):
+        """Return (event, count, [seconds since the previous hand-off at percentiles]) over traces handed off since then."""
+        traces = {}     # (trace, container id) -> {event: timestamp}
+        query = (DBSession.query(cls.trace, DataContainer.id, cls.event, cls.timestamp, DataContainer.timestamp)
+                .join(DataContainer, cls.container)
+                .filter(cls.trace.in_(DBSession.query(cls.trace).filter(cls.timestamp >= since))))
+        for trace, container_id, event, timestamp, acquired in query:
+            traces.setdefault((trace, container_id), {u'acquired': acquired})[event] = timestamp
+        deltas = {}
+        for timestamps in traces.itervalues():
+            for event, _, delta in cls._waterfall(timestamps):
+                if delta is not None:
+                    deltas.setdefault(event, []).append(delta)
+        summary = []
+        for event in [e for e in cls.events if e in deltas]:
+            column = sorted(deltas[event])
+            summary.append((event, len(column), [column[min(len(column) - 1, len(column) * p / 100)] for p in cls.percentiles]))
+        return summary
+
+    @classmethod
+    def recent(cls, since, limit=None):
+        """Return the containers with a hand-off since then, most recent first, up to limit of them."""
+        return (DataContainer.query
+                .filter(DataContainer.id.in_(DBSession.query(cls.table.c.container_id).filter(cls.timestamp >= since)))
+                .order_by(DataContainer.timestamp.desc())
+                .limit(limit)
+                .all())
@@ -128,6 +128,40 @@ require(['utility/tablednd', 'utility/scrolltab/drilldown', 'utility/scrolltab/m
         });
     };
 
+    /*
+     * dropExpedite
+     * Callback when a session or sessions have been dropped on the expedite div.
+     */
+    var dropExpedite = function (event, ui)
+    {
+        var selected_rows;
+        selected_rows = ui.helper.data('moving_rows');
+
+        var sess_id_list = Array();
+        selected_rows.each(function() { sess_id_list.push(getId(this.id)); });
+        $.ajax({
+            traditional: true,
+            type: 'POST',
+            url: "browse/expedite",
+            dataType: "json",
+            data:
+            {
+                sess: sess_id_list,
+            },
+            success: function(data)
+            {
+                if (data.success)
+                {
+                    alert(data.count + ' job(s) expedited.');
+                }
+                else
+                {
+                    alert('Failed');
+                }
+            },
+        });
+    };
+
     /*
      * dropSessionsOnExperiment
      * Callback when we've dropped a session or sessions onto another
@@ -455,6 +489,7 @@ require(['utility/tablednd', 'utility/scrolltab/drilldown', 'utility/scrolltab/m
         TableDragAndDrop.setupDraggable($(datasets._getBodyTable()));
         TableDragAndDrop.setupDroppable("#sessions .scrolltable_body table, #datasets .scrolltable_body table", $("#download_drop"), dropDownloads);
         TableDragAndDrop.setupDroppable(".scrolltable_body table", $("#trash_drop"), dropTrash);
+        TableDragAndDrop.setupDroppable("#sessions .scrolltable_body table", $("#expedite_drop"), dropExpedite);
 
         $($("#radio_trash input")[getTrashFlag()]).click();
         $("#radio_trash input").change(changeTrashFlag);
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+#
+# @author:  Gunnar Schaefer
+
+"""
+Benchmark the pipeline end to end on synthetic data.
+
+Synthetic DICOM series are staged the way the DicomReaper stages them, then sorted with Sorter.sort,
+compressed and digested with Scheduler.schedule, and processed with the Processor's pipelines, all
+against a scratch store and database (SQLite by default). PFile-like files of the configured size
+are compressed and digested as the PFileReaper and Scheduler would; they carry no real GE header,
+so sorting and processing PFiles is only benchmarked from a real PFile given as a template.
+
+The report lists throughput and per-item latency for each phase, followed by the stage metrics
+recorded by the daemons themselves. Run it on the target hardware before and after a change.
+"""
+
+import os
+import time
+import shutil
+import logging
+import argparse
+import datetime
+
+import numpy as np
+import dicom
+import dicom.UID
+import dicom.dataset
+import sqlalchemy
+import transaction
+
+import nimsutil
+from nimsgears.model import *
+
+import sorter
+import scheduler
+import processor
+
+log = logging.getLogger('benchmark')
+
+UID_ROOT = '1.2.826.0.1.3680043.9.7261'     # for synthetic data only
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+PFILE_HEADER_SIZE = 149788                  # size of a rev. 24 PFile header
+
+
+def make_uid(*parts):
+    return '.'.join([UID_ROOT] + [str(p) for p in parts])
+
+
+def phantom(size_x, size_y, num_slices, num_timepoints, seed=0):
+    """Return int16 images of a noisy, slowly drifting ellipsoid, about as compressible as real data."""
+    rng = np.random.RandomState(seed)
+    z, y, x = np.ogrid[-1:1:num_slices*1j, -1:1:size_y*1j, -1:1:size_x*1j]
+    volume = np.where(x**2 / .8 + y**2 / .6 + z**2 < 1, 1000., 0.)
+    for t in xrange(num_timepoints):
+        yield (volume * (1 + .01 * np.sin(t / 10.)) + rng.normal(0, 20, volume.shape)).clip(0).astype(np.int16)
+
+
+class SyntheticData(object):
+
+    """Generate stage items like the reapers do, numbered from exam to keep UIDs unique across runs."""
+
+    def __init__(self, stage_path, exam, size_x=64, size_y=64, num_slices=32, num_timepoints=100, num_bands=1, num_coils=32):
+        self.stage_path = stage_path
+        self.exam = exam
+        self.size_x = size_x
+        self.size_y = size_y
+        self.num_slices = num_slices
+        self.num_timepoints = num_timepoints
+        self.num_bands = num_bands
+        self.num_coils = num_coils
+
+    def dicom_series(self, series):
+        """Stage a DICOM series, tarred into one acquisition, in a stage dir named by a trace ID."""
+        stage_dir = nimsutil.make_joined_path(self.stage_path, '.' + nimsutil.trace_id('bench_%d_%d' % (self.exam, series)))
+        arcdir = '%d_%d_1_dicoms' % (self.exam, series)
+        arcdir_path = nimsutil.make_joined_path(stage_dir, arcdir)
+        now = datetime.datetime.now()
+        images = phantom(self.size_x, self.size_y, self.num_slices, self.num_timepoints, seed=series)
+        for t, volume in enumerate(images):
+            for s in xrange(self.num_slices):
+                instance = t * self.num_slices + s + 1
+                self.dicom_image(series, instance, t, s, volume[s], now).save_as(os.path.join(arcdir_path, '%d.dcm' % instance))
+        with nimsutil.compressed_tar(os.path.join(stage_dir, arcdir + '.tgz'), compresslevel=6) as archive:
+            archive.add(arcdir_path, arcname=arcdir)
+        shutil.rmtree(arcdir_path)
+        os.rename(stage_dir, os.path.join(self.stage_path, os.path.basename(stage_dir)[1:]))
+        return self.num_slices * self.num_timepoints
+
+    def dicom_image(self, series, instance, timepoint, slice_, pixels, timestamp):
+        meta = dicom.dataset.Dataset()
+        meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+        meta.MediaStorageSOPInstanceUID = make_uid(self.exam, series, instance)
+        meta.TransferSyntaxUID = dicom.UID.ExplicitVRLittleEndian
+        meta.ImplementationClassUID = UID_ROOT
+        dcm = dicom.dataset.FileDataset('', {}, file_meta=meta, preamble='\0' * 128)
+        dcm.is_little_endian = True
+        dcm.is_implicit_VR = False
+        dcm.SOPClassUID = MR_IMAGE_STORAGE
+        dcm.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        dcm.StudyInstanceUID = make_uid(self.exam)
+        dcm.SeriesInstanceUID = make_uid(self.exam, series)
+        dcm.FrameOfReferenceUID = make_uid(self.exam, 0)
+        dcm.Modality = 'MR'
+        dcm.Manufacturer = 'GE MEDICAL SYSTEMS'
+        dcm.ImageType = ['ORIGINAL', 'PRIMARY', 'OTHER']
+        dcm.PatientID = 'bench@unknown/benchmark'
+        dcm.PatientName = 'Benchmark^Synthetic'
+        dcm.PatientBirthDate = '19700101'
+        dcm.PatientSex = 'O'
+        dcm.OperatorsName = 'benchmark'
+        dcm.StudyID = str(self.exam)
+        dcm.SeriesNumber = series
+        dcm.AcquisitionNumber = 1
+        dcm.InstanceNumber = instance
+        dcm.StudyDate = dcm.SeriesDate = dcm.AcquisitionDate = dcm.ContentDate = timestamp.strftime('%Y%m%d')
+        dcm.StudyTime = dcm.SeriesTime = dcm.AcquisitionTime = dcm.ContentTime = timestamp.strftime('%H%M%S')
+        dcm.SeriesDescription = 'synthetic epi'
+        dcm.ProtocolName = 'benchmark'
+        dcm.MRAcquisitionType = '2D'
+        dcm.ScanningSequence = 'EP'
+        dcm.SequenceVariant = 'NONE'
+        dcm.RepetitionTime = 2000.
+        dcm.EchoTime = 30.
+        dcm.FlipAngle = 77.
+        dcm.PixelBandwidth = 7812.5
+        dcm.NumberOfAverages = 1
+        dcm.AcquisitionMatrix = [0, self.size_x, self.size_y, 0]
+        dcm.InPlanePhaseEncodingDirection = 'COL'
+        dcm.ReceiveCoilName = '32Ch Head'
+        dcm.NumberOfTemporalPositions = self.num_timepoints
+        dcm.TemporalPositionIdentifier = timepoint + 1
+        dcm.ImagesInAcquisition = self.num_slices * self.num_timepoints
+        dcm.SliceThickness = 3.
+        dcm.SpacingBetweenSlices = 3.
+        dcm.PixelSpacing = [2.4, 2.4]
+        dcm.SliceLocation = 3. * slice_
+        dcm.ImagePositionPatient = [-self.size_x * 1.2, -self.size_y * 1.2, 3. * slice_]
+        dcm.ImageOrientationPatient = [1., 0., 0., 0., 1., 0.]
+        dcm.add_new((0x0019, 0x0010), 'LO', 'GEMS_ACQU_01')
+        dcm.add_new((0x0019, 0x109c), 'LO', 'epi')                      # pulse sequence name
+        dcm.add_new((0x0021, 0x0010), 'LO', 'GEMS_RELA_01')
+        dcm.add_new((0x0021, 0x104f), 'SS', self.num_slices)            # locations in acquisition
+        dcm.SamplesPerPixel = 1
+        dcm.PhotometricInterpretation = 'MONOCHROME2'
+        dcm.Rows = self.size_y
+        dcm.Columns = self.size_x
+        dcm.BitsAllocated = 16
+        dcm.BitsStored = 16
+        dcm.HighBit = 15
+        dcm.PixelRepresentation = 1
+        dcm.PixelData = pixels.tostring()
+        return dcm
+
+    def pfile_like(self, path, series):
+        """Write a PFile-like file of the configured size, complex int16 data after a blank header, and return its size."""
+        with open(path, 'wb') as pfile:
+            pfile.write('\0' * PFILE_HEADER_SIZE)
+            for volume in phantom(self.size_x, self.size_y, self.num_slices / self.num_bands, self.num_timepoints, seed=series):
+                for coil in xrange(self.num_coils):
+                    np.dstack((volume, volume[:, ::-1])).tofile(pfile)   # stand-in for real and imaginary parts
+        return os.path.getsize(path)
+
+    def pfile_from_template(self, series, template):
+        """Stage a copy of a real PFile, as the PFileReaper does."""
+        stage_dir = nimsutil.make_joined_path(self.stage_path, '.' + nimsutil.trace_id('bench_%d_%d' % (self.exam, series)))
+        path = os.path.join(stage_dir, os.path.basename(template))
+        shutil.copy2(template, path)
+        size = os.path.getsize(path)
+        nimsutil.gzip_inplace(path, 0o644)
+        os.rename(stage_dir, os.path.join(self.stage_path, os.path.basename(stage_dir)[1:]))
+        return size
+
+
+class Phase(object):
+
+    """Throughput and per-item latency of one phase of the benchmark."""
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.bytes = 0
+        self.wall_time = None   # when items overlap; otherwise the sum of their latencies
+
+    def time(self, nbytes=0):
+        """Return a context manager that times one item of nbytes."""
+        self.bytes += nbytes
+        return nimsutil.StageTimer(self.name, lambda timer: self.latencies.append(timer.wall_time))
+
+    def report(self):
+        total = self.wall_time if self.wall_time is not None else sum(self.latencies)
+        column = sorted(self.latencies)
+        values = [column[min(len(column) - 1, len(column) * p / 100)] for p in self.percentiles] if column else []
+        return '%-12s %6d %10.2f %10.2f %10s/s %s' % (
+                self.name, len(column), total,
+                len(column) / total if total else 0,
+                nimsutil.hrsize(self.bytes / total if total else 0),
+                ''.join('%10.3f' % v for v in values))
+
+
+class Benchmark(object):
+
+    def __init__(self, db_uri, work_path, synthetic_args, num_dicom, num_pfile, pfile_template=None, jobs=1):
+        self.work_path = work_path
+        self.stage_path = nimsutil.make_joined_path(work_path, 'stage')
+        self.nims_path = nimsutil.make_joined_path(work_path, 'nims')
+        self.preserve_path = nimsutil.make_joined_path(work_path, 'preserve')
+        self.tempdir = nimsutil.make_joined_path(work_path, 'tmp')
+        self.db_uri = db_uri or 'sqlite:///%s' % os.path.join(work_path, 'nims.sqlite')
+        self.num_dicom = num_dicom
+        self.num_pfile = num_pfile
+        self.pfile_template = pfile_template
+        self.jobs = jobs
+
+        engine = sqlalchemy.create_engine(self.db_uri)
+        init_model(engine)
+        metadata.create_all(engine)
+        if not ResearchGroup.query.filter_by(gid=u'unknown').first():
+            ResearchGroup(gid=u'unknown')
+        transaction.commit()
+
+        exam = int(time.time()) % 100000
+        self.data = SyntheticData(self.stage_path, exam, **synthetic_args)
+        self.phases = []
+
+    def phase(self, name):
+        phase = Phase(name)
+        self.phases.append(phase)
+        return phase
+
+    def run(self):
+        self.start = datetime.datetime.now()
+        self.generate()
+        self.reap_pfile_like()
+        self.sort()
+        self.schedule()
+        self.process()
+
+    def generate(self):
+        dicom_phase = self.phase('gen dicom')
+        for series in xrange(1, self.num_dicom + 1):
+            with dicom_phase.time():
+                self.data.dicom_series(series)
+        if self.pfile_template:
+            for series in xrange(self.num_dicom + 1, self.num_dicom + self.num_pfile + 1):
+                self.data.pfile_from_template(series, self.pfile_template)
+
+    def reap_pfile_like(self):
+        """Compress and digest synthetic PFile-like files as the PFileReaper and Scheduler would."""
+        compress_phase = self.phase('gzip pfile')
+        digest_phase = self.phase('digest pfile')
+        for series in xrange(self.num_pfile):
+            with nimsutil.TempDir(dir=self.tempdir) as tempdir:
+                path = os.path.join(tempdir, 'P%05d.7' % series)
+                with compress_phase.time(self.data.pfile_like(path, series)):
+                    nimsutil.gzip_inplace(path, 0o644)
+                with digest_phase.time(nimsutil.du(tempdir)):
+                    nimsutil.redigest(tempdir)
+
+    def sort(self):
+        sort_phase = self.phase('sort')
+        the_sorter = sorter.Sorter(self.stage_path, self.preserve_path, self.nims_path, 0)
+        for stage_item in sorted(os.listdir(self.stage_path)):
+            stage_item_path = os.path.join(self.stage_path, stage_item)
+            for filepath in [os.path.join(dirpath, fn) for (dirpath, _, filenames) in os.walk(stage_item_path) for fn in filenames]:
+                with sort_phase.time(os.path.getsize(filepath)):
+                    the_sorter.sort(filepath, stage_item)
+            shutil.rmtree(stage_item_path)
+        preserved = os.listdir(self.preserve_path)
+        if preserved:
+            log.warning('%d files could not be sorted, see %s' % (len(preserved), self.preserve_path))
+
+    def schedule(self):
+        schedule_phase = self.phase('schedule')
+        the_scheduler = scheduler.Scheduler(self.db_uri, self.nims_path, 0, 0, 10, 24)
+        while True:
+            dc = the_scheduler.next_dirty()
+            if not dc:
+                break
+            with schedule_phase.time(sum(nimsutil.du(os.path.join(self.nims_path, ds.relpath)) for ds in dc.original_datasets)):
+                the_scheduler.schedule(dc)
+        transaction.commit()
+
+    def process(self):
+        """Run the queued jobs, up to jobs at a time, in the Processor's pipelines."""
+        process_phase = self.phase('process')
+        process_phase.wall_time = 0.
+        the_processor = processor.Processor(self.db_uri, self.nims_path, None, u'find&proc', [], self.jobs, self.jobs, False, 0,
+                self.tempdir, False, 3600)
+        while True:
+            jobs = Job.claim(Job.query.filter(Job.task == u'find&proc').order_by(Job.id), self.jobs, the_processor.owner, the_processor.lease_time)
+            if not jobs:
+                break
+            start = time.time()
+            for job in jobs:
+                the_processor.start(job)
+            for pipeline in list(the_processor.pipelines):
+                pipeline.join()
+                process_phase.latencies.append(time.time() - start)
+            the_processor.collect()
+            process_phase.wall_time += time.time() - start
+
+    def report(self):
+        print '%-12s %6s %10s %10s %12s %s' % ('phase', 'items', 'seconds', 'items/s', 'throughput',
+                ''.join('%10s' % ('p%d s' % p) for p in Phase.percentiles))
+        for phase in self.phases:
+            print phase.report()
+        print
+        print '%-12s %6s %s' % ('stage', 'count', ''.join('%10s' % ('p%d s' % p) for p in StageMetric.percentiles))
+        for stage, psd, count, values in StageMetric.summary(self.start):
+            print '%-12s %6d %s' % (stage, count, ''.join('%10.3f' % v if v is not None else '%10s' % '' for v in values['wall_time']))
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.description = """Benchmark the sorter, scheduler and processor on synthetic data."""
+        self.add_argument('-u', '--db_uri', help='URI of a scratch database (default: SQLite in the work dir)')
+        self.add_argument('-w', '--workdir', help='scratch directory, kept afterwards if given (default: a temporary directory)')
+        self.add_argument('-d', '--dicoms', type=int, default=4, help='number of DICOM series (default: 4)')
+        self.add_argument('-p', '--pfiles', type=int, default=2, help='number of PFile-like files (default: 2)')
+        self.add_argument('-t', '--template', help='real PFile to also sort and process, --pfiles times')
+        self.add_argument('-x', '--size_x', type=int, default=64, help='matrix size x (default: 64)')
+        self.add_argument('-y', '--size_y', type=int, default=64, help='matrix size y (default: 64)')
+        self.add_argument('-s', '--slices', type=int, default=32, help='slices per volume (default: 32)')
+        self.add_argument('-n', '--timepoints', type=int, default=100, help='timepoints (default: 100)')
+        self.add_argument('-b', '--bands', type=int, default=1, help='multiband factor of PFile-like files (default: 1)')
+        self.add_argument('-c', '--coils', type=int, default=32, help='receive coils of PFile-like files (default: 32)')
+        self.add_argument('-j', '--jobs', type=int, default=1, help='processor jobs to run concurrently (default: 1)')
+        self.add_argument('-f', '--logfile', help='path to log file')
+        self.add_argument('-l', '--loglevel', default='warning', help='log level (default: warning)')
+        self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
+    synthetic_args = dict(size_x=args.size_x, size_y=args.size_y, num_slices=args.slices, num_timepoints=args.timepoints,
+            num_bands=args.bands, num_coils=args.coils)
+    with nimsutil.TempDir() as tempdir:
+        work_path = nimsutil.make_joined_path(args.workdir) if args.workdir else tempdir
+        benchmark = Benchmark(args.db_uri, work_path, synthetic_args, args.dicoms, args.pfiles, args.template, args.jobs)
+        benchmark.run()
+        benchmark.report()
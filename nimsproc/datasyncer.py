@@ -18,7 +18,8 @@ log = logging.getLogger('datasyncer')
 class DataSyncer(object):
 
     def __init__(self, data_path, sync_path, sleep_time):
-        self.rsync_cmd = 'rsync -a --del %s %s' % (data_path, sync_path)
+        # pipelines stage their outputs in .staging inside the store, before publishing them by rename
+        self.rsync_cmd = 'rsync -a --del --exclude=.staging/ %s %s' % (data_path, sync_path)
         self.sleep_time = sleep_time
         self.alive = True
 
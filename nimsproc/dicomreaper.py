@@ -8,7 +8,6 @@ import time
 import shutil
 import signal
 import logging
-import tarfile
 import argparse
 import datetime
 import collections
@@ -19,6 +18,11 @@ import nimsdata
 
 log = logging.getLogger('dicomreaper')
 
+metrics = nimsutil.metrics_registry
+reaped_series = metrics.counter('nims_reaped_total', 'Series or files handed to the sorter')
+reaped_images = metrics.counter('nims_reaped_images_total', 'DICOM images reaped')
+incomplete_series = metrics.counter('nims_reap_incomplete_total', 'Reaps that did not retrieve every image')
+
 
 class DicomReaper(object):
 
@@ -35,6 +39,8 @@ class DicomReaper(object):
         self.current_exam_datetime = nimsutil.get_reference_datetime(self.datetime_file)
         self.monitored_exams = collections.deque()
         self.alive = True
+        metrics.gauge('nims_stage_backlog', 'Items waiting in a stage directory',
+                lambda: {(('stage', 'sort'),): nimsutil.stage_backlog(self.sort_stage)})
 
         # delete any files left behind from a previous run
         for item in os.listdir(self.reap_stage):
@@ -149,7 +155,7 @@ class Series(object):
             log.info('Monitoring  %s' % self)
         elif self.needs_reaping: # image count has stopped increasing
             log.info('Reaping     %s' % self)
-            stage_dir = '%s_%s_%s_%s' % (self.reaper.id_, self.exam.id_, self.id_, datetime.datetime.now().strftime('%s'))
+            stage_dir = nimsutil.trace_id('%s_%s_%s' % (self.reaper.id_, self.exam.id_, self.id_))
             reap_path = nimsutil.make_joined_path(self.reaper.reap_stage, stage_dir)
             reap_count = self.reaper.scu.move(scu.SeriesQuery(SeriesInstanceUID=self.uid), reap_path)
             if reap_count == self.image_count:
@@ -157,8 +163,11 @@ class Series(object):
                 shutil.move(reap_path, os.path.join(self.reaper.sort_stage, '.' + stage_dir))
                 os.rename(os.path.join(self.reaper.sort_stage, '.' + stage_dir), os.path.join(self.reaper.sort_stage, stage_dir))
                 self.needs_reaping = False
+                reaped_series.inc()
+                reaped_images.inc(reap_count)
                 log.info('Reaped      %s' % self)
             else:
+                incomplete_series.inc()
                 shutil.rmtree(reap_path)
                 log.warning('Incomplete  %s, %d reaped' % (self, reap_count))
 
@@ -175,7 +184,8 @@ class Series(object):
             os.mkdir(arcdir_path)
             for filepath in acq_paths:
                 os.rename(filepath, '%s.dcm' % os.path.join(arcdir_path, os.path.basename(filepath)))
-            with tarfile.open('%s.tgz' % arcdir_path, 'w:gz', compresslevel=6) as archive:
+            with metrics.histogram('nims_compress_seconds', 'Time spent compressing files').time(method='gzip'), \
+                    nimsutil.compressed_tar('%s.tgz' % arcdir_path, compresslevel=6) as archive:
                 archive.add(arcdir_path, arcname=os.path.basename(arcdir_path))
             shutil.rmtree(arcdir_path)
 
@@ -195,6 +205,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
+        self.add_argument('-P', '--metricsport', type=int, help='serve metrics on this port of localhost')
 
 
 if __name__ == '__main__':
@@ -202,6 +213,8 @@ if __name__ == '__main__':
     host, port, return_port = args.dicomserver.split(':')
 
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
+    if args.metricsport:
+        nimsutil.metrics_registry.serve(args.metricsport)
     scu_ = scu.SCU(host, port, return_port, args.aet, args.aec)
     datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % args.aec)
 
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#
+# @author:  Gunnar Schaefer
+
+import argparse
+import datetime
+
+import sqlalchemy
+
+from nimsgears.model import *
+
+
+def format_seconds(seconds):
+    return '%dh%02dm%02ds' % (seconds // 3600, seconds % 3600 // 60, seconds % 60) if seconds is not None else ''
+
+
+def print_waterfall(epoch):
+    print '%s (%s)' % (epoch, epoch.timestamp)
+    for event, timestamp, delta in TraceEvent.waterfall(epoch):
+        print '    %-12s %s  %12s' % (event, timestamp.strftime('%Y-%m-%d %H:%M:%S'), format_seconds(delta))
+
+
+def print_summary(since):
+    print 'Latency of each hand-off since %s' % since.strftime('%Y-%m-%d %H:%M')
+    print '    %-12s %6s %s' % ('stage', 'count', ''.join('%12s' % ('p%d' % p) for p in TraceEvent.percentiles))
+    for event, count, values in TraceEvent.summary(since):
+        print '    %-12s %6d %s' % (event, count, ''.join('%12s' % format_seconds(v) for v in values))
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super(ArgumentParser, self).__init__()
+        self.description = """Report the time from acquisition to NIfTI and QA, as traced through the pipeline."""
+        self.add_argument('db_uri', help='database URI')
+        self.add_argument('-d', '--days', type=int, default=7, help='summarize traces handed off in the last days (default: 7)')
+        self.add_argument('-e', '--epoch_id', type=int, action='append', help='show the latency waterfall of this epoch (repeatable)')
+        self.add_argument('-w', '--waterfalls', action='store_true', help='show the latency waterfall of every recent epoch')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser().parse_args()
+    init_model(sqlalchemy.create_engine(args.db_uri))
+    since = datetime.datetime.now() - datetime.timedelta(days=args.days)
+    if args.epoch_id:
+        for epoch_id in args.epoch_id:
+            print_waterfall(Epoch.get(epoch_id))
+    else:
+        if args.waterfalls:
+            for epoch in TraceEvent.recent(since):
+                print_waterfall(epoch)
+        print_summary(since)
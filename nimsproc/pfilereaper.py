@@ -17,15 +17,22 @@ import nimsdata
 
 log = logging.getLogger('pfilereaper')
 
+metrics = nimsutil.metrics_registry
+reaped_files = metrics.counter('nims_reaped_total', 'Series or files handed to the sorter')
+reaped_bytes = metrics.counter('nims_reaped_bytes_total', 'Bytes of PFiles reaped')
+monitored_files = metrics.gauge('nims_monitored_files', 'PFiles being watched until they stop growing')
+
 
 class PFileReaper(object):
 
-    def __init__(self, id_, pat_id, discard_ids, data_path, reap_path, sort_path, datetime_file, sleep_time):
+    def __init__(self, id_, pat_id, discard_ids, data_path, reap_path, sort_path, datetime_file, sleep_time, poll=None):
         super(PFileReaper, self).__init__()
         self.id_ = id_
         self.pat_id = pat_id
         self.discard_ids = discard_ids
+        self.data_path = data_path
         self.data_glob = os.path.join(data_path, 'P?????.7')
+        self.poll = poll
         self.reap_stage = nimsutil.make_joined_path(reap_path)
         self.sort_stage = nimsutil.make_joined_path(sort_path)
         self.datetime_file = datetime_file
@@ -34,6 +41,8 @@ class PFileReaper(object):
         self.current_file_timestamp = nimsutil.get_reference_datetime(self.datetime_file)
         self.monitored_files = {}
         self.alive = True
+        metrics.gauge('nims_stage_backlog', 'Items waiting in a stage directory',
+                lambda: {(('stage', 'sort'),): nimsutil.stage_backlog(self.sort_stage)})
 
         # delete any files left behind from a previous run
         for item in os.listdir(self.reap_stage):
@@ -47,6 +56,17 @@ class PFileReaper(object):
         self.alive = False
 
     def run(self):
+        """
+        Reap PFiles once they stop growing.
+
+        A PFile is complete once its size and modification time have been unchanged for at least the
+        sleep time. Scanners may reopen a PFile and append to it after closing it, so a close is not
+        taken to mean complete. When the data directory can be watched with inotify, a close only
+        wakes the reaper to check sooner, and the reaper sleeps no longer than it takes for the next
+        monitored PFile to become stable.
+        """
+        watcher = nimsutil.StageWatcher(self.data_path, self.sleep_time, self.poll)
+        watcher.items(0)    # closes only wake the reaper; every PFile must be seen to stop growing
         while self.alive:
             try:
                 reap_files = [ReapPFile(p, self) for p in glob.glob(self.data_glob)]
@@ -59,20 +79,29 @@ class PFileReaper(object):
                 for rf in reap_files:
                     if rf.path in self.monitored_files:
                         mf = self.monitored_files[rf.path]
-                        if mf.needs_reaping and rf.size == mf.size:
+                        if rf.size == mf.size and rf.mod_time == mf.mod_time:
+                            rf.stable_since = mf.stable_since
+                        if mf.needs_reaping and rf.stable_since + self.sleep_time <= time.time():
                             rf.reap()
                             if not rf.needs_reaping:
                                 nimsutil.update_reference_datetime(self.datetime_file, rf.mod_time)
                                 self.current_file_timestamp = rf.mod_time
                         elif mf.needs_reaping:
-                            log.info('Monitoring  %s' % rf)
+                            if rf.stable_since != mf.stable_since:
+                                log.info('Monitoring  %s' % rf)
                         elif rf.size == mf.size:
                             rf.needs_reaping = False
                     else:
                         log.info('Discovered  %s' % rf)
                 self.monitored_files = dict(zip([rf.path for rf in reap_files], reap_files))
+                monitored_files.set(len([rf for rf in reap_files if rf.needs_reaping]))
             finally:
-                time.sleep(self.sleep_time)
+                if watcher.notifies:
+                    stable_times = [rf.stable_since + self.sleep_time for rf in self.monitored_files.itervalues() if rf.needs_reaping]
+                    watcher.items(max(min(stable_times + [time.time() + self.sleep_time]) - time.time(), 0.1))
+                else:
+                    time.sleep(self.sleep_time)
+        watcher.close()
 
 
 class ReapPFile(object):
@@ -84,6 +113,7 @@ class ReapPFile(object):
         self.pat_id = None
         self.size = os.path.getsize(path)
         self.mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        self.stable_since = time.time()     # when the current size and modification time were first seen
         self.needs_reaping = True
         self.pfile = None
 
@@ -104,7 +134,7 @@ class ReapPFile(object):
             return
         else:
             self.pat_id = self.pfile.patient_id
-            stage_dir = '%s_%s' % (self.reaper.id_, datetime.datetime.now().strftime('%s.%f'))
+            stage_dir = nimsutil.trace_id(self.reaper.id_)
             reap_path = nimsutil.make_joined_path(self.reaper.reap_stage, stage_dir)
         if self.pat_id.strip('/').lower() in reaper.discard_ids:
             self.needs_reaping = False
@@ -132,6 +162,8 @@ class ReapPFile(object):
             shutil.move(reap_path, os.path.join(self.reaper.sort_stage, '.' + stage_dir))
             os.rename(os.path.join(self.reaper.sort_stage, '.' + stage_dir), os.path.join(self.reaper.sort_stage, stage_dir))
             self.needs_reaping = False
+            reaped_files.inc()
+            reaped_bytes.inc(self.size)
             log.info('Reaped      %s' % self)
 
 
@@ -145,9 +177,11 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('-p', '--patid', help='glob for patient IDs to reap (default: "*")')
         self.add_argument('-d', '--discard', default='discard', help='space-separated list of Patient IDs to discard')
         self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-o', '--poll', action='store_true', default=None, help='poll the data directory rather than watch it (default: poll network filesystems only)')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
+        self.add_argument('-P', '--metricsport', type=int, help='serve metrics on this port of localhost')
 
 
 if __name__ == '__main__':
@@ -155,9 +189,11 @@ if __name__ == '__main__':
 
     reaper_id = args.data_path.strip('/').replace('/', '_')
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
+    if args.metricsport:
+        nimsutil.metrics_registry.serve(args.metricsport)
     datetime_file = os.path.join(os.path.dirname(__file__), '.%s.datetime' % reaper_id)
 
-    reaper = PFileReaper(reaper_id, args.patid, args.discard.split(), args.data_path, args.reap_path, args.sort_path, datetime_file, args.sleeptime)
+    reaper = PFileReaper(reaper_id, args.patid, args.discard.split(), args.data_path, args.reap_path, args.sort_path, datetime_file, args.sleeptime, args.poll)
 
     def term_handler(signum, stack):
         reaper.halt()
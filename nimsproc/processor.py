@@ -7,13 +7,19 @@ import os
 import abc
 import glob
 import time
+import Queue
+import select
 import shutil
 import signal
+import socket
 import logging
-import tarfile
 import argparse
 import datetime
+import hashlib
+import resource
 import threading
+import collections
+import multiprocessing
 import numpy as np
 
 import sqlalchemy
@@ -29,11 +35,42 @@ from nimsgears.model import *
 
 log = logging.getLogger('processor')
 
+metrics = nimsutil.metrics_registry
+jobs_running = metrics.gauge('nims_jobs_running', 'Jobs running in this processor')
+jobs_started = metrics.counter('nims_jobs_started_total', 'Jobs started, by cost class')
+jobs_finished = metrics.counter('nims_jobs_finished_total', 'Jobs finished, by cost class')
+job_seconds = metrics.histogram('nims_job_seconds', 'Time from the start of a job until it finishes, by cost class')
+
+# Resources held by each class of job while it runs, as (cpus, memory in GB). A cpus value of None
+# stands for the maximum number of concurrent recon jobs (-k).
+JOB_COSTS = {
+        u'physio':      (1, 0.5),
+        u'screenshot':  (1, 0.5),
+        u'dicom':       (1, 2),
+        u'pfile':       (2, 8),
+        u'pfile_mux':   (None, 24),
+        }
+HEAVY_JOBS = (u'pfile', u'pfile_mux')   # kept out of the cpus reserved for short jobs
+CLAIM_WINDOW = 100                      # number of pending jobs considered for packing at once
+
+# Stages of a find&proc job, in dependency order: stage -> (stages it depends on, kind and filetypes of its
+# output datasets). Outputs are tagged with a digest of their inputs, so that a rerun only recomputes stale
+# stages. The physio stage runs as a separate find job, in parallel with nifti and pyramid.
+STAGES = collections.OrderedDict([
+        ('parse',   ((), None)),
+        ('physio',  (('parse',), (u'peripheral', (u'physio',)))),
+        ('nifti',   (('parse',), (u'derived', (u'nifti', u'bitmap')))),
+        ('pyramid', (('nifti',), (u'web', (u'img_pyr',)))),
+        ])
+PHYSIO_RETRY_DELAY = datetime.timedelta(seconds=30)
+
 
 class Processor(object):
 
-    def __init__(self, db_uri, nims_path, physio_path, task, filters, max_jobs, max_recon_jobs, reset, sleeptime, tempdir, newest):
+    def __init__(self, db_uri, nims_path, physio_path, task, filters, max_jobs, max_recon_jobs, reset, sleeptime, tempdir, newest, lease_time,
+            backend='thread', max_mem=None, max_cpu=None, cpu_budget=None, mem_budget=None, reserved_cpus=1, cache_path=None, cache_size=None):
         super(Processor, self).__init__()
+        self.db_uri = db_uri
         self.nims_path = nims_path
         self.physio_path = physio_path
         self.task = unicode(task) if task else None
@@ -43,9 +80,26 @@ class Processor(object):
         self.sleeptime = sleeptime
         self.tempdir = tempdir
         self.newest = newest
+        self.lease_time = datetime.timedelta(seconds=lease_time)
+        self.owner = u'%s:%d' % (socket.gethostname(), os.getpid())
+        self.backend = backend
+        self.max_mem = max_mem
+        self.max_cpu = max_cpu
+        self.cpu_budget = cpu_budget or multiprocessing.cpu_count()
+        self.mem_budget = mem_budget or os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.**3
+        self.reserved_cpus = min(reserved_cpus, self.cpu_budget - 1)
+        self.pfile_cache = nimsutil.ExtractionCache(cache_path, cache_size) if cache_path else None
+        self.pipelines = []
+        self.costs = {}         # pipeline -> (cost class, cpus, memory) held while it runs
+        self.start_times = {}   # pipeline -> start time
+        self.claim_costs = {}   # job id -> (cost class, cpus, memory), from claim until start
+        self.results = multiprocessing.Queue()
+        self.reported = set()   # ids of jobs whose pipeline process reported a result before it was collected
 
         self.alive = True
-        init_model(sqlalchemy.create_engine(db_uri))
+        self.engine = sqlalchemy.create_engine(db_uri)
+        init_model(self.engine)
+        self.waiter = JobWaiter(self.engine, sleeptime)
         if reset: self.reset_all()
 
     def halt(self):
@@ -53,40 +107,147 @@ class Processor(object):
 
     def run(self):
         while self.alive:
-            if threading.active_count()-1 < self.max_jobs:
+            self.collect()
+            if len(self.pipelines) < self.max_jobs:
+                for job in Job.reclaim_expired():
+                    log.warning(u'%d %s %s' % (job.id, job, job.activity))
                 query = Job.query.join(DataContainer).join(Epoch)
                 if self.task:
                     query = query.filter(Job.task==self.task)
                 for f in self.filters:
                     query = query.filter(eval(f))
-                if self.newest:
-                    job = query.filter(Job.status==u'pending').order_by(Job.id.desc()).with_lockmode('update').first()
-                else:
-                    job = query.filter(Job.status==u'pending').order_by(Job.id).with_lockmode('update').first()
-
-                if job:
-                    if isinstance(job.data_container, Epoch) and job.data_container.primary_dataset!=None:
-                        ds = job.data_container.primary_dataset
-                        if ds.filetype == nimsdata.medimg.nimsdicom.NIMSDicom.filetype:
-                            pipeline_class = DicomPipeline
-                        elif ds.filetype == nimsdata.medimg.nimspfile.NIMSPFile.filetype:
-                            pipeline_class = PFilePipeline
-
-                        pipeline = pipeline_class(job, self.nims_path, self.physio_path, self.tempdir, self.max_recon_jobs)
-                        job.status = u'running'
-                        transaction.commit()
-                        pipeline.start()
-                    else:
-                        job.status = u'failed'
-                        job.activity = u'failed: not an Epoch or no primary dataset.'
-                        log.warning(u'%d %s %s ' % (job.id, job, job.activity))
-                        transaction.commit()
+                query = query.order_by(Job.priority.desc(), Job.id.desc() if self.newest else Job.id)
+                jobs = Job.claim(query, CLAIM_WINDOW, self.owner, self.lease_time, self.admission_filter())
+
+                if jobs:
+                    self.waiter.reset()
+                    for job in jobs:
+                        self.start(job)
                 else:
                     log.debug('Waiting for work...')
-                    time.sleep(self.sleeptime)
+                    self.waiter.wait()
             else:
                 log.debug('Waiting for jobs to finish...')
-                time.sleep(self.sleeptime)
+                self.pipelines[0].join(self.sleeptime)
+
+    def cost(self, job):
+        """Return the cost class of a job, and the cpus and memory (in GB) it holds while running."""
+        epoch = job.data_container
+        ds = epoch.primary_dataset if isinstance(epoch, Epoch) else None
+        if ds is None:
+            return None, 0, 0   # will fail right away
+        if job.task == u'find':
+            cost_class = u'physio'
+        elif ds.filetype == nimsdata.medimg.nimspfile.NIMSPFile.filetype:
+            if (epoch.psd or u'').startswith(u'mux') and (epoch.num_bands or 1) > 1:
+                cost_class = u'pfile_mux'
+            else:
+                cost_class = u'pfile'
+        elif epoch.scan_type == u'screenshot':
+            cost_class = u'screenshot'
+        else:
+            cost_class = u'dicom'
+        cpus, memory = JOB_COSTS[cost_class]
+        cpu_budget = self.cpu_budget - (self.reserved_cpus if cost_class in HEAVY_JOBS else 0)
+        return cost_class, min(cpus or self.max_recon_jobs, cpu_budget), min(memory, self.mem_budget)
+
+    def admission_filter(self):
+        """
+        Return a claim filter that packs jobs into the remaining cpu and memory budget.
+
+        Candidates that don't fit are passed over rather than waited for, so short jobs never
+        queue behind long recons. Heavy jobs may not use the cpus reserved for short jobs. A job
+        is always admitted when nothing else is running, so that no job can be starved outright.
+        """
+        free_slots = self.max_jobs - len(self.pipelines)
+        used = [sum(c[1] for c in self.costs.itervalues()), sum(c[2] for c in self.costs.itervalues())]
+        self.claim_costs = {}
+
+        def accept(job):
+            if len(self.claim_costs) >= free_slots:
+                return False
+            cost_class, cpus, memory = self.cost(job)
+            cpu_budget = self.cpu_budget - (self.reserved_cpus if cost_class in HEAVY_JOBS else 0)
+            fits = used[0] + cpus <= cpu_budget and used[1] + memory <= self.mem_budget
+            if fits or not (self.pipelines or self.claim_costs):
+                used[0] += cpus
+                used[1] += memory
+                self.claim_costs[job.id] = (cost_class, cpus, memory)
+                return True
+            return False
+
+        return accept
+
+    def start(self, job):
+        """Start a pipeline for a freshly claimed job."""
+        DBSession.add(job)
+        cost = self.claim_costs.pop(job.id, None) or self.cost(job)
+        if isinstance(job.data_container, Epoch) and job.data_container.primary_dataset!=None:
+            ds = job.data_container.primary_dataset
+            if ds.filetype == nimsdata.medimg.nimsdicom.NIMSDicom.filetype:
+                pipeline_class = DicomPipeline
+            elif ds.filetype == nimsdata.medimg.nimspfile.NIMSPFile.filetype:
+                pipeline_class = PFilePipeline
+
+            cost_class, cpus, memory = cost
+            log.info(u'%d %s claimed as %s job (%d cpus, %.1f GB)' % (job.id, job, cost_class, cpus, memory))
+            recon_jobs = cpus if cost_class in HEAVY_JOBS else self.max_recon_jobs
+            pipeline_args = (self.nims_path, self.physio_path, self.tempdir, recon_jobs, self.owner, self.lease_time, self.pfile_cache)
+            if self.backend == 'process':
+                if self.physio_path:
+                    nimsutil.physio_index(self.physio_path).update()    # let the child inherit an up-to-date index
+                pipeline = PipelineProcess(self.db_uri, job.id, pipeline_class, pipeline_args, self.results, self.max_mem, self.max_cpu)
+                transaction.commit()
+                self.engine.dispose()   # the child must not inherit pooled connections
+            else:
+                pipeline = pipeline_class(job, *pipeline_args)
+                transaction.commit()
+            pipeline.start()
+            self.pipelines.append(pipeline)
+            self.costs[pipeline] = cost
+            self.start_times[pipeline] = time.time()
+            jobs_started.inc(cost_class=cost_class)
+            jobs_running.set(len(self.pipelines))
+        else:
+            job.status = u'failed'
+            job.activity = u'failed: not an Epoch or no primary dataset.'
+            job.release()
+            log.warning(u'%d %s %s ' % (job.id, job, job.activity))
+            transaction.commit()
+
+    def collect(self):
+        """Forget finished pipelines and record the results reported by pipeline processes."""
+        self.drain()
+        finished = [p for p in self.pipelines if not p.is_alive()]
+        self.pipelines = [p for p in self.pipelines if p not in finished]
+        for p in finished:
+            cost_class = self.costs.pop(p, (None,))[0]
+            job_seconds.observe(time.time() - self.start_times.pop(p), cost_class=cost_class)
+            jobs_finished.inc(cost_class=cost_class)
+        jobs_running.set(len(self.pipelines))
+        for p in [p for p in finished if isinstance(p, PipelineProcess)]:
+            if p.job_id not in self.reported:
+                self.drain(timeout=1)   # the result of a process that just exited may still be in the pipe
+            if p.job_id in self.reported:
+                self.reported.remove(p.job_id)
+            else:
+                log.warning(u'%d pipeline process exited with code %s' % (p.job_id, p.exitcode))
+                self.finish(p.job_id, u'failed', u'failed: pipeline process exited with code %s' % p.exitcode)
+
+    def drain(self, timeout=None):
+        """Record the results queued by pipeline processes, waiting up to timeout seconds for the first one."""
+        try:
+            while True:
+                job_id, status, activity = self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+                timeout = None
+                self.finish(job_id, status, activity)
+                self.reported.add(job_id)
+        except Queue.Empty:
+            pass
+
+    def finish(self, job_id, status, activity):
+        if not Job.finish(job_id, self.owner, status, activity):
+            log.warning(u'%d lost lease, not recording %s' % (job_id, status))
 
     def reset_all(self):
         """Reset all running of failed jobs to pending."""
@@ -96,46 +257,210 @@ class Processor(object):
         for job in job_query.all():
             job.status = u'pending'
             job.activity = u'reset to pending'
+            job.release()
             log.info(u'%d %s %s' % (job.id, job, job.activity))
         transaction.commit()
 
 
+class JobWaiter(object):
+
+    """
+    Block until new jobs may be available.
+
+    With PostgreSQL, we LISTEN for the notifications sent by the scheduler whenever it creates
+    or resets a job, and still wake up every sleeptime seconds to catch jobs queued by other
+    means. Other databases are polled with an exponential backoff from min_sleeptime up to
+    sleeptime, which starts over as soon as work is found.
+    """
+
+    def __init__(self, engine, sleeptime, min_sleeptime=0.1):
+        super(JobWaiter, self).__init__()
+        self.sleeptime = sleeptime
+        self.min_sleeptime = min(min_sleeptime, sleeptime)
+        self.backoff = self.min_sleeptime
+        self.connection = None
+        if engine.dialect.name == 'postgresql':
+            self.pool_connection = engine.raw_connection()      # keep checked out for the lifetime of the waiter
+            self.connection = self.pool_connection.connection
+            self.connection.set_isolation_level(0)              # LISTEN requires autocommit
+            self.connection.cursor().execute('LISTEN %s' % Job.notify_channel)
+            log.debug('Listening for job notifications on channel %s' % Job.notify_channel)
+
+    def reset(self):
+        self.backoff = self.min_sleeptime
+
+    def wait(self):
+        if self.connection:
+            if select.select([self.connection], [], [], self.sleeptime)[0]:
+                self.connection.poll()
+                del self.connection.notifies[:]
+        else:
+            time.sleep(self.backoff)
+            self.backoff = min(2 * self.backoff, self.sleeptime)
+
+
+class LeaseHeartbeat(threading.Thread):
+
+    """Periodically renew the lease on a running job until stopped, or until the lease is lost."""
+
+    def __init__(self, job_id, owner, lease_time):
+        super(LeaseHeartbeat, self).__init__()
+        self.daemon = True
+        self.job_id = job_id
+        self.owner = owner
+        self.lease_time = lease_time
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self):
+        interval = self.lease_time.total_seconds() / 3.
+        while not self.stopped.wait(interval):
+            try:
+                if not Job.renew_lease(self.job_id, self.owner, self.lease_time):
+                    log.warning(u'%d lost lease' % self.job_id)
+                    self.lost.set()
+                    break
+            except sqlalchemy.exc.SQLAlchemyError as ex:
+                transaction.abort()
+                log.warning(u'%d error renewing lease: %s' % (self.job_id, ex))
+        DBSession.remove()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class PipelineProcess(multiprocessing.Process):
+
+    """
+    Run a pipeline in a child process, with its own database engine and resource limits.
+
+    The outcome of the job is put on the results queue as (job_id, status, activity), for the
+    processor to record. max_mem limits the address space in bytes, max_cpu the CPU time
+    in seconds; the child is killed by the kernel when it exceeds either.
+    """
+
+    def __init__(self, db_uri, job_id, pipeline_class, pipeline_args, results, max_mem=None, max_cpu=None):
+        super(PipelineProcess, self).__init__()
+        self.db_uri = db_uri
+        self.job_id = job_id
+        self.pipeline_class = pipeline_class
+        self.pipeline_args = pipeline_args
+        self.results = results
+        self.max_mem = max_mem
+        self.max_cpu = max_cpu
+
+    def run(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if self.max_mem:
+            resource.setrlimit(resource.RLIMIT_AS, (self.max_mem, self.max_mem))
+        if self.max_cpu:
+            resource.setrlimit(resource.RLIMIT_CPU, (self.max_cpu, self.max_cpu + 60))
+        DBSession.remove()
+        init_model(sqlalchemy.create_engine(self.db_uri))
+        pipeline = self.pipeline_class(Job.get(self.job_id), *self.pipeline_args)
+        self.results.put((self.job_id,) + pipeline.execute())
+
+
 class Pipeline(threading.Thread):
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, job, nims_path, physio_path, tempdir, max_recon_jobs):
+    def __init__(self, job, nims_path, physio_path, tempdir, max_recon_jobs, lease_owner, lease_time, pfile_cache=None):
         super(Pipeline, self).__init__()
         self.job = job
         self.nims_path = nims_path
         self.physio_path = physio_path
         self.tempdir = tempdir
         self.max_recon_jobs = max_recon_jobs
+        self.heartbeat = LeaseHeartbeat(job.id, lease_owner, lease_time)
+        self.pfile_cache = pfile_cache
+        self.checkouts = []     # cache entries in use by this job
 
     def run(self):
+        status, activity = self.execute()
+        if not Job.finish(self.heartbeat.job_id, self.heartbeat.owner, status, activity):
+            log.warning(u'%d lost lease, not recording %s' % (self.heartbeat.job_id, status))
+
+    def execute(self):
+        """Run the job's task and return its final status and activity, without recording them."""
+        self.heartbeat.start()
         DBSession.add(self.job)
         self.job.activity = u'started %s' % self.job.data_container.primary_dataset.filetype
         log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+        if self.job.task == u'find&proc':
+            TraceEvent.record(u'started', self.job.data_container, self.job.trace)
         transaction.commit()
         DBSession.add(self.job)
         try:
+            status = u'done'
             if self.job.task == u'find&proc':
-                self.process()  # process now includes find.
+                self.process()  # physio is found by a separate find job, queued by process.
+            elif self.job.task == u'find':
+                status = self.find_physio()
         except Exception as ex:
-            self.job.status = u'failed'
-            self.job.activity = (u'failed: %s' % ex)[:255]
-            log.warning(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+            status, activity = u'failed', (u'failed: %s' % ex)[:255]
+            log.warning(u'%d %s %s' % (self.job.id, self.job, activity))
         else:
-            self.job.status = u'done'
-            self.job.activity = u'done'
-            log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+            DBSession.add(self.job)
+            activity = u'done' if status == u'done' else self.job.activity
+            log.info(u'%d %s %s' % (self.job.id, self.job, activity))
+            if status == u'done' and self.job.task == u'find&proc':
+                TraceEvent.record(u'processed', self.job.data_container, self.job.trace)
+        finally:
+            self.heartbeat.stop()
+            for entry in self.checkouts:
+                entry.release()
+        Job.notify()    # resources are about to be freed
         transaction.commit()
+        return status, activity
 
     def clean(self, data_container, kind):
         for ds in Dataset.query.filter_by(container=data_container).filter_by(kind=kind).all():
             shutil.rmtree(os.path.join(self.nims_path, ds.relpath))
             ds.delete()
 
+    def measure(self, stage):
+        """
+        Return a StageTimer that records the resources used by a stage of this job.
+
+        Stages are not started once the job's lease has been lost, as another processor may
+        already have reclaimed the job.
+        """
+        if self.heartbeat.lost.is_set():
+            raise Exception('lease lost before %s' % stage)
+        return StageMetric.measure(stage, self.job, self.job.data_container.psd)
+
+    def staging_dir(self):
+        """Return a TempDir on the store's filesystem, from which outputs are published by renaming."""
+        return nimsutil.TempDir(dir=nimsutil.make_joined_path(self.nims_path, '.staging'))
+
+    def stage_digest(self, stage):
+        """Return a digest of the inputs of a stage: the primary data, the description and upstream stages."""
+        dc = self.job.data_container
+        hash_ = hashlib.sha1(stage)
+        hash_.update(dc.primary_dataset.digest or '')
+        hash_.update((dc.description or u'').encode('utf-8'))
+        for dependency in STAGES[stage][0]:
+            hash_.update(self.stage_digest(dependency))
+        return hash_.digest()
+
+    def stale_stages(self):
+        """Return the set of stages whose outputs are missing or were computed from different inputs."""
+        dc = self.job.data_container
+        stale = set()
+        for stage, (dependencies, outputs) in STAGES.iteritems():
+            if outputs is None:
+                continue
+            kind, filetypes = outputs
+            digest = self.stage_digest(stage)
+            current = [ds for ds in Dataset.query.filter_by(container=dc).filter_by(kind=kind).all()
+                    if ds.filetype in filetypes and ds.digest == digest and os.path.isdir(os.path.join(self.nims_path, ds.relpath))]
+            if not current or stale.intersection(dependencies):
+                stale.add(stage)
+        if stale - set(['physio']) or dc.slice_order is None:
+            stale.add('parse')
+        return stale
+
     @abc.abstractmethod
     def find(self, slice_order, num_slices):
         """
@@ -172,7 +497,7 @@ class Pipeline(threading.Thread):
             # sometime after the Rxed duration, but rather sometime after the actual duration! We don't yet
             # know the actual duration, so we'll just make shit up and hope for the best.
             physio_lag = datetime.timedelta(seconds=30)
-            physio_files = nimsutil.find_ge_physio(self.physio_path, dc.timestamp+physio_lag, dc.psd.encode('utf-8'))
+            physio_files = nimsutil.physio_index(self.physio_path).find(dc.timestamp+physio_lag, dc.psd.encode('utf-8'))
             #physio_files = nimsutil.find_ge_physio(self.physio_path, dc.timestamp+dc.prescribed_duration, dc.psd.encode('utf-8'))
             if physio_files:
                 physio = nimsphysio.NIMSPhysio(physio_files, dc.tr, dc.num_timepoints, nimsdata.medimg.medimg.get_slice_order(slice_order, num_slices))
@@ -184,25 +509,26 @@ class Pipeline(threading.Thread):
                     DBSession.add(self.job.data_container)
                     dataset.kind = u'peripheral'
                     dataset.container = self.job.data_container
-                    with nimsutil.TempDir(dir=self.tempdir) as tempdir_path:
-                        arcdir_path = os.path.join(tempdir_path, '%s_physio' % self.job.data_container.name)
-                        os.mkdir(arcdir_path)
-                        for f in physio_files:
-                            shutil.copy2(f, arcdir_path)
+                    dataset.digest = self.stage_digest('physio')
+                    with self.staging_dir() as staging_path:
+                        arcname = '%s_physio' % self.job.data_container.name
                         filename = '%s_physio.tgz' % self.job.data_container.name
-                        dataset.filenames = [filename]
-                        with tarfile.open(os.path.join(self.nims_path, dataset.relpath, filename), 'w:gz', compresslevel=6) as archive:
-                            archive.add(arcdir_path, arcname=os.path.basename(arcdir_path))
+                        with nimsutil.compressed_tar(os.path.join(staging_path, filename), compresslevel=6) as archive:
+                            archive.addfile(archive.gettarinfo(os.path.dirname(physio_files[0]), arcname))  # top-level directory
+                            for f in physio_files:
+                                archive.add(f, arcname=os.path.join(arcname, os.path.basename(f)))
+                        filenames = [filename]
                         try:
                             reg_filename = '%s_physio_regressors.csv.gz' % self.job.data_container.name
-                            physio.write_regressors(os.path.join(self.nims_path, dataset.relpath, reg_filename))
+                            physio.write_regressors(os.path.join(staging_path, reg_filename))
                             self.job.activity = u'physio regressors %s written' % reg_filename
                             log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
                         except nimsphysio.NIMSPhysioError:
                             self.job.activity = u'error generating regressors from physio data'
                             log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
                         else:
-                            dataset.filenames += [reg_filename]
+                            filenames += [reg_filename]
+                        dataset.filenames = nimsutil.publish(staging_path, os.path.join(self.nims_path, dataset.relpath), filenames)
                 else:
                     self.job.activity = u'invalid physio found and discarded'
                     log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
@@ -215,16 +541,83 @@ class Pipeline(threading.Thread):
         transaction.commit()
         DBSession.add(self.job)
 
+    def queue_find(self, slice_order, num_slices):
+        """
+        Queue a separate find job to search for physio and generate regressors.
+
+        The find job is claimed by another slot and runs in parallel with the rest of this job.
+        slice_order and num_slices are stored on the epoch, for the find job to work from.
+        """
+        dc = self.job.data_container
+        dc.slice_order = slice_order
+        dc.num_slices = num_slices
+        find_job = Job.query.filter_by(data_container=dc).filter_by(task=u'find').first()
+        if not find_job:
+            find_job = Job(data_container=dc, task=u'find')
+        if find_job.status != u'running':
+            find_job.status = u'pending'
+            find_job.activity = u'pending'
+            find_job.priority = self.job.priority
+            find_job.notbefore = None
+            Job.notify()
+        self.job.activity = u'queued physio search'
+        log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
+        transaction.commit()
+        DBSession.add(self.job)
+
+    def find_physio(self):
+        """
+        Run the physio stage of a find job and return the job's new status.
+
+        If no physio files are found on the first attempt, the job goes back to pending, not to
+        be claimed for another PHYSIO_RETRY_DELAY, since physio files show up a little after the scan.
+        """
+        dc = self.job.data_container
+        with self.measure(u'physio'):
+            self.find(dc.slice_order, dc.num_slices)
+        if self.job.activity == u'no physio files found' and self.job.notbefore is None:
+            self.job.notbefore = datetime.datetime.now() + PHYSIO_RETRY_DELAY
+            self.job.activity = u'no physio files found; searching again in %d seconds' % PHYSIO_RETRY_DELAY.seconds
+            return u'pending'
+        return u'done'
+
     @abc.abstractmethod
     def process(self):
-        self.clean(self.job.data_container, u'derived')
-        self.clean(self.job.data_container, u'web')
-        self.clean(self.job.data_container, u'qa')
-        self.job.activity = u'reading data / preparing to run recon'
+        """
+        Clean up the outputs of stale stages, and queue the physio stage if nothing else is needed for it.
+
+        Subclasses parse the primary dataset only if 'parse' is in self.stale, and then recompute the
+        stale stages among nifti and pyramid, and queue physio if it is still in self.stale.
+        """
+        dc = self.job.data_container
+        self.stale = self.stale_stages()
+        if 'nifti' in self.stale:
+            self.clean(dc, u'derived')
+            self.clean(dc, u'qa')
+        if 'pyramid' in self.stale:
+            self.clean(dc, u'web')
+        if 'physio' in self.stale and dc.slice_order is not None:
+            self.queue_find(dc.slice_order, dc.num_slices)
+            self.stale.discard('physio')
+        if 'parse' in self.stale:
+            self.job.activity = u'reading data / preparing to run recon'
+        else:
+            self.job.activity = u'outputs up to date'
         log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
         transaction.commit()
         DBSession.add(self.job)
 
+    def queue_find_if_stale(self, slice_order, num_slices):
+        """Queue the physio stage after parsing, or drop stale physio if it cannot be computed."""
+        if 'physio' not in self.stale:
+            return
+        if slice_order and num_slices:
+            self.queue_find(slice_order, num_slices)
+        else:
+            self.clean(self.job.data_container, u'peripheral')
+            transaction.commit()
+            DBSession.add(self.job)
+
 
 class DicomPipeline(Pipeline):
 
@@ -247,32 +640,23 @@ class DicomPipeline(Pipeline):
 
         """
         super(DicomPipeline, self).process()
+        if 'parse' not in self.stale:
+            return
 
         ds = self.job.data_container.primary_dataset
-        with nimsutil.TempDir(dir=self.tempdir) as outputdir:
+        with self.staging_dir() as outputdir:
             outbase = os.path.join(outputdir, ds.container.name)
-            dcm_tgz = os.path.join(self.nims_path, ds.relpath, os.listdir(os.path.join(self.nims_path, ds.relpath))[0])
-            dcm_acq = nimsdata.parse(dcm_tgz, filetype='dicom', load_data=True, ignore_json=True)   # store exception for later...
+            dcm_tgz = glob.glob(os.path.join(self.nims_path, ds.relpath, '*_dicoms.tgz'))[0]
+            with self.measure(u'parse'):
+                dcm_acq = nimsdata.parse(dcm_tgz, filetype='dicom', load_data=True, ignore_json=True)   # store exception for later...
 
-            # if physio was not found, wait 30 seconds and search again.
-            # this should only run when the job activity is u'no physio files found'
-            # if physio not recorded, or physio invalid, don't try again
+            # the find job searches for physio in parallel, and once more 30 seconds later if none is found
             try:
-                self.find(dcm_acq.slice_order, dcm_acq.num_slices)
+                self.queue_find_if_stale(dcm_acq.slice_order, dcm_acq.num_slices)
             except Exception as e:
                 # this catches some of the non-image scans that do not have
                 # dcm_acq.slice_order and/or dcm_acq.num_slices
                 log.info(str(e))  # do we need this logging message?
-            if self.job.activity == u'no physio files found':
-                self.job.activity = u'no physio files found; searching again in 30 seconds'
-                log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
-                time.sleep(30)
-                try:
-                    self.find(dcm_acq.slice_order, dcm_acq.num_slices)
-                except Exception as e:
-                    # this catches some of the non-image scans that do not have
-                    # dcm_acq.slice_order and/or dcm_acq.num_slices
-                    log.info(str(e))  # do we need this logging message?
 
             if dcm_acq.failure_reason:   # implies dcm_acq.data = None
                 # if dcm_acq.failure_reason is set, job has failed
@@ -288,8 +672,11 @@ class DicomPipeline(Pipeline):
                 self.job.activity = (u'dicom %s is a non-image type' % dcm_tgz)
                 transaction.commit()
             else:
+                conv_files = None
                 if dcm_acq.is_screenshot:
-                    conv_files = nimsdata.write(dcm_acq, dcm_acq.data, outbase, filetype='png')
+                    if 'nifti' in self.stale:
+                        with self.measure(u'nifti'):
+                            conv_files = nimsdata.write(dcm_acq, dcm_acq.data, outbase, filetype='png')
                     if conv_files:
                         outputdir_list = os.listdir(outputdir)
                         self.job.activity = (u'generated %s' % (', '.join([f for f in outputdir_list])))[:255]
@@ -304,14 +691,13 @@ class DicomPipeline(Pipeline):
                         conv_ds.container.num_slices = dcm_acq.num_slices
                         conv_ds.container.num_timepoints = dcm_acq.num_timepoints
                         conv_ds.container.duration = dcm_acq.duration
-                        filenames = []
-                        for f in outputdir_list:
-                            filenames.append(f)
-                            shutil.copy2(os.path.join(outputdir, f), os.path.join(self.nims_path, conv_ds.relpath))
-                        conv_ds.filenames = filenames
+                        conv_ds.digest = self.stage_digest('nifti')
+                        conv_ds.filenames = nimsutil.publish(outputdir, os.path.join(self.nims_path, conv_ds.relpath), outputdir_list)
                         transaction.commit()
                 else:
-                    conv_files = nimsdata.write(dcm_acq, dcm_acq.data, outbase, filetype='nifti')
+                    if 'nifti' in self.stale:
+                        with self.measure(u'nifti'):
+                            conv_files = nimsdata.write(dcm_acq, dcm_acq.data, outbase, filetype='nifti')
                     if conv_files:
                         # if nifti was successfully created
                         outputdir_list = os.listdir(outputdir)
@@ -322,23 +708,23 @@ class DicomPipeline(Pipeline):
                         DBSession.add(self.job.data_container)
                         conv_ds.kind = u'derived'
                         conv_ds.container = self.job.data_container
-                        filenames = []
-                        for f in outputdir_list:
-                            filenames.append(f)
-                            shutil.copy2(os.path.join(outputdir, f), os.path.join(self.nims_path, conv_ds.relpath))
-                        conv_ds.filenames = filenames
+                        conv_ds.digest = self.stage_digest('nifti')
+                        conv_ds.filenames = nimsutil.publish(outputdir, os.path.join(self.nims_path, conv_ds.relpath), outputdir_list)
                         transaction.commit()
+                    if 'pyramid' in self.stale and (conv_files or 'nifti' not in self.stale):
                         pyramid_ds = Dataset.at_path(self.nims_path, u'img_pyr')
                         DBSession.add(self.job)
                         DBSession.add(self.job.data_container)
                         outpath = os.path.join(self.nims_path, pyramid_ds.relpath, self.job.data_container.name)
                         voxel_order = None if dcm_acq.is_localizer else 'LPS'
-                        nims_montage = nimsdata.write(dcm_acq, dcm_acq.data, outpath, filetype='montage', voxel_order=voxel_order)
+                        with self.measure(u'pyramid'):
+                            nims_montage = nimsdata.write(dcm_acq, dcm_acq.data, outpath, filetype='montage', voxel_order=voxel_order)
                         self.job.activity = (u'generated %s' % (', '.join([os.path.basename(f) for f in nims_montage])))[:255]
                         log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
                         pyramid_ds.kind = u'web'
                         pyramid_ds.container = self.job.data_container
-                        pyramid_ds.filenames = os.listdir(os.path.join(self.nims_path, pyramid_ds.relpath))
+                        pyramid_ds.digest = self.stage_digest('pyramid')
+                        pyramid_ds.filenames = [f for f in os.listdir(os.path.join(self.nims_path, pyramid_ds.relpath)) if not f.startswith('.')]
                         transaction.commit()
 
             DBSession.add(self.job)
@@ -351,6 +737,26 @@ class PFilePipeline(Pipeline):
     def find(self, slice_order, num_slices):
         return super(PFilePipeline, self).find(slice_order, num_slices)
 
+    def extract(self, pfile_tgz, dataset, dest_path):
+        """
+        Extract a pfile tgz and return the directory it contains.
+
+        With a scratch cache, the archive is extracted into the cache entry for the dataset digest,
+        unless it already has been, and dest_path is not used. The entry is held until the job ends,
+        possibly by other jobs at the same time, and is read-only; outputs go to the job's tempdir.
+        """
+        from subprocess import call
+        def extract(path):
+            if call(['tar', '--use-compress-program=pigz', '-xf', pfile_tgz, '-C', path]):
+                raise Exception('could not extract %s' % os.path.basename(pfile_tgz))
+        if self.pfile_cache and dataset.digest:
+            entry = self.pfile_cache.checkout(dataset.digest.encode('hex'), extract, 2 * os.path.getsize(pfile_tgz))
+            self.checkouts.append(entry)
+            dest_path = entry.path
+        else:
+            extract(dest_path)
+        return os.path.join(dest_path, os.listdir(dest_path)[0])
+
     def process(self):
         """"
         Convert a pfile.
@@ -369,22 +775,21 @@ class PFilePipeline(Pipeline):
 
         """
         super(PFilePipeline, self).process()
+        if 'parse' not in self.stale:
+            return
 
         ds = self.job.data_container.primary_dataset
         log.info('Processing ' + ds.container.description)
 
-        with nimsutil.TempDir(dir=self.tempdir) as outputdir:
+        with nimsutil.TempDir(dir=self.tempdir) as outputdir, self.staging_dir() as stagingdir:
             log.debug('parsing')
-            outbase = os.path.join(outputdir, ds.container.name)
+            outbase = os.path.join(stagingdir, ds.container.name)
             pfile_tgz = glob.glob(os.path.join(self.nims_path, ds.relpath, '*_pfile.tgz'))
             pfile_7gz = glob.glob(os.path.join(self.nims_path, ds.relpath, 'P?????.7*'))
             if pfile_tgz:
                 log.debug('input format: tgz')
-                from subprocess import call
-                call(['tar', '--use-compress-program=pigz', '-xf', pfile_tgz[0], '-C', outputdir])
-                #with tarfile.open(pfile_tgz[0]) as archive:
-                #    archive.extractall(path=outputdir)
-                temp_datadir = os.path.join(outputdir, os.listdir(outputdir)[0])
+                with self.measure(u'extract'):
+                    temp_datadir = self.extract(pfile_tgz[0], ds, outputdir)
                 input_pfile = os.path.join(temp_datadir, glob.glob(os.path.join(temp_datadir, 'P?????.7'))[0])
             elif pfile_7gz:
                 log.debug('input format: directory')
@@ -401,10 +806,18 @@ class PFilePipeline(Pipeline):
             else:
                 recon_type = None
             log.info('Selecting recon_type %s...' % recon_type)
-            pf = nimsdata.parse(input_pfile, filetype='pfile', ignore_json=True, load_data=False, full_parse=True, tempdir=outputdir, num_jobs=self.max_recon_jobs, recon_type=recon_type)
+            with self.measure(u'parse'):
+                pf = nimsdata.parse(input_pfile, filetype='pfile', ignore_json=True, load_data=False, full_parse=True, tempdir=outputdir, num_jobs=self.max_recon_jobs, recon_type=recon_type)
+            # the sorter routed the pfile on its header alone; save what only the full parse determines
+            ds.container.update_from_mrfile(pf)
+            if (ds.container.psd or u'').startswith(u'mux'):
+                MuxCalibration.from_mrfile(pf, ds, os.path.basename(pfile_tgz[0] if pfile_tgz else input_pfile))
+            transaction.commit()
+            DBSession.add(self.job)
+            ds = self.job.data_container.primary_dataset
 
             try:
-                self.find(pf.slice_order, pf.num_slices)
+                self.queue_find_if_stale(pf.slice_order, pf.num_slices)
             except Exception as exc:  # XXX, specific exceptions
                 pass
 
@@ -413,49 +826,34 @@ class PFilePipeline(Pipeline):
             # help locate an aux_file that contains necessary calibration scans.
             aux_file = None
             if pf.psd_type=='muxepi' and pf.num_bands>1:
-                q = Epoch.query.filter(Epoch.session==self.job.data_container.session).filter(Epoch.trashtime==None).filter(Epoch.psd.startswith(u'mux')).filter(Epoch.size_x==pf.size[0]).filter(Epoch.size_y==pf.size[1])
+                candidates = MuxCalibration.candidates(self.job.data_container, pf.size[0], pf.size[1])
 
                 log.info('looking for single-band mux calibration scans...')
-                epochs = [e for e in q.all() if e!=self.job.data_container and e.num_bands==1 ]
-                if len(epochs)==0:
+                calibrations = [c for c in candidates if c.num_bands==1]
+                if len(calibrations)==0:
                     if pf.num_mux_cal_cycle<2:
-                        epochs = [e for e in q.all() if e!=self.job.data_container and e.num_mux_cal_cycle>=2]
-                        log.info('No single-band scan found; %d mux candidates found...' % len(epochs))
+                        calibrations = [c for c in candidates if c.num_mux_cal_cycle>=2]
+                        log.info('No single-band scan found; %d mux candidates found...' % len(calibrations))
                     else:
                         log.info('No single-band cal scan found-- using internal calibration.')
                 else:
-                    log.info('Single-band calibration candidates: %s' % str([e.primary_dataset.filenames for e in epochs]))
-
-                # REALLY BAD MUX HACK!
-                # prefer pe0 scans. Ideally, we'd check the pfile headers and find matching pepolar scans.
-                # But that would take forever, so we'll assume target scans are always pe0 and further assume that
-                # the pepolar is correctly indicated in the description.
-                epochs_pe_match = [e for e in epochs if (not 'pe1' in e.description and pf.phase_encode_direction==0) or ('pe1' in e.description and pf.phase_encode_direction==1)]
-                if len(epochs_pe_match)>0:
-                    epochs = epochs_pe_match
-                    log.debug('Selecting only epochs with "pe0" in the description')
-                else:
-                    epochs = []
-                    #epochs_pe0 = [e for e in epochs if not 'pe1' in e.description]
-                    #if len(epochs_pe0)>0:
-                    #    epochs = epochs_pe0
-                    #    log.debug('Selecting only epochs without "pe1" in the description')
-
-                if len(epochs)>0:
-                    # which epoch has the closest series number
-                    series_num_diff = np.array([e.series for e in epochs]) - pf.series_no
+                    log.info('Single-band calibration candidates: %s' % str([os.path.basename(c.archive_path) for c in calibrations]))
+
+                # only use calibration scans acquired with the same phase encode direction
+                calibrations = [c for c in calibrations if c.phase_encode_direction==pf.phase_encode_direction]
+
+                if len(calibrations)>0:
+                    # which calibration scan has the closest series number
+                    series_num_diff = np.array([c.series for c in calibrations]) - pf.series_no
                     closest = np.min(np.abs(series_num_diff))==np.abs(series_num_diff)
                     # there may be more than one. We prefer the prior scan.
                     closest = np.where(np.min(series_num_diff[closest])==series_num_diff)[0][0]
-                    candidate = epochs[closest]
+                    candidate = calibrations[closest]
                     # auxfile could be either P7.gz with adjacent files or a pfile tgz
-                    aux_tgz = glob.glob(os.path.join(self.nims_path, candidate.primary_dataset.relpath, '*_pfile.tgz'))
-                    aux_7gz = glob.glob(os.path.join(self.nims_path, candidate.primary_dataset.relpath, 'P?????.7*'))
-                    if aux_tgz:
-                        aux_file = aux_tgz[0]
-                    elif aux_7gz:
-                        aux_file = aux_7gz[0]
-                    # aux_file = os.path.join(self.nims_path, candidate.primary_dataset.relpath, candidate.primary_dataset.filenames[0])
+                    aux_file = os.path.join(self.nims_path, candidate.archive_path)
+                    if aux_file.endswith('_pfile.tgz') and self.pfile_cache and candidate.dataset.digest:
+                        aux_datadir = self.extract(aux_file, candidate.dataset, None)
+                        aux_file = glob.glob(os.path.join(aux_datadir, 'P?????.7'))[0]
                     log.info('identified aux_file: %s' % os.path.basename(aux_file))
 
                     self.job.activity = (u'Found aux file: %s' % os.path.basename(aux_file))[:255]
@@ -471,7 +869,8 @@ class PFilePipeline(Pipeline):
             # db_desc passes the database description to the pfile.load_data fxn, allowing pfile.load_data() to
             # make additional decisions based on the description stored in the database.
             # This allows user-edits to the description to affect jobs.
-            pf.load_data(aux_file=aux_file, db_desc=self.job.data_container.description)
+            with self.measure(u'recon'):
+                pf.load_data(aux_file=aux_file, db_desc=self.job.data_container.description)
             if pf.failure_reason:   # implies pf.data = None
                 self.job.activity = (u'error loading pfile: %s' % str(pf.failure_reason))
                 transaction.commit()
@@ -486,9 +885,12 @@ class PFilePipeline(Pipeline):
                 self.job.activity = (u'pfile %s is a non-image type' % input_pfile)
                 transaction.commit()
             else:
-                conv_file = nimsdata.write(pf, pf.data, outbase, filetype='nifti')
+                conv_file = None
+                if 'nifti' in self.stale:
+                    with self.measure(u'nifti'):
+                        conv_file = nimsdata.write(pf, pf.data, outbase, filetype='nifti')
                 if conv_file:
-                    outputdir_list = [f for f in os.listdir(outputdir) if not os.path.isdir(os.path.join(outputdir, f))]
+                    outputdir_list = [f for f in os.listdir(stagingdir) if not os.path.isdir(os.path.join(stagingdir, f))]
                     self.job.activity = (u'generated %s' % (', '.join([f for f in outputdir_list])))[:255]
                     log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
                     dataset = Dataset.at_path(self.nims_path, u'nifti')
@@ -501,23 +903,23 @@ class PFilePipeline(Pipeline):
                     dataset.container.num_slices = pf.num_slices
                     dataset.container.num_timepoints = pf.num_timepoints
                     dataset.container.duration = datetime.timedelta(seconds=pf.duration)
-                    filenames = []
-                    for f in outputdir_list:
-                        filenames.append(f)
-                        shutil.copy2(os.path.join(outputdir, f), os.path.join(self.nims_path, dataset.relpath))
-                    dataset.filenames = filenames
+                    dataset.digest = self.stage_digest('nifti')
+                    dataset.filenames = nimsutil.publish(stagingdir, os.path.join(self.nims_path, dataset.relpath), outputdir_list)
                     transaction.commit()
 
+                if 'pyramid' in self.stale and (conv_file or 'nifti' not in self.stale):
                     pyramid_ds = Dataset.at_path(self.nims_path, u'img_pyr')
                     DBSession.add(self.job)
                     DBSession.add(self.job.data_container)
                     outpath = os.path.join(self.nims_path, pyramid_ds.relpath, self.job.data_container.name)
-                    nims_montage = nimsdata.write(pf, pf.data, outpath, filetype='montage')
+                    with self.measure(u'pyramid'):
+                        nims_montage = nimsdata.write(pf, pf.data, outpath, filetype='montage')
                     self.job.activity = u'generated image pyramid %s' % nims_montage
                     log.info(u'%d %s %s' % (self.job.id, self.job, self.job.activity))
                     pyramid_ds.kind = u'web'
                     pyramid_ds.container = self.job.data_container
-                    pyramid_ds.filenames = os.listdir(os.path.join(self.nims_path, pyramid_ds.relpath))
+                    pyramid_ds.digest = self.stage_digest('pyramid')
+                    pyramid_ds.filenames = [f for f in os.listdir(os.path.join(self.nims_path, pyramid_ds.relpath)) if not f.startswith('.')]
                     transaction.commit()
 
             DBSession.add(self.job)
@@ -534,15 +936,25 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('physio_path', metavar='PHYSIO_PATH', nargs='?', help='path to physio data')
         self.add_argument('-T', '--task', help='find|proc  (default is all)')
         self.add_argument('-e', '--filter', default=[], action='append', help='sqlalchemy filter expression')
-        self.add_argument('-j', '--jobs', type=int, default=1, help='maximum number of concurrent threads')
+        self.add_argument('-j', '--jobs', type=int, default=1, help='maximum number of concurrent jobs')
         self.add_argument('-k', '--reconjobs', type=int, default=8, help='maximum number of concurrent recon jobs')
         self.add_argument('-r', '--reset', action='store_true', help='reset currently active (crashed) jobs')
-        self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep between db queries')
+        self.add_argument('-s', '--sleeptime', type=int, default=10, help='maximum time to sleep between db queries')
         self.add_argument('-t', '--tempdir', help='directory to use for temporary files')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
-        self.add_argument('-n', '--newest', action='store_true', default=False, help='do newest jobs first')
+        self.add_argument('-n', '--newest', action='store_true', default=False, help='do newest jobs first within each priority')
+        self.add_argument('-b', '--backend', choices=['thread', 'process'], default='thread', help='run jobs in threads or child processes (default: thread)')
+        self.add_argument('-m', '--maxmem', type=int, help='per-job memory limit in MB (process backend only)')
+        self.add_argument('-c', '--maxcpu', type=int, help='per-job CPU time limit in seconds (process backend only)')
+        self.add_argument('-C', '--cpus', type=int, help='cpus available to jobs (default: all)')
+        self.add_argument('-M', '--memory', type=float, help='memory available to jobs in GB (default: all)')
+        self.add_argument('-R', '--reserve', type=int, default=1, help='cpus reserved for short (dicom, screenshot) jobs (default: 1)')
+        self.add_argument('-L', '--lease', type=int, default=300, help='seconds before an unrenewed job lease expires (default: 300)')
+        self.add_argument('-x', '--cachedir', help='scratch directory for caching extracted pfiles (default: no cache)')
+        self.add_argument('-X', '--cachesize', type=float, default=100, help='size of the pfile cache in GB (default: 100)')
+        self.add_argument('-P', '--metricsport', type=int, help='serve metrics on this port of localhost')
 
 
 if __name__ == '__main__':
@@ -551,7 +963,10 @@ if __name__ == '__main__':
 
     args = ArgumentParser().parse_args()
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
-    processor = Processor(args.db_uri, args.nims_path, args.physio_path, args.task, args.filter, args.jobs, args.reconjobs, args.reset, args.sleeptime, args.tempdir, args.newest)
+    if args.metricsport:
+        nimsutil.metrics_registry.serve(args.metricsport)
+    processor = Processor(args.db_uri, args.nims_path, args.physio_path, args.task, args.filter, args.jobs, args.reconjobs, args.reset, args.sleeptime, args.tempdir, args.newest, args.lease,
+            args.backend, args.maxmem and args.maxmem * 1024**2, args.maxcpu, args.cpus, args.memory, args.reserve, args.cachedir, args.cachesize * 1024**3)
 
     def term_handler(signum, stack):
         processor.halt()
@@ -19,11 +19,17 @@ import shutil
 
 import transaction
 import sqlalchemy
+import nimsutil
 from nimsgears.model import *
 import multiprocessing
 
 qa_version = 1.0
 
+metrics = nimsutil.metrics_registry
+qa_seconds = metrics.histogram('nims_qa_seconds', 'Time to compute one QA report (single-job mode only)')
+metrics.gauge('nims_qa_running', 'QA reports being computed in worker processes',
+        lambda: {(): len(multiprocessing.active_children())})
+
 def add_subplot_axes(fig, ax, rect, axisbg='w'):
     box = ax.get_position()
     width = box.width
@@ -228,7 +234,8 @@ def generate_qa_report(epoch_id, nimspath, force=False, spike_thresh=6., nskip=4
         else:
             qa_file_name = epoch.name + u'_qa'
             print("%s epoch id %d (%s) QA: computing report..." % (time.asctime(), epoch_id, str(epoch)))
-            transrot,abs_disp,rel_disp,tsnr,global_ts,t_z,spike_inds = compute_qa(ni, tr, spike_thresh, nskip)
+            with StageMetric.measure(u'qa', psd=epoch.psd), qa_seconds.time():
+                transrot,abs_disp,rel_disp,tsnr,global_ts,t_z,spike_inds = compute_qa(ni, tr, spike_thresh, nskip)
             median_tsnr = np.ma.median(tsnr)[0]
             qa_ds = Dataset.at_path(nimspath, u'json')
             qa_ds.filenames = [qa_file_name + u'.json', qa_file_name + u'.png']
@@ -257,6 +264,7 @@ def generate_qa_report(epoch_id, nimspath, force=False, spike_thresh=6., nskip=4
         # the state may have changed while we were processing...
         if epoch.qa_status!=u'rerun':
             epoch.qa_status = u'done'
+            TraceEvent.record(u'qa', epoch, epoch.primary_dataset.trace)
     print("%s epoch id %d (%s) QA: Finished in %0.2f minutes." % (time.asctime(), epoch_id, str(epoch), (time.time()-start_secs)/60.))
     transaction.commit()
     return
@@ -322,10 +330,13 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('-t', '--spike_thresh', type=float, default=6., metavar='[6.0]', help='z-score threshold for spike detector.')
         self.add_argument('-n', '--nskip', type=int, default=6, metavar='[6]', help='number of initial timepoints to skip.')
         self.add_argument('-j', '--jobs', type=int, default=4, metavar='[4]', help='Number of jobs to run in parallel.')
+        self.add_argument('-P', '--metricsport', type=int, help='serve metrics on this port of localhost')
 
 if __name__ == '__main__':
     args = ArgumentParser().parse_args()
     init_model(sqlalchemy.create_engine(args.db_uri))
+    if args.metricsport:
+        nimsutil.metrics_registry.serve(args.metricsport)
     scan_type = u'functional'
     if args.epoch_id:
         epochs = [args.epoch_id]
@@ -5,6 +5,7 @@
 import os
 import time
 import shlex
+import collections
 import shutil
 import signal
 import logging
@@ -17,10 +18,11 @@ log = logging.getLogger('restager')
 
 
 class Restager(object):
-    def __init__(self, source_stage, data_host, reap_stage, sort_stage, sleep_time):
+    def __init__(self, source_stage, data_host, reap_stage, sort_stage, sleep_time, poll=None):
         super(Restager, self).__init__()
         self.source_stage = source_stage
         self.sleep_time = sleep_time
+        self.poll = poll
         self.alive = True
 
         self.scp_cmd = 'rsync -a %%s %s:%s' % (data_host, reap_stage)
@@ -37,25 +39,32 @@ class Restager(object):
             self.alive = False
             log.error('Cannot set up remote staging area')
 
+        watcher = nimsutil.StageWatcher(self.source_stage, self.sleep_time, self.poll)
+        stage_contents = collections.deque()   # oldest first
         while self.alive:
-            stage_contents = [os.path.join(self.source_stage, sc) for sc in os.listdir(self.source_stage)]
+            stage_contents.extend(watcher.items(0 if stage_contents else None))
             if stage_contents:
-                item_path = min(stage_contents, key=os.path.getmtime)
+                item_path = stage_contents[0]
                 try:
                     log.info('Restaging %s' % os.path.basename(item_path))
                     subprocess.check_call(shlex.split(self.scp_cmd % item_path))
                     subprocess.check_call(shlex.split(self.move_cmd % os.path.basename(item_path)))
                 except subprocess.CalledProcessError:
                     log.info('Failed to restage %s' % os.path.basename(item_path))
+                    if not os.path.exists(item_path):
+                        stage_contents.popleft()
+                    else:
+                        time.sleep(self.sleep_time)
                 else:
                     if os.path.isdir(item_path):
                         shutil.rmtree(item_path)
                     else:
                         os.remove(item_path)
+                    stage_contents.popleft()
                     log.info('Restaged  %s' % os.path.basename(item_path))
             else:
                 log.debug('Waiting for work...')
-                time.sleep(self.sleep_time)
+        watcher.close()
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -65,6 +74,7 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('data_host', help='username@hostname of data destination')
         self.add_argument('remote_stage', help='path to destination staging area')
         self.add_argument('-s', '--sleeptime', type=int, default=30, help='time to sleep before checking for new data')
+        self.add_argument('-o', '--poll', action='store_true', default=None, help='poll the stage rather than watch it (default: poll network filesystems only)')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
@@ -78,7 +88,7 @@ if __name__ == "__main__":
     reap_stage = nimsutil.make_joined_path(args.remote_stage, 'reap')
     sort_stage = nimsutil.make_joined_path(args.remote_stage, 'sort')
 
-    restager = Restager(source_stage, args.data_host, reap_stage, sort_stage, args.sleeptime)
+    restager = Restager(source_stage, args.data_host, reap_stage, sort_stage, args.sleeptime, args.poll)
 
     def term_handler(signum, stack):
         restager.halt()
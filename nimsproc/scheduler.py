@@ -7,7 +7,6 @@ import time
 import shutil
 import signal
 import logging
-import tarfile
 import argparse
 import datetime
 
@@ -20,14 +19,23 @@ from nimsgears.model import *
 
 log = logging.getLogger('scheduler')
 
+metrics = nimsutil.metrics_registry
+jobs_by_status = metrics.gauge('nims_jobs', 'Jobs in the queue, by status')
+dirty_containers = metrics.gauge('nims_dirty_containers', 'Data containers waiting to be scheduled')
+compress_seconds = metrics.histogram('nims_compress_seconds', 'Time spent compressing files')
+compress_input = metrics.counter('nims_compress_input_bytes_total', 'Bytes of data compressed')
+compress_output = metrics.counter('nims_compress_output_bytes_total', 'Bytes of compressed data written')
+
 
 class Scheduler(object):
 
-    def __init__(self, db_uri, nims_path, sleeptime, cooltime):
+    def __init__(self, db_uri, nims_path, sleeptime, cooltime, agetime, freshtime):
         super(Scheduler, self).__init__()
         self.nims_path = nims_path
         self.sleeptime = sleeptime
         self.cooltime = datetime.timedelta(seconds=cooltime)
+        self.agetime = datetime.timedelta(minutes=agetime)
+        self.freshtime = datetime.timedelta(hours=freshtime)
 
         self.alive = True
         init_model(sqlalchemy.create_engine(db_uri))
@@ -38,67 +46,104 @@ class Scheduler(object):
 
     def run(self):
         while self.alive:
-            # relaunch jobs that need rerun
-            for job in Job.query.filter((Job.status != u'running') & (Job.status != u'abandoned') & (Job.needs_rerun == True)).all():
-                job.status = u'pending'
-                job.activity = u'reset to pending'
-                log.info(u'Reset       %s to pending' % job)
-                job.needs_rerun = False
-            transaction.commit()
-
-            # deal with dirty data containers
-            dc = (DataContainer.query
-                    .filter(DataContainer.dirty == True)
-                    .filter(~DataContainer.datasets.any(Dataset.updatetime > (datetime.datetime.now() - self.cooltime)))
-                    .order_by(DataContainer.timestamp).first())
+            self.requeue()
+            dc = self.next_dirty()
             if dc:
-                dc.dirty = False
-                dc.scheduling = True
-                transaction.commit()
-                DBSession.add(dc)
-
-                # compress data if needed
-                for ds in [ds for ds in dc.original_datasets if not ds.compressed]:
-                    log.info(u'Compressing %s %s' % (dc, ds.filetype))
-                    dataset_path = os.path.join(self.nims_path, ds.relpath)
-                    if ds.filetype == nimsdata.nimsdicom.NIMSDicom.filetype:
-                        arcdir = '%s_%s_%s_dicoms' % (dc.session.exam, dc.series, dc.acq)
-                        arcdir_path = os.path.join(dataset_path, arcdir)
-                        os.mkdir(arcdir_path)
-                        for filename in [f for f in os.listdir(dataset_path) if not f.startswith(arcdir)]:
-                            os.rename(os.path.join(dataset_path, filename), os.path.join(arcdir_path, filename))
-                        with tarfile.open('%s.tgz' % arcdir_path, 'w:gz', compresslevel=6) as archive:
-                            archive.add(arcdir_path, arcname=os.path.basename(arcdir_path))
-                        shutil.rmtree(arcdir_path)
-                        ds.filenames = os.listdir(dataset_path)
-                        ds.compressed = True
-                        transaction.commit()
-                    elif ds.filetype == nimsdata.nimsraw.NIMSPFile.filetype:
-                        for pfilepath in [os.path.join(dataset_path, f) for f in os.listdir(dataset_path) if not f.startswith('_')]:
-                            nimsutil.gzip_inplace(pfilepath, 0o644)
-                        ds.filenames = os.listdir(dataset_path)
-                        ds.compressed = True
-                        transaction.commit()
-                    DBSession.add(dc)
-
-                # schedule job
-                log.info(u'Inspecting  %s' % dc)
-                new_digest = nimsutil.redigest(os.path.join(self.nims_path, dc.primary_dataset.relpath))
-                if dc.primary_dataset.digest != new_digest:
-                    dc.primary_dataset.digest = new_digest
-                    job = Job.query.filter_by(data_container=dc).filter_by(task=u'find&proc').first()
-                    if not job:
-                        job = Job(data_container=dc, task=u'find&proc', status=u'pending', activity=u'pending')
-                        log.info(u'Created job %s' % job)
-                    elif job.status != u'pending' and not job.needs_rerun:
-                        job.needs_rerun = True
-                        log.info(u'Marked job  %s for restart' % job)
-                dc.scheduling = False
-                log.info(u'Done        %s' % dc)
-                transaction.commit()
+                self.schedule(dc)
             else:
                 time.sleep(self.sleeptime)
 
+    def requeue(self):
+        """Relaunch jobs that need a rerun, age the queue and update the queue metrics."""
+        rerun_jobs = Job.query.filter((Job.status != u'running') & (Job.status != u'abandoned') & (Job.needs_rerun == True)).all()
+        for job in rerun_jobs:
+            job.status = u'pending'
+            job.activity = u'reset to pending'
+            job.queue(self.priority(job.data_container))
+            log.info(u'Reset       %s to pending' % job)
+            job.needs_rerun = False
+        if rerun_jobs:
+            Job.notify()
+        Job.age(self.agetime)
+        for status, count in DBSession.query(Job.status, sqlalchemy.func.count(Job.id)).group_by(Job.status):
+            jobs_by_status.set(count, status=status)
+        dirty_containers.set(DataContainer.query.filter_by(dirty=True).count())
+        transaction.commit()
+
+    def next_dirty(self):
+        """Return the oldest dirty data container whose datasets have cooled, if any."""
+        return (DataContainer.query
+                .filter(DataContainer.dirty == True)
+                .filter(~DataContainer.datasets.any(Dataset.updatetime > (datetime.datetime.now() - self.cooltime)))
+                .order_by(DataContainer.timestamp).first())
+
+    def schedule(self, dc):
+        """Compress the original datasets of a dirty data container and queue a job if its primary data changed."""
+        dc.dirty = False
+        dc.scheduling = True
+        trace = dc.primary_dataset.trace
+        TraceEvent.record(u'cooled', dc, trace)
+        transaction.commit()
+        DBSession.add(dc)
+
+        # compress data if needed
+        for ds in [ds for ds in dc.original_datasets if not ds.compressed]:
+            log.info(u'Compressing %s %s' % (dc, ds.filetype))
+            with StageMetric.measure(u'compress', psd=getattr(dc, 'psd', None)):
+                dataset_path = os.path.join(self.nims_path, ds.relpath)
+                if ds.filetype == nimsdata.nimsdicom.NIMSDicom.filetype:
+                    arcdir = '%s_%s_%s_dicoms' % (dc.session.exam, dc.series, dc.acq)
+                    arcdir_path = os.path.join(dataset_path, arcdir)
+                    os.mkdir(arcdir_path)
+                    for filename in [f for f in os.listdir(dataset_path) if not f.startswith(arcdir) and not f.startswith('.')]:
+                        os.rename(os.path.join(dataset_path, filename), os.path.join(arcdir_path, filename))
+                    with compress_seconds.time(method='gzip'), nimsutil.compressed_tar('%s.tgz' % arcdir_path, compresslevel=6) as archive:
+                        archive.add(arcdir_path, arcname=os.path.basename(arcdir_path))
+                    compress_input.inc(nimsutil.du(arcdir_path), method='gzip')
+                    compress_output.inc(os.path.getsize('%s.tgz' % arcdir_path), method='gzip')
+                    shutil.rmtree(arcdir_path)
+                    ds.filenames = [f for f in os.listdir(dataset_path) if not f.startswith('.')]
+                    ds.compressed = True
+                    transaction.commit()
+                elif ds.filetype == nimsdata.nimsraw.NIMSPFile.filetype:
+                    for pfilepath in [os.path.join(dataset_path, f) for f in os.listdir(dataset_path) if not f.startswith(('_', '.'))]:
+                        nimsutil.gzip_inplace(pfilepath, 0o644)
+                    ds.filenames = [f for f in os.listdir(dataset_path) if not f.startswith('.')]
+                    ds.compressed = True
+                    transaction.commit()
+            DBSession.add(dc)
+            TraceEvent.record(u'compressed', dc, trace)
+
+        # schedule job
+        log.info(u'Inspecting  %s' % dc)
+        with StageMetric.measure(u'digest', psd=getattr(dc, 'psd', None)):
+            dataset_path = os.path.join(self.nims_path, dc.primary_dataset.relpath)
+            uncached = not os.path.exists(os.path.join(dataset_path, nimsutil.DIGEST_CACHE))
+            new_digest = nimsutil.redigest(dataset_path, cache=True)
+            if uncached and dc.primary_dataset.digest not in (None, new_digest) and dc.primary_dataset.digest == nimsutil.stream_digest(dataset_path):
+                dc.primary_dataset.digest = new_digest  # digested before digests were cached; the data is unchanged
+        if dc.primary_dataset.digest != new_digest:
+            dc.primary_dataset.digest = new_digest
+            job = Job.query.filter_by(data_container=dc).filter_by(task=u'find&proc').first()
+            if not job:
+                job = Job(data_container=dc, task=u'find&proc', status=u'pending', activity=u'pending', priority=self.priority(dc))
+                Job.notify()
+                log.info(u'Created job %s' % job)
+            elif job.status != u'pending' and not job.needs_rerun:
+                job.needs_rerun = True
+                log.info(u'Marked job  %s for restart' % job)
+            job.trace = trace
+            TraceEvent.record(u'queued', dc, trace)
+        dc.scheduling = False
+        log.info(u'Done        %s' % dc)
+        transaction.commit()
+
+    def priority(self, dc):
+        """Queue jobs for recent acquisitions ahead of backfill and reruns of older data."""
+        if dc.timestamp and dc.timestamp > datetime.datetime.now() - self.freshtime:
+            return Job.default_priority
+        return Job.backfill_priority
+
     def reset_all(self):
         """Reset all scheduling data containers to dirty."""
         for dc in DataContainer.query.filter_by(scheduling=True).all():
@@ -116,15 +161,20 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('nims_path', help='data location')
         self.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep between db queries')
         self.add_argument('-c', '--cooltime', type=int, default=30, help='time to let data cool before processing')
+        self.add_argument('-a', '--agetime', type=int, default=10, help='minutes a job must wait for each priority increase (default: 10)')
+        self.add_argument('-r', '--freshtime', type=int, default=24, help='hours after acquisition that jobs get normal priority (default: 24)')
         self.add_argument('-f', '--logfile', help='path to log file')
         self.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
         self.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
+        self.add_argument('-P', '--metricsport', type=int, help='serve metrics on this port of localhost')
 
 
 if __name__ == '__main__':
     args = ArgumentParser().parse_args()
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
-    scheduler = Scheduler(args.db_uri, args.nims_path, args.sleeptime, args.cooltime)
+    if args.metricsport:
+        nimsutil.metrics_registry.serve(args.metricsport)
+    scheduler = Scheduler(args.db_uri, args.nims_path, args.sleeptime, args.cooltime, args.agetime, args.freshtime)
 
     def term_handler(signum, stack):
         scheduler.halt()
@@ -2,24 +2,40 @@
 #
 # @author:  Gunnar Schaefer, Reno Bowen
 
+import io
 import os
 import glob
 import time
+import fnmatch
+import Queue
 import shutil
 import logging
 import tarfile
 import datetime
+import threading
+import collections
 import transaction
 
+import nimsutil
 import nimsdata
 import nimsgears.model
 import tempdir as tempfile
 
 log = logging.getLogger('sorter')
 
+metrics = nimsutil.metrics_registry
+sorted_files = metrics.counter('nims_sorted_total', 'Files sorted into the data store, by filetype')
+preserved_files = metrics.counter('nims_preserved_total', 'Unsortable files set aside')
+sort_seconds = metrics.histogram('nims_sort_seconds', 'Time to sort one file, by filetype')
+sort_batch_seconds = metrics.histogram('nims_sort_batch_seconds', 'Time to sort the DICOMs of one stage item as a batch')
+
 import warnings
 warnings.filterwarnings('error')
 
+PFILE_HEADER_SIZE = 512 * 1024          # more than the header of any P-file revision
+DICOM_HEADER_THRESHOLD = 1024 * 1024    # DICOMs larger than this are routed on a copy of their header
+SERIES_LOCK_STRIPES = 64                # locks shared by hash among the series being sorted
+
 
 def write_json_file(path, object_):
     with open(path, 'w') as json_file:
@@ -31,151 +47,449 @@ def write_digest_file(path):
     digest_path = os.path.join(path, 'DIGEST.txt')
 
 
-def create_archive(path, content, arcname, **kwargs):
+def copy_dicom_header(filepath, header_path):
+    """Copy the DICOM at filepath, up to its pixel data, to header_path."""
+    import dicom
+    with open(filepath, 'rb') as fp:
+        dicom.read_file(fp, stop_before_pixels=True)
+        size = fp.tell()
+        fp.seek(0)
+        with open(header_path, 'wb') as header:
+            header.write(fp.read(size))
+
+
+def is_dicom(filepath):
+    """Return whether the file at filepath has the 'DICM' magic of a DICOM file after its preamble."""
+    with open(filepath, 'rb') as fp:
+        fp.seek(128)
+        return fp.read(4) == 'DICM'
+
+
+def digest_order(fn):
+    return (fn.endswith('.json') and 1) or (fn.endswith('.txt') and 2) or fn
+
+
+def create_archive(path, content, arcname, compresslevel=6):
+    """
+    Archive the directory content as arcname into an appendable tgz at path, and return its digest.
+
+    The archive is an ordinary tgz, but its tar entries and its end-of-archive blocks are separate
+    gzip members, so that append_archive() can add entries by rewriting only the last member (see
+    nimsutil.append_tar).
+    """
     # write digest file
     digest_filepath = os.path.join(content, 'DIGEST.txt')
     open(digest_filepath, 'w').close() # touch file, so that it's included in the digest
-    filenames = sorted(os.listdir(content), key=lambda fn: (fn.endswith('.json') and 1) or (fn.endswith('.txt') and 2) or fn)
+    filenames = sorted(os.listdir(content), key=digest_order)
+    digest = '\n'.join(filenames) + '\n'
     with open(digest_filepath, 'w') as digest_file:
-        digest_file.write('\n'.join(filenames) + '\n')
+        digest_file.write(digest)
     # create archive
-    with tarfile.open(path, 'w:gz', **kwargs) as archive:
-        archive.add(content, arcname, recursive=False) # add the top-level directory
+    gettarinfo = tarfile.TarFile(fileobj=io.BytesIO(), mode='w').gettarinfo
+    with open(path, 'wb') as archive:
+        members = [(gettarinfo(content, arcname), None)]    # the top-level directory
         for fn in filenames:
-            archive.add(os.path.join(content, fn), os.path.join(arcname, fn))
+            tarinfo = gettarinfo(os.path.join(content, fn), os.path.join(arcname, fn))
+            members.append((tarinfo, open(os.path.join(content, fn), 'rb') if tarinfo.isreg() else None))
+        try:
+            nimsutil.write_tar_member(archive, members, compresslevel)
+        finally:
+            for tarinfo, data in members:
+                if data: data.close()
+        archive.write(nimsutil.TAR_END_MEMBER)
+    return digest
+
+
+def append_archive(path, size, digest, src_path, compresslevel=6):
+    """
+    Append the files of the tgz at src_path to the appendable archive at path, and return the new digest.
+
+    size and digest are from the archive's manifest. The files are renamed into the top-level directory
+    of the archive, followed by a DIGEST.txt that lists the files of both. Like a repack, files from
+    src_path supersede same-named files in the archive, because tar extracts later entries over earlier
+    ones. Only the new data is compressed and written; the manifest is updated last.
+    """
+    with tarfile.open(path, 'r:gz') as archive:
+        arcname = archive.next().name.split('/')[0]
+    filenames = set(digest.split())
+
+    def digest_text():
+        return '\n'.join(sorted(filenames, key=digest_order)) + '\n'
+
+    def members():
+        for member, fileobj in nimsutil.iter_tar(src_path):
+            fn = member.name.split('/', 1)[-1]
+            if fn != 'DIGEST.txt':
+                member.name = '%s/%s' % (arcname, fn)
+                filenames.add(fn)
+                yield member, fileobj
+        digest_info = tarfile.TarInfo('%s/DIGEST.txt' % arcname)
+        digest_info.size, digest_info.mtime, digest_info.mode = len(digest_text()), time.time(), 0o644
+        yield digest_info, io.BytesIO(digest_text())
+
+    nimsutil.append_tar(path, size, members(), compresslevel)
+    nimsutil.write_manifest(path, digest_text())
+    return digest_text()
 
 
 class Sorter(object):
 
-    def __init__(self, stage_path, preserve_path, nims_path, sleep_time):
+    def __init__(self, stage_path, preserve_path, nims_path, sleep_time, jobs=1, poll=None, batch=False):
         super(Sorter, self).__init__()
         self.stage_path = stage_path
         self.preserve_path = preserve_path
         self.nims_path = nims_path
         self.sleep_time = sleep_time
+        self.jobs = jobs
+        self.poll = poll
+        self.batch = batch
         self.alive = True
+        self.queue = Queue.Queue()
+        self.in_progress = set()            # stage items queued or being sorted
+        self.resolve_lock = threading.Lock()
+        self.series_locks = [threading.Lock() for i in range(SERIES_LOCK_STRIPES)]
+        metrics.gauge('nims_stage_backlog', 'Items waiting in a stage directory',
+                lambda: {(('stage', 'sort'),): nimsutil.stage_backlog(self.stage_path)})
 
     def halt(self):
         self.alive = False
 
     def run(self):
-        while self.alive:
-            stage_items = [os.path.join(self.stage_path, si) for si in os.listdir(self.stage_path) if not si.startswith('.')] # ignore dot files
-            if stage_items:
-                for stage_item in sorted(stage_items, key=os.path.getmtime): # oldest first
-                    if os.path.islink(stage_item):
-                        os.remove(stage_item)
-                    elif 'gephysio' in os.path.basename(stage_item): # HACK !!!!!!!!!!!!!!!! NIMS 1.0 cannot sort gephysio
-                        log.info('Unpacking   %s' % os.path.basename(stage_item))
-                        with tempfile.TemporaryDirectory() as tempdir_path:
-                            with tarfile.open(stage_item) as archive:
-                                archive.extractall(path=tempdir_path)
-                            physiodir_path = os.listdir(tempdir_path)[0]
-                            for f in os.listdir(os.path.join(tempdir_path, physiodir_path)):
-                                shutil.copy(os.path.join(tempdir_path, physiodir_path, f), os.path.join(self.nims_path, 'physio'))
-                        log.info('Done        %s' % os.path.basename(stage_item))
-                        os.remove(stage_item)
-                    elif os.path.isfile(stage_item):
-                        self.sort(stage_item)
-                    else:
-                        for subpath in [os.path.join(dirpath, fn) for (dirpath, _, filenames) in os.walk(stage_item) for fn in filenames]:
-                            if not os.path.islink(subpath) and not subpath.startswith('.'):
-                                self.sort(subpath)
-                        shutil.rmtree(stage_item)
-            else:
-                log.debug('Waiting for data...')
-                time.sleep(self.sleep_time)
+        """
+        Sort stage items, oldest first, with a pool of worker threads.
+
+        Each stage item is sorted by one worker, so that the files of a reaped series are handled in
+        order, while separate stage items are sorted in parallel. Workers serialize the resolution
+        of files to datasets, which may create database rows, and all further work on the same
+        series, but parse and move files concurrently.
+        """
+        watcher = nimsutil.StageWatcher(self.stage_path, self.sleep_time, self.poll)
+        workers = [threading.Thread(target=self.work, name='sorter-%d' % i) for i in range(self.jobs)]
+        for worker in workers:
+            worker.start()
+        try:
+            while self.alive:
+                if not self.in_progress:
+                    log.debug('Waiting for data...')
+                for stage_item in watcher.items():
+                    if stage_item not in self.in_progress:
+                        self.in_progress.add(stage_item)
+                        self.queue.put(stage_item)
+        finally:
+            for worker in workers:
+                self.queue.put(None)
+            for worker in workers:
+                worker.join()
+            watcher.close()
+
+    def work(self):
+        while True:
+            stage_item = self.queue.get()
+            if stage_item is None:
+                break
+            try:
+                if self.alive:
+                    self.sort_stage_item(stage_item)
+            except Exception:
+                log.exception('Error while sorting %s - shutting down...' % os.path.basename(stage_item))
+                self.halt()
+            finally:
+                self.in_progress.discard(stage_item)
+
+    def sort_stage_item(self, stage_item):
+        if os.path.islink(stage_item):
+            os.remove(stage_item)
+        elif 'gephysio' in os.path.basename(stage_item): # HACK !!!!!!!!!!!!!!!! NIMS 1.0 cannot sort gephysio
+            log.info('Unpacking   %s' % os.path.basename(stage_item))
+            with tempfile.TemporaryDirectory() as tempdir_path:
+                with tarfile.open(stage_item) as archive:
+                    archive.extractall(path=tempdir_path)
+                physiodir_path = os.listdir(tempdir_path)[0]
+                for f in os.listdir(os.path.join(tempdir_path, physiodir_path)):
+                    shutil.copy(os.path.join(tempdir_path, physiodir_path, f), os.path.join(self.nims_path, 'physio'))
+            log.info('Done        %s' % os.path.basename(stage_item))
+            os.remove(stage_item)
+        elif os.path.isfile(stage_item):
+            trace = self.trace_id(stage_item)
+            with nimsgears.model.StageMetric.measure(u'sort') as timer:
+                dataset = self.sort(stage_item, trace, timer)
+            self.trace([dataset] if dataset else [], trace)
+            transaction.commit()    # the stage metric and trace events, once per stage item
+        else:
+            trace = self.trace_id(stage_item)
+            datasets = []
+            with nimsgears.model.StageMetric.measure(u'sort') as timer:
+                subpaths = [os.path.join(dirpath, fn) for (dirpath, _, filenames) in os.walk(stage_item) for fn in filenames]
+                subpaths = [sp for sp in subpaths if not os.path.islink(sp) and not sp.startswith('.')]
+                if self.batch:
+                    datasets += self.sort_batch([sp for sp in subpaths if 'pfile' not in os.path.basename(sp)], trace, timer)
+                    subpaths = [sp for sp in subpaths if 'pfile' in os.path.basename(sp)]
+                for subpath in subpaths:
+                    if not self.alive: break    # leave the rest of the stage item for the next run
+                    datasets.append(self.sort(subpath, trace, timer))
+            self.trace([ds for ds in datasets if ds], trace)
+            transaction.commit()    # the stage metric and trace events, once per stage item
+            if self.alive:
+                shutil.rmtree(stage_item)
+
+    def series_lock(self, mrfile):
+        """
+        Return the lock that serializes work on the dataset of mrfile.
+
+        Series share a fixed set of locks by hash, so the locks do not grow with the number of series
+        sorted; two series that share a lock are merely sorted one after the other.
+        """
+        return self.series_locks[hash((mrfile.series_uid, mrfile.acq_no)) % SERIES_LOCK_STRIPES]
 
     def preserve(self, filepath):
         if self.preserve_path:
             preserve_path = os.path.join(self.preserve_path, os.path.relpath(filepath, self.stage_path).replace('/', '_'))
             log.debug('Preserving  %s' % os.path.basename(filepath))
             shutil.move(filepath, preserve_path)
+            preserved_files.inc()
+
 
+    @staticmethod
+    def trace_id(stage_item):
+        """Return the trace ID that names stage_item, or None, e.g. for a loose file."""
+        trace = os.path.basename(stage_item)
+        return trace if nimsutil.trace_time(trace) else None
 
-    def sort(self, filepath):
+    def trace(self, datasets, trace):
+        """Record the hand-offs of trace to and from the sorter, once for each of the datasets sorted from a stage item."""
+        if not trace:
+            return
+        for dataset in datasets:
+            nimsgears.model.DBSession.add(dataset)
+        for dataset in dict((ds.id, ds) for ds in datasets).itervalues():
+            nimsgears.model.TraceEvent.record(u'reaped', dataset.container, unicode(trace), nimsutil.trace_time(trace))
+            nimsgears.model.TraceEvent.record(u'sorted', dataset.container, unicode(trace), update=True)
+
+    def sort(self, filepath, trace=None, timer=None):
         """
         Revised sorter to handle multiple pfile acquisitions from a single series.
         Expects tgz file to contain METADATA.json and DIGEST.txt as the first files
-        in the archive.
+        in the archive. The psd is noted on timer, the stage metric of the stage item, if given.
+        Returns the dataset sorted into, or None if the file was preserved.
         """
         filename = os.path.basename(filepath)
-        if 'pfile' in filename:
-            log.info('Parsing     %s' % filename)
-            with tempfile.TemporaryDirectory(dir=None) as tempdir_path:
-                with tarfile.open(filepath) as archive:
-                    archive.extractall(path=tempdir_path)
-                newdata_dir = os.path.join(tempdir_path, os.listdir(tempdir_path)[0])
-                try:
-                    new_digest = open(os.path.join(newdata_dir, 'DIGEST.txt')).read()
-                except IOError:
-                    log.debug('%s has no digest' % filepath)
-                    new_digest = None
-                pfile = glob.glob(os.path.join(newdata_dir, 'P?????.7'))[0]
-                try:
-                    mrfile = nimsdata.parse(pfile, filetype='pfile', full_parse=True)
-                except nimsdata.NIMSDataError:
-                    self.preserve(filepath)
-                else:
+        dataset = None
+        with sort_seconds.time(filetype='pfile' if 'pfile' in filename else 'dicom'):
+            if 'pfile' in filename:
+                log.info('Parsing     %s' % filename)
+                with tempfile.TemporaryDirectory(dir=None) as tempdir_path:
+                    newdata_dir = None
+                    try:
+                        new_digest, mrfile = self.route_pfile(filepath, tempdir_path)
+                        if unicode(mrfile.psd_name).startswith(u'mux'):   # the calibration needs the full parse
+                            newdata_dir = self.extract_pfile(filepath, tempdir_path)
+                            pfile = glob.glob(os.path.join(newdata_dir, 'P?????.7'))[0]
+                            mrfile = nimsdata.parse(pfile, filetype='pfile', full_parse=True)
+                    except nimsdata.NIMSDataError:
+                        self.preserve(filepath)
+                    else:
+                        if timer:
+                            timer.info['psd'] = unicode(mrfile.psd_name)
+                        log.info('Sorting     %s' % filename)
+                        filename = '_'.join(filename.rsplit('_')[-4:])
+                        with self.resolve_lock:   # resolving may create the experiment, subject, session and epoch
+                            dataset = nimsgears.model.Dataset.from_mrfile(mrfile, self.nims_path)
+                        with self.series_lock(mrfile):
+                            existing_pf = glob.glob(os.path.join(self.nims_path, dataset.relpath, '*pfile.tgz'))
+                            if not existing_pf:
+                                shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
+                                if new_digest is not None:
+                                    nimsutil.write_manifest(os.path.join(self.nims_path, dataset.relpath, filename), new_digest)
+                            else:
+                                orig_pf = existing_pf[0]
+                                manifest = nimsutil.read_manifest(orig_pf)
+                                if manifest:
+                                    orig_digest = manifest[1]
+                                else:
+                                    with tarfile.open(orig_pf) as orig_archive:
+                                        for ti in orig_archive:
+                                            if 'DIGEST.txt' in ti.name:
+                                                orig_digest = orig_archive.extractfile(ti).read()
+                                                break
+                                        else:
+                                            log.debug('no digest')
+                                            orig_digest = None
+                                if (new_digest is None or orig_digest is None) or (new_digest != orig_digest):
+                                    if manifest and nimsutil.is_appendable(orig_pf, manifest[0]):
+                                        log.debug('appending')
+                                        filename = os.path.basename(orig_pf)
+                                        append_archive(orig_pf, manifest[0], manifest[1], filepath, compresslevel=6)
+                                        os.remove(filepath)
+                                    else:
+                                        log.debug('repacking')
+                                        if not newdata_dir:
+                                            newdata_dir = self.extract_pfile(filepath, tempdir_path)
+                                        with tempfile.TemporaryDirectory(dir=tempdir_path) as combined_dir:
+                                            with tarfile.open(orig_pf) as orig_archive:
+                                                orig_archive.extractall(path=combined_dir)
+                                            combineddata_dir = os.path.join(combined_dir, os.listdir(combined_dir)[0])
+                                            for f in glob.glob(os.path.join(newdata_dir, '*')):
+                                                fn = os.path.basename(f)
+                                                log.debug('MOVING %s into %s' % (f, os.path.join(combineddata_dir, fn)))
+                                                shutil.move(f, os.path.join(combineddata_dir, fn))
+                                            log.debug(os.listdir(combineddata_dir))
+                                            outpath = os.path.join(tempdir_path, filename)
+                                            digest = create_archive(outpath, combineddata_dir, os.path.basename(combineddata_dir), compresslevel=6)
+                                            shutil.move(outpath, os.path.join(self.nims_path, dataset.relpath, filename))
+                                            nimsutil.write_manifest(os.path.join(self.nims_path, dataset.relpath, filename), digest)
+                                        os.remove(filepath)
+                                else:
+                                    shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
+                                    if new_digest is not None:
+                                        nimsutil.write_manifest(os.path.join(self.nims_path, dataset.relpath, filename), new_digest)
+
+                            log.debug('file sorted into to %s' % os.path.join(self.nims_path, dataset.relpath, filename))
+                            dataset.container.num_mux_cal_cycle = getattr(mrfile, 'num_mux_cal_cycle', None)
+                            dataset.filenames = [filename]
+                            if (dataset.container.psd or u'').startswith(u'mux'):
+                                nimsgears.model.MuxCalibration.from_mrfile(mrfile, dataset, filename)
+                            dataset.updatetime = datetime.datetime.now()
+                            dataset.untrash()
+                            if trace:
+                                dataset.trace = unicode(trace)
+                            transaction.commit()
+                            sorted_files.inc(filetype='pfile')
+            else:
+                mrfile = self.parse(filepath)
+                if mrfile:
+                    if timer:
+                        timer.info['psd'] = unicode(mrfile.psd_name)
                     log.info('Sorting     %s' % filename)
                     filename = '_'.join(filename.rsplit('_')[-4:])
-                    dataset = nimsgears.model.Dataset.from_mrfile(mrfile, self.nims_path)
-                    existing_pf = glob.glob(os.path.join(self.nims_path, dataset.relpath, '*pfile.tgz'))
-                    if not existing_pf:
+                    with self.resolve_lock:   # resolving may create the experiment, subject, session and epoch
+                        dataset = nimsgears.model.Dataset.from_mrfile(mrfile, self.nims_path)
+                    with self.series_lock(mrfile):
                         shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
-                    else:
-                        orig_pf = existing_pf[0]
-                        with tarfile.open(orig_pf) as orig_archive:
-                            for ti in orig_archive:
-                                if 'DIGEST.txt' in ti.name:
-                                    orig_digest = orig_archive.extractfile(ti).read()
-                                    break
-                            else:
-                                log.debug('no digest')
-                                orig_digest = None
-                        if (new_digest is None or orig_digest is None) or (new_digest != orig_digest):
-                            log.debug('repacking')
-                            with tempfile.TemporaryDirectory(dir=tempdir_path) as combined_dir:
-                                with tarfile.open(orig_pf) as orig_archive:
-                                    orig_archive.extractall(path=combined_dir)
-                                combineddata_dir = os.path.join(combined_dir, os.listdir(combined_dir)[0])
-                                for f in glob.glob(os.path.join(newdata_dir, '*')):
-                                    fn = os.path.basename(f)
-                                    log.debug('MOVING %s into %s' % (f, os.path.join(combineddata_dir, fn)))
-                                    shutil.move(f, os.path.join(combineddata_dir, fn))
-                                log.debug(os.listdir(combineddata_dir))
-                                outpath = os.path.join(tempdir_path, filename)
-                                create_archive(outpath, combineddata_dir, os.path.basename(combineddata_dir), compresslevel=6)
-                                shutil.move(outpath, os.path.join(self.nims_path, dataset.relpath, filename))
-                            os.remove(filepath)
-                        else:
-                            shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
-
-                    log.debug('file sorted into to %s' % os.path.join(self.nims_path, dataset.relpath, filename))
-                    dataset.container.num_mux_cal_cycle = mrfile.num_mux_cal_cycle
-                    dataset.filenames = [filename]
-                    dataset.updatetime = datetime.datetime.now()
-                    dataset.untrash()
-                    transaction.commit()
-        else:
-            try:
-                mrfile = nimsdata.parse(filepath)
-            except nimsdata.NIMSDataError:
-                self.preserve(filepath)
+                        dataset.filenames = [filename]
+                        dataset.updatetime = datetime.datetime.now()
+                        dataset.untrash()
+                        if trace:
+                            dataset.trace = unicode(trace)
+                        transaction.commit()
+                        sorted_files.inc(filetype=mrfile.filetype)
+        log.info('Done        %s' % filename)
+        return dataset
+
+    def route_pfile(self, filepath, tempdir_path):
+        """
+        Return the digest and the header-only parse of the P-file in the pfile tgz at filepath.
+
+        The archive is streamed up to the P-file, of which only the header block is copied to
+        tempdir_path and parsed, which is all the sorter needs to route it. The data stays packed.
+        """
+        digest = None
+        for member, fileobj in nimsutil.iter_tar(filepath):
+            name = os.path.basename(member.name)
+            if name == 'DIGEST.txt':
+                digest = fileobj.read()
+            elif fnmatch.fnmatch(name, 'P?????.7'):
+                header_path = os.path.join(nimsutil.make_joined_path(tempdir_path, 'header'), name)
+                with open(header_path, 'wb') as header:
+                    header.write(fileobj.read(PFILE_HEADER_SIZE))
+                if digest is None:
+                    log.debug('%s has no digest' % filepath)
+                return digest, nimsdata.parse(header_path, filetype='pfile')
+        raise nimsdata.NIMSDataError('%s contains no P-file' % filepath)
+
+    def extract_pfile(self, filepath, tempdir_path):
+        """Extract the pfile tgz at filepath into tempdir_path and return the path of its data directory."""
+        extract_path = nimsutil.make_joined_path(tempdir_path, 'extracted')
+        with tarfile.open(filepath) as archive:
+            archive.extractall(path=extract_path)
+        return os.path.join(extract_path, os.listdir(extract_path)[0])
+
+    def parse(self, filepath):
+        """
+        Return the parsed file at filepath, or None if it cannot be parsed and has been preserved.
+
+        Large DICOMs, e.g. multi-frame files, are parsed from a copy of their header, so that routing
+        them does not read their pixel data. Full parsing is left to the processor. Other large files,
+        e.g. tgz archives, are told apart by the DICOM magic and parsed as they are.
+        """
+        try:
+            if os.path.getsize(filepath) > DICOM_HEADER_THRESHOLD and is_dicom(filepath):
+                with tempfile.TemporaryDirectory(dir=None) as tempdir_path:
+                    header_path = os.path.join(tempdir_path, os.path.basename(filepath))
+                    try:
+                        copy_dicom_header(filepath, header_path)
+                    except Exception:
+                        header_path = filepath  # not one pydicom can read; let nimsdata decide
+                    mrfile = nimsdata.parse(header_path, load_data=False)
             else:
-                mrfile.num_mux_cal_cycle = None  # dcms will never have num_mux_cal_cycles
-                if mrfile.is_screenshot:
-                    mrfile.acq_no = 0
-                    mrfile.timestamp = datetime.datetime.strptime(datetime.datetime.strftime(mrfile.timestamp, '%Y%m%d') + '235959', '%Y%m%d%H%M%S')
-                log.info('Sorting     %s' % filename)
-                filename = '_'.join(filename.rsplit('_')[-4:])
-                dataset = nimsgears.model.Dataset.from_mrfile(mrfile, self.nims_path)
-                shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
-                dataset.filenames = [filename]
+                mrfile = nimsdata.parse(filepath, load_data=False)
+        except nimsdata.NIMSDataError:
+            self.preserve(filepath)
+            return None
+        mrfile.num_mux_cal_cycle = None  # dcms will never have num_mux_cal_cycles
+        if mrfile.is_screenshot:
+            mrfile.acq_no = 0
+            mrfile.timestamp = datetime.datetime.strptime(datetime.datetime.strftime(mrfile.timestamp, '%Y%m%d') + '235959', '%Y%m%d%H%M%S')
+        return mrfile
+
+    def sort_batch(self, filepaths, trace=None, timer=None):
+        """
+        Sort the files of one stage item, committing twice for the whole batch rather than once per file.
+
+        All files are parsed first and grouped by series and acquisition. Each group is resolved to
+        its dataset once. The datasets are marked as updated and committed before any of their files
+        are moved, so that a crash part way through cannot leave files in the store unscheduled;
+        the files left in the stage are sorted again on restart. The locks of all series in the
+        batch are taken, in a fixed order, until the batch is committed. Returns the datasets sorted into.
+        """
+        start = time.time()
+        groups = collections.OrderedDict()  # (series uid, acquisition) -> [(filepath, mrfile)]
+        for filepath in filepaths:
+            log.debug('Parsing     %s' % os.path.basename(filepath))
+            mrfile = self.parse(filepath)
+            if mrfile:
+                groups.setdefault((mrfile.series_uid, mrfile.acq_no), []).append((filepath, mrfile))
+        batch = []                          # [(dataset, files)]
+        for files in groups.itervalues():
+            if not self.alive: break        # leave the rest of the stage item for the next run
+            mrfile = files[0][1]
+            if timer:
+                timer.info['psd'] = unicode(mrfile.psd_name)
+            log.info('Sorting     %d files of %s' % (len(files), os.path.basename(os.path.dirname(files[0][0]))))
+            with self.resolve_lock:   # resolving may create the experiment, subject, session and epoch
+                batch.append((nimsgears.model.Dataset.from_mrfile(mrfile, self.nims_path), files))
+        if not batch:
+            return []
+        locks = [self.series_locks[i] for i in sorted(set(hash(key) % SERIES_LOCK_STRIPES for key in groups))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            for dataset, _ in batch:
+                dataset.updatetime = datetime.datetime.now()
+            transaction.commit()
+            for dataset, files in batch:
+                nimsgears.model.DBSession.add(dataset)
+                filenames = []
+                for filepath, _ in files:
+                    filename = '_'.join(os.path.basename(filepath).rsplit('_')[-4:])
+                    shutil.move(filepath, os.path.join(self.nims_path, dataset.relpath, filename))
+                    filenames.append(filename)
+                dataset.filenames = filenames
                 dataset.updatetime = datetime.datetime.now()
                 dataset.untrash()
-                transaction.commit()
-        log.info('Done        %s' % filename)
+                if trace:
+                    dataset.trace = unicode(trace)
+            transaction.commit()
+        finally:
+            for lock in locks:
+                lock.release()
+        num_files = sum(len(files) for _, files in batch)
+        for _, files in batch:
+            sorted_files.inc(len(files), filetype=files[0][1].filetype)
+        batch_time = time.time() - start
+        sort_batch_seconds.observe(batch_time)
+        for i in range(num_files):     # as the average per file, comparable with files sorted one at a time
+            sort_seconds.observe(batch_time / num_files, filetype='dicom')
+        return [dataset for dataset, _ in batch]
 
 
 if __name__ == '__main__':
@@ -183,8 +497,6 @@ if __name__ == '__main__':
     import argparse
     import sqlalchemy
 
-    import nimsutil
-
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('db_uri', help='database URI')
     arg_parser.add_argument('stage_path', help='path to staging area')
@@ -192,14 +504,20 @@ if __name__ == '__main__':
     arg_parser.add_argument('-t', '--toplevel', action='store_true', help='handle toplevel files')
     arg_parser.add_argument('-p', '--preserve_path', help='preserve unsortable files here')
     arg_parser.add_argument('-s', '--sleeptime', type=int, default=10, help='time to sleep before checking for new files')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1, help='number of stage items to sort in parallel (default: 1)')
+    arg_parser.add_argument('-b', '--batch', action='store_true', help='sort the files of a stage item together, committing once per dataset')
+    arg_parser.add_argument('-o', '--poll', action='store_true', default=None, help='poll the stage rather than watch it (default: poll network filesystems only)')
     arg_parser.add_argument('-f', '--logfile', help='path to log file')
     arg_parser.add_argument('-l', '--loglevel', default='info', help='log level (default: info)')
     arg_parser.add_argument('-q', '--quiet', action='store_true', default=False, help='disable console logging')
+    arg_parser.add_argument('-P', '--metricsport', type=int, help='serve metrics on this port of localhost')
     args = arg_parser.parse_args()
 
     nimsutil.configure_log(args.logfile, not args.quiet, args.loglevel)
+    if args.metricsport:
+        nimsutil.metrics_registry.serve(args.metricsport)
     nimsgears.model.init_model(sqlalchemy.create_engine(args.db_uri))
-    sorter = Sorter(args.stage_path, args.preserve_path, args.nims_path, args.sleeptime)
+    sorter = Sorter(args.stage_path, args.preserve_path, args.nims_path, args.sleeptime, args.jobs, args.poll, args.batch)
 
     def term_handler(signum, stack):
         sorter.halt()
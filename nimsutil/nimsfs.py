@@ -18,8 +18,7 @@ import time
 import argparse
 import pwd    # to translate uid to username
 import fuse
-import gzip
-import struct
+import nimsutil
 
 import sqlalchemy
 from nimsgears.model import *
@@ -322,11 +321,8 @@ class Nimsfs(fuse.LoggingMixIn, fuse.Operations):
                         fname = next((f[1] for f in files if f[0]==fn), None)
                         if fname:
                             ts = os.path.getmtime(fname)
-                            # Apparently there's no way to get the uncompressed size except by reading the last four bytes.
                             # TODO: consider saving this (as well as the timestamp) in the db.
-                            with open(fname, 'r') as fp:
-                                fp.seek(-4,2)
-                                sz = struct.unpack('<I',fp.read())[0]
+                            sz = nimsutil.gzip_size(fname)
                         else:
                             raise fuse.FuseOSError(errno.ENOENT)
                     else:
@@ -375,7 +371,7 @@ class Nimsfs(fuse.LoggingMixIn, fuse.Operations):
                     fn = cur_path[5][:-3] +'gz'
                     fname = next((f[1] for f in files if f[0]==fn), None)
                     if fname:
-                        self.gzfile = gzip.open(fname,'r')
+                        self.gzfile = nimsutil.open_gzip(fname)
                         fh = self.gzfile.fileno()
                     else:
                         raise fuse.FuseOSError(errno.ENOENT)
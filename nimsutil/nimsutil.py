@@ -6,13 +6,30 @@
 import os
 import re
 import gzip
+import fcntl
+import zlib
+import errno
+import time
+import bisect
+import ctypes
+import ctypes.util
+import select
 import shutil
 import string
+import struct
 import tarfile
 import difflib
 import hashlib
+import json
 import datetime
+import resource
 import tempfile
+import threading
+import contextlib
+import BaseHTTPServer
+import multiprocessing
+import multiprocessing.pool
+import collections
 import logging, logging.handlers
 
 
@@ -34,6 +51,388 @@ class TempDir(object):
         shutil.rmtree(self.temp_dir)
 
 
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)   # linux; not exposed by python 2
+
+
+class StageTimer(object):
+
+    """
+    Context managed measurement of the resources used by a stage of work.
+
+    Records wall time and CPU time in seconds, peak RSS in kB, and bytes read from and written to
+    block devices. CPU time and I/O are those of the calling thread plus those of the subprocesses,
+    e.g. pigz or a recon, that finished and were waited for during the stage. Child usage is only
+    kept per process, so children that other threads reap meanwhile are counted as well. Peak RSS
+    is that of the process or of its largest child, whichever is larger.
+    On exit, failed is set if the stage raised, and on_exit, if given, is called with the timer.
+    Keyword arguments are kept in info, where the stage can add to them.
+    """
+
+    def __init__(self, stage, on_exit=None, **info):
+        self.stage = stage
+        self.on_exit = on_exit
+        self.info = info
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start_usage = resource.getrusage(RUSAGE_THREAD)
+        self.start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        usage = resource.getrusage(RUSAGE_THREAD)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.wall_time = time.time() - self.start_time
+        self.cpu_time = (self.usage_delta(usage, self.start_usage, 'ru_utime', 'ru_stime')
+                + self.usage_delta(children, self.start_children, 'ru_utime', 'ru_stime'))
+        self.max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children.ru_maxrss)
+        self.read_bytes = (self.usage_delta(usage, self.start_usage, 'ru_inblock')
+                + self.usage_delta(children, self.start_children, 'ru_inblock')) * 512
+        self.write_bytes = (self.usage_delta(usage, self.start_usage, 'ru_oublock')
+                + self.usage_delta(children, self.start_children, 'ru_oublock')) * 512
+        self.failed = exc_type is not None
+        if self.on_exit:
+            self.on_exit(self)
+
+    @staticmethod
+    def usage_delta(usage, start_usage, *fields):
+        return sum(getattr(usage, f) - getattr(start_usage, f) for f in fields)
+
+
+class Metric(object):
+
+    """A metric with one value per set of labels, in Prometheus text exposition format."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}    # sorted label items -> value
+
+    @staticmethod
+    def format_labels(labels, **extra):
+        items = sorted(labels) + sorted(extra.items())
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) if items else ''
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + self.format_labels(labels), value) for labels, value in sorted(self.values.iteritems())]
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        lines += ['%s %r' % (name, float(value)) for name, value in self.samples() if value is not None]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    """A metric that is set directly, or computed by callback, returning {label items: value}, when exposed."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback=None):
+        super(Gauge, self).__init__(name, help)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback:
+            values = self.callback()
+            return [(self.name + self.format_labels(labels), value) for labels, value in sorted(values.iteritems())]
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+    def __init__(self, name, help, buckets=default_buckets):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * len(self.buckets) + [0, 0.])    # bucket counts, count, sum
+            bucket = bisect.bisect_left(self.buckets, value)
+            if bucket < len(self.buckets):
+                counts[bucket] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """Return a context manager that observes the wall time of its block."""
+        return StageTimer(self.name, lambda timer: self.observe(timer.wall_time, **labels))
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, counts in sorted(self.values.iteritems()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket' + self.format_labels(labels, le=repr(float(bound))), cumulative))
+                samples.append((self.name + '_bucket' + self.format_labels(labels, le='+Inf'), counts[-2]))
+                samples.append((self.name + '_count' + self.format_labels(labels), counts[-2]))
+                samples.append((self.name + '_sum' + self.format_labels(labels), counts[-1]))
+        return samples
+
+
+class MetricsRegistry(object):
+
+    """
+    In-process registry of metrics, exposed in Prometheus text format.
+
+    Metrics are created on first use and shared by name, so that modules can register the
+    metrics they update without coordinating. serve() exposes them over HTTP on localhost.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, cls, name, help, *args, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self.register(Counter, name, help)
+
+    def gauge(self, name, help, callback=None):
+        return self.register(Gauge, name, help, callback)
+
+    def histogram(self, name, help, buckets=Histogram.default_buckets):
+        return self.register(Histogram, name, help, buckets)
+
+    def exposition(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        return '\n'.join(m.exposition() for m in metrics) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the metrics at http://host:port/metrics from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.exposition()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+metrics_registry = MetricsRegistry()
+
+
+def stage_backlog(path):
+    """Return the number of items waiting in a stage directory, ignoring dot files, or None if it is missing."""
+    try:
+        return len([item for item in os.listdir(path) if not item.startswith('.')])
+    except OSError:
+        return None
+
+
+def trace_id(prefix):
+    """Return a new trace ID, for naming a stage item, that records the time at which it was made."""
+    return '%s_%.6f' % (prefix, time.time())
+
+
+def trace_time(trace):
+    """Return the datetime at which trace was made, or None if trace is not a trace ID."""
+    try:
+        return datetime.datetime.fromtimestamp(float(trace.rsplit('_', 1)[-1]))
+    except (ValueError, AttributeError):
+        return None
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+REMOTE_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'lustre', 'gpfs', 'fuse.sshfs')
+
+
+def filesystem_type(path):
+    """Return the type of the filesystem that path is on, according to /proc/mounts, or None."""
+    path = os.path.realpath(path)
+    fstype, mount_len = None, -1
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                mount_point, type_ = line.split()[1:3]
+                mount_point = mount_point.replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > mount_len:
+                    fstype, mount_len = type_, len(mount_point)
+    except IOError:
+        pass
+    return fstype
+
+
+class Inotify(object):
+
+    """Minimal ctypes binding of Linux inotify, for watching a single directory."""
+
+    event_header = struct.Struct('iIII')    # wd, mask, cookie, len
+
+    def __init__(self, path, mask):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        if libc.inotify_add_watch(self.fd, path, mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error), path)
+
+    def read(self, timeout):
+        """Return [(mask, name)] of the events that arrive within timeout seconds."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            events.append((mask, data[offset:offset + length].rstrip('\0')))
+            offset += length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StageWatcher(object):
+
+    """
+    Deliver the items that become ready in a stage directory.
+
+    Writers stage an item under a '.'-prefixed name and rename it into place when it is complete,
+    so an item is ready once it has a name without a leading dot. Items already in the stage are
+    delivered first, oldest first, then new items as they are renamed, or as plain files are
+    closed, into the stage. Each item is delivered once while it remains in the stage.
+
+    On Linux the stage is watched with inotify, unless it is on a network filesystem, where
+    inotify does not see changes made by other hosts; there, or if poll is True, the stage is
+    listed every interval instead.
+    """
+
+    def __init__(self, path, interval=10, poll=None):
+        self.path = path
+        self.interval = interval
+        self.inotify = None
+        if not poll and (poll is not None or filesystem_type(path) not in REMOTE_FILESYSTEMS):
+            try:
+                self.inotify = Inotify(path, IN_MOVED_TO | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_DELETE)
+            except (OSError, AttributeError):   # not Linux, or out of watches
+                pass
+        self.delivered = set()
+        self.pending = self.scan()
+
+    @property
+    def notifies(self):
+        """True if items are delivered when they are complete, rather than when they are first seen."""
+        return self.inotify is not None
+
+    def scan(self):
+        """Return the ready items that have not been delivered, oldest first, and forget those that are gone."""
+        names = set(name for name in os.listdir(self.path) if not name.startswith('.'))
+        self.delivered &= names
+        items = []
+        for name in names - self.delivered:
+            try:
+                items.append((os.path.getmtime(os.path.join(self.path, name)), name))
+            except OSError:     # already gone
+                pass
+        return [name for _, name in sorted(items)]
+
+    def items(self, timeout=None):
+        """Return the paths of newly ready items, oldest first, waiting up to timeout (default: interval) for some."""
+        timeout = self.interval if timeout is None else timeout
+        if not self.pending:
+            if self.inotify:
+                self.pending = self.wait(timeout)
+            else:
+                self.pending = self.scan()
+                if not self.pending:
+                    time.sleep(timeout)
+                    self.pending = self.scan()
+        names, self.pending = [n for n in self.pending if n not in self.delivered], []
+        self.delivered.update(names)
+        return [os.path.join(self.path, name) for name in names]
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        names = []
+        while not names:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            for mask, name in self.inotify.read(remaining):
+                if mask & IN_Q_OVERFLOW:
+                    names = self.scan()
+                elif name.startswith('.'):
+                    pass
+                elif mask & (IN_MOVED_FROM | IN_DELETE):
+                    self.delivered.discard(name)
+                    if name in names:
+                        names.remove(name)
+                elif mask & IN_MOVED_TO or not mask & IN_ISDIR:
+                    if name not in names:
+                        names.append(name)
+        return names
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+
+
 def configure_log(filepath=None, console=True, level='debug'):
     """Return a nims-configured logger."""
     logging._levelNames[10] = 'DBUG'
@@ -170,20 +569,85 @@ def ldap_query(uid):
     return unicode(firstname), unicode(lastname), unicode(email), uid_number
 
 
-def find_ge_physio(data_path, timestamp, psd_name):
-    physio_files = os.listdir(data_path)
-    if not physio_files:
-        raise Exception('physio files unavailable')
+class PhysioIndex(object):
+
+    """
+    Incrementally maintained index of a directory of GE physio files.
+
+    Files are indexed by the psd name and timestamp encoded in their names. The directory is only
+    listed again once its mtime changes, and only names that have not been seen before are parsed.
+    Lookups bisect the sorted timestamps of each psd.
+    """
+
+    filename_regexp = re.compile(r'.+?_(?P<psd>.+)_(?P<timestamp>\d{10}_\d{2}_\d{2}_\d+)$')
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.mtime = None
+        self.listtime = None
+        self.filenames = set()
+        self.timestamps = {}    # psd name -> sorted list of timestamps
+        self.files = {}         # (psd name, timestamp) -> list of filenames
+
+    def update(self):
+        """Index new files, if the directory has changed since it was last listed."""
+        with self.lock:
+            mtime = os.path.getmtime(self.data_path)
+            if mtime == self.mtime and self.listtime - mtime > 1:    # allow for coarse mtime resolution
+                return
+            listtime = time.time()
+            filenames = set(os.listdir(self.data_path))
+            if self.filenames - filenames:
+                self.reset()    # files were removed; start over
+            for filename in filenames - self.filenames:
+                match = self.filename_regexp.match(filename)
+                if not match:
+                    continue
+                try:
+                    timestamp = datetime.datetime.strptime(match.group('timestamp'), '%m%d%Y%H_%M_%S_%f')
+                except ValueError:
+                    continue
+                key = (match.group('psd'), timestamp)
+                if key not in self.files:
+                    bisect.insort(self.timestamps.setdefault(key[0], []), timestamp)
+                self.files.setdefault(key, []).append(filename)
+            self.filenames = filenames
+            self.mtime = mtime
+            self.listtime = listtime
 
-    physio_dict = {}
-    leadtime = datetime.timedelta(days=1)
-    regexp = '.+%s_((%s.+)|(%s.+))' % (psd_name, timestamp.strftime('%m%d%Y'), (timestamp+leadtime).strftime('%m%d%Y'))
+    def find(self, timestamp, psd_name):
+        """Return paths to the first bundle of physio files recorded for psd_name at or after timestamp."""
+        self.update()
+        if not self.filenames:
+            raise Exception('physio files unavailable')
+        deadline = datetime.datetime.combine(timestamp.date() + datetime.timedelta(days=2), datetime.time())
+        with self.lock:
+            matches = {}
+            for psd, timestamps in self.timestamps.iteritems():
+                if psd.endswith(psd_name):
+                    i = bisect.bisect_left(timestamps, timestamp)
+                    if i < len(timestamps) and timestamps[i] < deadline:
+                        matches.setdefault(timestamps[i], []).extend(self.files[(psd, timestamps[i])])
+            return [os.path.join(self.data_path, pf) for pf in matches[min(matches)]] if matches else []
 
-    physio_files = filter(lambda pf: re.match(regexp, pf), physio_files)
-    for pdt, pfn in [re.match(regexp, pf).group(1,0) for pf in physio_files]:
-        physio_dict.setdefault(datetime.datetime.strptime(pdt, '%m%d%Y%H_%M_%S_%f'), []).append(pfn)
-    valid_keys = filter(lambda pdt: pdt >= timestamp, physio_dict)
-    return [os.path.join(data_path, pf) for pf in physio_dict[min(valid_keys)]] if valid_keys else []
+
+_physio_indexes = {}
+_physio_indexes_lock = threading.Lock()
+
+def physio_index(data_path):
+    """Return the shared PhysioIndex for data_path."""
+    with _physio_indexes_lock:
+        if data_path not in _physio_indexes:
+            _physio_indexes[data_path] = PhysioIndex(data_path)
+        return _physio_indexes[data_path]
+
+
+def find_ge_physio(data_path, timestamp, psd_name):
+    return physio_index(data_path).find(timestamp, psd_name)
 
 
 def pack_dicom_uid(uid):
@@ -208,32 +672,680 @@ def hrsize(size):
     return '%.0f%s' % (size, 'Y')
 
 
+def iter_tar(path):
+    """
+    Yield (member, fileobj) for the regular files of a tar archive, in archive order.
+
+    The archive is read as a stream, so a compressed archive is decompressed exactly once, without
+    seeking and without extracting anything to disk. Each fileobj is only readable until the next
+    member is requested. Gzip files are read with GzipFile, which, unlike the tarfile stream, reads
+    all the members of a gzip file of concatenated members.
+    """
+    with open(path, 'rb') as fileobj:
+        gzipped = fileobj.read(2) == '\x1f\x8b'
+        fileobj.seek(0)
+        with tarfile.open(fileobj=gzip.GzipFile(fileobj=fileobj) if gzipped else fileobj, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member, archive.extractfile(member)
+
+
+FICLONE = 0x40049409    # linux/fs.h: _IOW(0x94, 9, int)
+
+
+def fsync_path(path):
+    """Flush a file or directory to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def clone_file(src, dst):
+    """Copy src to dst as a reflink where the filesystem supports it, and as a plain copy otherwise."""
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except (IOError, OSError):
+                shutil.copyfileobj(src_file, dst_file, 1048576)
+    shutil.copystat(src, dst)
+
+
+def publish(src_path, dest_path, filenames=None):
+    """
+    Move files from a staging directory into dest_path, and return their names.
+
+    Each file is flushed to disk and then renamed into place, so readers never see a partially
+    written file. The staging directory should be on the same filesystem as dest_path, e.g. a
+    TempDir inside the store; otherwise files are reflinked or copied, and then removed.
+    """
+    filenames = filenames if filenames is not None else [f for f in os.listdir(src_path) if os.path.isfile(os.path.join(src_path, f))]
+    for filename in filenames:
+        src, dst = os.path.join(src_path, filename), os.path.join(dest_path, filename)
+        fsync_path(src)
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            clone_file(src, dst + '.part')
+            fsync_path(dst + '.part')
+            os.rename(dst + '.part', dst)
+            os.remove(src)
+    fsync_path(dest_path)
+    return filenames
+
+
+def du(path):
+    """Return the total size of the files under path, in bytes."""
+    return sum(os.path.getsize(os.path.join(dirpath, fn)) for dirpath, _, filenames in os.walk(path) for fn in filenames)
+
+
+class ExtractionCache(object):
+
+    """
+    Size-bounded LRU cache of extracted archives on local scratch disk, keyed by content digest.
+
+    Each entry is a directory named by its key, with a sibling .lock and .size file. Users hold a
+    shared flock on the .lock file while an entry is checked out, and eviction only removes entries
+    whose lock it can take exclusively, so entries in use are never evicted, by any thread or process
+    on the host. Checking out an entry touches it, which makes the directory mtime its LRU timestamp.
+
+    Entries are shared by all their users at once, so they are made read-only once extracted; users
+    must write their outputs elsewhere.
+    """
+
+    def __init__(self, cache_path, max_size):
+        self.cache_path = make_joined_path(cache_path)
+        self.max_size = max_size
+
+    def checkout(self, key, extract, size_hint=0):
+        """
+        Return a CacheEntry for key, calling extract(path) to fill a new entry if there is none.
+
+        size_hint is the expected size of a new entry, for which space is made before extraction.
+        The entry must be released when done, preferably with a with statement.
+        """
+        entry_path = os.path.join(self.cache_path, key)
+        lockfile = open(entry_path + '.lock', 'a')
+        try:
+            while True:
+                fcntl.flock(lockfile, fcntl.LOCK_SH)    # shared with the other users of an existing entry
+                if not same_file(lockfile, entry_path + '.lock'):
+                    lockfile.close()                    # removed by eviction while we waited for it
+                    lockfile = open(entry_path + '.lock', 'a')
+                    continue
+                if os.path.isdir(entry_path):
+                    os.utime(entry_path, None)
+                    return CacheEntry(entry_path, lockfile)
+                fcntl.flock(lockfile, fcntl.LOCK_EX)    # one extraction per entry at a time; not atomic
+                if not same_file(lockfile, entry_path + '.lock'):
+                    continue
+                if not os.path.isdir(entry_path):       # unless filled while we waited for the lock
+                    self.evict(size_hint)
+                    temp_path = tempfile.mkdtemp(dir=self.cache_path, prefix='.extract')
+                    try:
+                        extract(temp_path)
+                        with open(entry_path + '.size', 'w') as size_file:
+                            size_file.write('%d\n' % du(temp_path))
+                        set_writable(temp_path, False)
+                        os.rename(temp_path, entry_path)
+                    except:
+                        set_writable(temp_path, True)
+                        shutil.rmtree(temp_path, ignore_errors=True)
+                        raise
+                    self.evict()
+                # downgrade and check again; the entry may be evicted before the shared lock is taken
+        except:
+            lockfile.close()
+            raise
+
+    def entry_size(self, key):
+        try:
+            with open(os.path.join(self.cache_path, key + '.size')) as size_file:
+                return int(size_file.read())
+        except (IOError, ValueError):
+            return du(os.path.join(self.cache_path, key))
+
+    def evict(self, needed=0):
+        """Remove the least recently used entries that are not in use, until needed more bytes fit."""
+        entries = []
+        for key in os.listdir(self.cache_path):
+            entry_path = os.path.join(self.cache_path, key)
+            if key.startswith('.') or not os.path.isdir(entry_path):
+                continue
+            try:
+                entries.append((os.path.getmtime(entry_path), key, self.entry_size(key)))
+            except OSError:
+                pass    # evicted by someone else
+        total = sum(size for mtime, key, size in entries)
+        for mtime, key, size in sorted(entries):
+            if total + needed <= self.max_size:
+                break
+            entry_path = os.path.join(self.cache_path, key)
+            with open(entry_path + '.lock', 'a') as lockfile:
+                try:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue    # in use
+                if not same_file(lockfile, entry_path + '.lock'):
+                    continue    # evicted by someone else
+                if os.path.isdir(entry_path):
+                    set_writable(entry_path, True)
+                    shutil.rmtree(entry_path)
+                    total -= size
+                for suffix in ('.size', '.lock'):   # while locked; checkout reopens a lock file it finds removed
+                    try:
+                        os.remove(entry_path + suffix)
+                    except OSError:
+                        pass
+
+
+def set_writable(path, writable):
+    """Make the tree at path writable by its owner, or read-only for everyone."""
+    for dirpath, dirnames, filenames in os.walk(path, topdown=writable):
+        for fn in filenames:
+            os.chmod(os.path.join(dirpath, fn), 0o644 if writable else 0o444)
+        os.chmod(dirpath, 0o755 if writable else 0o555)
+
+
+def same_file(fileobj, path):
+    """Return whether the open fileobj is still the file at path."""
+    try:
+        return os.fstat(fileobj.fileno()).st_ino == os.stat(path).st_ino
+    except OSError:
+        return False
+
+
+class CacheEntry(object):
+
+    """A checked out ExtractionCache entry, which cannot be evicted until released."""
+
+    def __init__(self, path, lockfile):
+        self.path = path
+        self.lockfile = lockfile
+
+    def __enter__(self):
+        return self.path
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self):
+        self.lockfile.close()
+
+
+class LRUCache(object):
+
+    """
+    Thread-safe, size-bounded in-memory LRU cache, whose entries optionally expire after ttl seconds.
+
+    get() returns default for missing and expired entries alike, so callers just recompute and put().
+    """
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()    # key -> (expiry time, value), least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            expiry, value = self.entries.pop(key)
+            if expiry is not None and expiry < time.time():
+                return default
+            self.entries[key] = (expiry, value)     # most recently used
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl if self.ttl else None, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# BGZF: gzip members of at most 64 KiB, whose 'BC' extra field holds the size of the member, so that
+# the headers of a file are an index of its blocks. gzip, pigz, tar and GzipFile read it like any gzip.
+BGZF_BLOCK_SIZE = 65280                                 # data per block, as in bgzip
+BGZF_HEADER = struct.Struct('<4sIBBH2sHH')              # magic and flags, mtime, xfl, os, xlen, 'BC', slen, bsize - 1
+BGZF_TRAILER = struct.Struct('<II')                     # crc32, isize
+
+
+def gzip_member(data, compresslevel=6):
+    """Return at most BGZF_BLOCK_SIZE bytes of data compressed into one BGZF block, a complete gzip member."""
+    deflate = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = deflate.compress(data) + deflate.flush()
+    bsize = BGZF_HEADER.size + len(cdata) + BGZF_TRAILER.size
+    return ''.join((BGZF_HEADER.pack('\x1f\x8b\x08\x04', 0, 0, 0xff, 6, 'BC', 2, bsize - 1), cdata,
+                    BGZF_TRAILER.pack(zlib.crc32(data) & 0xffffffff, len(data))))
+
+
+BGZF_EOF = gzip_member('')      # the empty block with which a BGZF file ends
+
+
+def bgzf_index(fileobj):
+    """
+    Return ([data offset], [file offset]) of the blocks of a BGZF file, and its uncompressed size.
+
+    Only the header and trailer of each block are read. Return None if the file is not BGZF.
+    """
+    data_offsets, file_offsets = [], []
+    data_offset = file_offset = 0
+    while True:
+        fileobj.seek(file_offset)
+        header = fileobj.read(BGZF_HEADER.size)
+        if not header:
+            return data_offsets, file_offsets, data_offset
+        if len(header) < BGZF_HEADER.size:
+            return None
+        magic, _, _, _, xlen, subfield, slen, bsize = BGZF_HEADER.unpack(header)
+        if magic != '\x1f\x8b\x08\x04' or xlen != 6 or subfield != 'BC' or slen != 2:
+            return None
+        fileobj.seek(file_offset + bsize + 1 - 4)
+        isize = struct.unpack('<I', fileobj.read(4))[0]
+        if isize:
+            data_offsets.append(data_offset)
+            file_offsets.append(file_offset)
+        data_offset += isize
+        file_offset += bsize + 1
+
+
+bgzf_indexes = LRUCache(64)     # (path, mtime, size) -> bgzf_index() of the file, or False if it is not BGZF
+
+
+def path_bgzf_index(path):
+    """
+    Return bgzf_index() of the file at path, or None if it is not BGZF.
+
+    Indexing reads a header and trailer per 64 KiB block, so the index is cached for as long as the
+    mtime and size of the file are unchanged; stat()ing or reopening a file is then free.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    index = bgzf_indexes.get(key)
+    if index is None:
+        with open(path, 'rb') as fileobj:
+            index = bgzf_index(fileobj) or False
+        bgzf_indexes.put(key, index)
+    return index or None
+
+
+class BlockGzipReader(object):
+
+    """
+    Read-only, seekable file object for BGZF files, such as those written by ParallelGzipFile.
+
+    Seeking looks up the block in the index of block headers and decompresses only that block, rather
+    than decompressing from the start of the file as GzipFile does. As in GzipFile, the CRC32 and
+    size of each block are checked against its trailer, and IOError is raised if they do not match.
+    """
+
+    def __init__(self, path, index=None):
+        self.fileobj = open(path, 'rb')
+        self.data_offsets, self.file_offsets, self.size = index or path_bgzf_index(path)
+        self.offset = 0
+        self.block = (None, '')     # (block number, data) of the last block read
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def close(self):
+        self.fileobj.close()
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=0):
+        self.offset = max(0, {0: offset, 1: self.offset + offset, 2: self.size + offset}[whence])
+
+    def read_block(self, number):
+        if self.block[0] != number:
+            self.fileobj.seek(self.file_offsets[number])
+            bsize = BGZF_HEADER.unpack(self.fileobj.read(BGZF_HEADER.size))[-1]
+            cdata = self.fileobj.read(bsize + 1 - BGZF_HEADER.size)
+            crc, isize = BGZF_TRAILER.unpack(cdata[-BGZF_TRAILER.size:])
+            data = zlib.decompress(cdata[:-BGZF_TRAILER.size], -zlib.MAX_WBITS)
+            if zlib.crc32(data) & 0xffffffff != crc or len(data) != isize:
+                raise IOError('CRC check failed in block %d of %s' % (number, self.fileobj.name))
+            self.block = (number, data)
+        return self.block[1]
+
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self.size, self.offset + size)
+        chunks = []
+        while self.offset < end:
+            number = bisect.bisect_right(self.data_offsets, self.offset) - 1
+            start = self.offset - self.data_offsets[number]
+            chunk = self.read_block(number)[start:start + end - self.offset]
+            chunks.append(chunk)
+            self.offset += len(chunk)
+        return ''.join(chunks)
+
+
+def open_gzip(path):
+    """Return a seekable file object for the gzip file at path: a BlockGzipReader if it is BGZF, else a GzipFile."""
+    index = path_bgzf_index(path)
+    return BlockGzipReader(path, index) if index else gzip.open(path, 'rb')
+
+
+def gzip_size(path):
+    """Return the uncompressed size of the gzip file at path, from its block index if it is BGZF."""
+    index = path_bgzf_index(path)
+    if index:
+        return index[2]
+    with open(path, 'rb') as fileobj:
+        fileobj.seek(-4, 2)     # the size of the last member, which is the size of a single-member file
+        return struct.unpack('<I', fileobj.read(4))[0]
+
+
+compression_pool_lock = threading.Lock()
+compression_threads = None
+compression_pid = None
+
+
+def compression_pool():
+    """
+    Return the thread pool, with a thread per core, that compresses the blocks of all compressed files.
+
+    There is one pool per process. A forked child, e.g. a pipeline process, does not inherit the
+    threads of its parent's pool, so it starts a pool of its own rather than use the parent's.
+    """
+    global compression_threads, compression_pid
+    with compression_pool_lock:
+        if compression_pid != os.getpid():
+            compression_threads = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+            compression_pid = os.getpid()
+    return compression_threads
+
+
+class ParallelGzipFile(object):
+
+    """
+    Write-only file object that writes BGZF, compressing blocks of the data on a pool of threads.
+
+    Each block of data becomes a BGZF block, i.e. a gzip member of its own, and the blocks are written
+    in order, so the file is standard gzip that BlockGzipReader can also read randomly. zlib releases
+    the GIL while it compresses, so compression scales with cores. At most two blocks per thread are
+    in flight at a time. fileobj, if given, is written to instead of path and not closed. Without eof,
+    the file is left without the BGZF end-of-file block, for the caller to append more blocks.
+    """
+
+    def __init__(self, path=None, compresslevel=6, fileobj=None, eof=True):
+        self.fileobj = fileobj or open(path, 'wb')
+        self.myfileobj = None if fileobj else self.fileobj
+        self.compresslevel = compresslevel
+        self.block_size = BGZF_BLOCK_SIZE
+        self.eof = eof
+        self.max_pending = 2 * multiprocessing.cpu_count()
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        self.offset = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.offset += len(data)
+        if self.buffered >= self.block_size:
+            data = ''.join(self.buffer)
+            full = len(data) - len(data) % self.block_size
+            for start in xrange(0, full, self.block_size):
+                self.submit(data[start:start + self.block_size])
+            self.buffer = [data[full:]]
+            self.buffered = len(data) - full
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def tell(self):
+        """Return the number of uncompressed bytes written."""
+        return self.offset
+
+    def submit(self, block):
+        self.pending.append(compression_pool().apply_async(gzip_member, (block, self.compresslevel)))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        """Write the blocks compressed so far; a partial block is held back to keep members full size."""
+        while self.pending and self.pending[0].ready():
+            self.fileobj.write(self.pending.popleft().get())
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffered:
+                self.submit(''.join(self.buffer))
+                self.buffer, self.buffered = [], 0
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            if self.eof:
+                self.fileobj.write(BGZF_EOF)
+        finally:
+            self.closed = True
+            if self.myfileobj:
+                self.myfileobj.close()
+
+
+@contextlib.contextmanager
+def compressed_tar(path, compresslevel=6):
+    """Yield a TarFile for writing a tar archive at path, compressed with a ParallelGzipFile."""
+    with ParallelGzipFile(path, compresslevel) as fileobj:
+        with tarfile.open(fileobj=fileobj, mode='w') as archive:
+            yield archive
+
+
+# The tar end-of-archive blocks, in a gzip member of their own, with which every appendable archive ends.
+TAR_END_MEMBER = gzip_member('\0' * 2 * tarfile.BLOCKSIZE) + BGZF_EOF
+
+
+def write_tar_member(fileobj, members, compresslevel=6):
+    """Write (tarinfo, fileobj or None) members to fileobj as gzipped tar entries, without the end-of-archive blocks."""
+    with ParallelGzipFile(fileobj=fileobj, compresslevel=compresslevel, eof=False) as gz:
+        for tarinfo, data in members:
+            gz.write(tarinfo.tobuf())
+            if data:
+                tarfile.copyfileobj(data, gz, tarinfo.size)
+                blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+                if remainder:
+                    gz.write('\0' * (tarfile.BLOCKSIZE - remainder))
+
+
+def is_appendable(path, size):
+    """Return whether the archive at path, truncated to size, ends in TAR_END_MEMBER."""
+    if size < len(TAR_END_MEMBER):
+        return False
+    with open(path, 'rb') as fp:
+        fp.seek(size - len(TAR_END_MEMBER))
+        return fp.read(len(TAR_END_MEMBER)) == TAR_END_MEMBER
+
+
+def append_tar(path, size, members, compresslevel=6):
+    """
+    Append (tarinfo, fileobj or None) members to the appendable tgz at path, which is truncated to size.
+
+    Only TAR_END_MEMBER is overwritten, by the new entries and another TAR_END_MEMBER, so only the new
+    data is compressed. The archive is flushed to disk before returning.
+    """
+    with open(path, 'r+b') as archive:
+        archive.seek(size - len(TAR_END_MEMBER))
+        write_tar_member(archive, members, compresslevel)
+        archive.write(TAR_END_MEMBER)
+        archive.truncate()
+        archive.flush()
+        os.fsync(archive.fileno())
+
+
+def manifest_path(path):
+    return os.path.join(os.path.dirname(path), '.%s.manifest' % os.path.basename(path))
+
+
+def write_manifest(path, digest):
+    """Record the size and inode of the archive at path along with its digest, i.e. its DIGEST.txt."""
+    stat = os.stat(path)
+    temp_path = manifest_path(path) + '.tmp'
+    with open(temp_path, 'w') as manifest:
+        manifest.write('%d %d\n%s' % (stat.st_size, stat.st_ino, digest))
+    os.rename(temp_path, manifest_path(path))
+
+
+def read_manifest(path):
+    """
+    Return (size, digest) from the manifest of the archive at path, or None if it has none.
+
+    A manifest left from an archive that has since been replaced, i.e. with a different inode, is
+    ignored. The size is that of the archive after its last complete append. An append that was
+    interrupted since has overwritten the TAR_END_MEMBER at that size, so is_appendable() tells it apart.
+    """
+    try:
+        with open(manifest_path(path)) as manifest:
+            size, inode = [int(n) for n in manifest.readline().split()]
+            digest = manifest.read()
+    except (IOError, ValueError):
+        return None
+    return (size, digest) if os.stat(path).st_ino == inode else None
+
+
 def gzip_inplace(path, mode=None):
     gzpath = path + '.gz'
-    with gzip.open(gzpath, 'wb', compresslevel=4) as gzfile:
-        with open(path) as pathfile:
-            gzfile.writelines(pathfile)
+    with metrics_registry.histogram('nims_compress_seconds', 'Time spent compressing files').time(method='gzip'):
+        with ParallelGzipFile(gzpath, compresslevel=4) as gzfile:
+            with open(path, 'rb') as pathfile:
+                shutil.copyfileobj(pathfile, gzfile, 1048576)
+    metrics_registry.counter('nims_compress_input_bytes_total', 'Bytes of data compressed').inc(os.path.getsize(path), method='gzip')
+    metrics_registry.counter('nims_compress_output_bytes_total', 'Bytes of compressed data written').inc(os.path.getsize(gzpath), method='gzip')
     shutil.copystat(path, gzpath)
     if mode: os.chmod(gzpath, mode)
     os.remove(path)
 
 
-def redigest(path):
+DIGEST_CACHE = '.digests.json'
+
+
+def hash_file(fileobj):
+    """Return the SHA-1 of the rest of fileobj."""
+    hash_ = hashlib.sha1()
+    for chunk in iter(lambda: fileobj.read(1048576 * hash_.block_size), ''):
+        hash_.update(chunk)
+    return hash_.digest()
+
+
+def open_tar(path):
+    """Return a TarFile for reading the archive at path, seekable by block if it is BGZF."""
+    with open(path, 'rb') as fileobj:
+        gzipped = fileobj.read(2) == '\x1f\x8b'
+    return tarfile.open(fileobj=open_gzip(path), mode='r:') if gzipped else tarfile.open(path, 'r:*')
+
+
+def stream_digest(path):
+    """
+    Return the digest of path as redigest() computed it before it cached digests.
+
+    This is the SHA-1 of the content of the files in path, and of the members of archives among
+    them, in one stream, which cannot be updated incrementally. Hidden files are skipped. It is only
+    used to tell whether a dataset digested this way has changed since.
+    """
 
     def hash_file(fd):
         for chunk in iter(lambda: fd.read(1048576 * hash_.block_size), ''):
             hash_.update(chunk)
 
     hash_ = hashlib.sha1()
-    filepaths = [os.path.join(path, f) for f in os.listdir(path)]
-    for filepath in sorted(filepaths):
+    for filename in sorted(os.listdir(path)):
+        filepath = os.path.join(path, filename)
+        if filename.startswith('.'):
+            continue
         if tarfile.is_tarfile(filepath):
-            archive = tarfile.open(filepath, 'r:*')
-            for member in archive:
-                if not member.isfile(): continue
-                fd = archive.extractfile(member)
-                hash_file(fd)
+            with contextlib.closing(tarfile.open(filepath, 'r:*')) as archive:
+                for member in archive:
+                    if not member.isfile(): continue
+                    hash_file(archive.extractfile(member))
         else:
             with open(filepath, 'rb') as fd:
                 hash_file(fd)
     return hash_.digest()
+
+
+def redigest(path, cache=False):
+    """
+    Return the digest of the content of the files in path, and of the members of archives among them.
+
+    The digest is the SHA-1 of the SHA-1s of each file, or of each regular member of an archive, in
+    order. Hidden files are skipped. With cache, these SHA-1s are kept in a hidden sidecar, keyed by
+    the size, mtime and inode of each file, and by the offset, name, size and mtime of each member, so
+    that only new or changed content is read again. Archives are walked by their member headers,
+    which for BGZF costs one block per member, so an archive that was appended to only has its new
+    members hashed.
+    """
+    cache_path = os.path.join(path, DIGEST_CACHE)
+    cached = {}
+    if cache:
+        try:
+            with open(cache_path) as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, ValueError):
+            pass
+    entries = {}
+    hash_ = hashlib.sha1()
+    for filename in sorted(os.listdir(path)):
+        filepath = os.path.join(path, filename)
+        if filename.startswith('.') or not os.path.isfile(filepath):
+            continue
+        stat = os.stat(filepath)
+        old = cached.get(filename, {})
+        entry = {'stat': [stat.st_size, stat.st_mtime, stat.st_ino]}
+        if old.get('stat') == entry['stat']:
+            entry = old
+        elif tarfile.is_tarfile(filepath):
+            old_members = dict(old.get('members', []))
+            entry['members'] = []
+            with contextlib.closing(open_tar(filepath)) as archive:
+                for member in archive:
+                    if not member.isfile(): continue
+                    key = '%d:%s:%d:%d' % (member.offset_data, member.name, member.size, member.mtime)
+                    digest = old_members.get(key) or hash_file(archive.extractfile(member)).encode('hex')
+                    entry['members'].append([key, digest])
+        else:
+            with open(filepath, 'rb') as fd:
+                entry['digest'] = hash_file(fd).encode('hex')
+        digests = [entry['digest']] if 'digest' in entry else [digest for key, digest in entry['members']]
+        for digest in digests:
+            hash_.update(digest.decode('hex'))
+        entries[filename] = entry
+    if cache and entries != cached:
+        with open(cache_path + '.tmp', 'w') as cache_file:
+            json.dump(entries, cache_file)
+        os.rename(cache_path + '.tmp', cache_path)
+    return hash_.digest()
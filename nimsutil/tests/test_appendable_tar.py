@@ -0,0 +1,101 @@
+"""Tests for appendable tgz archives: nimsutil.append_tar and the archive manifests."""
+
+import os
+import io
+import gzip
+import shutil
+import tarfile
+import tempfile
+import unittest
+import subprocess
+import distutils.spawn
+
+import nimsutil
+
+
+def tar_entries(files, arcname='arc'):
+    """Return (tarinfo, fileobj) members for {filename: data} files, under the directory arcname."""
+    members = []
+    for fn, data in sorted(files.iteritems()):
+        tarinfo = tarfile.TarInfo('%s/%s' % (arcname, fn))
+        tarinfo.size, tarinfo.mtime, tarinfo.mode = len(data), 1400000000, 0o644
+        members.append((tarinfo, io.BytesIO(data)))
+    return members
+
+
+def read_tar(fileobj):
+    """Return {name: data} of the regular members of the tar in fileobj; later members supersede earlier ones."""
+    with tarfile.open(fileobj=fileobj, mode='r:*') as archive:
+        return dict((m.name, archive.extractfile(m).read()) for m in archive if m.isfile())
+
+
+class TestAppendableTar(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'arc_pfile.tgz')
+        self.files = {'P00001.7': os.urandom(200000), 'DIGEST.txt': 'P00001.7\n'}
+        with open(self.path, 'wb') as archive:
+            nimsutil.write_tar_member(archive, tar_entries(self.files))
+            archive.write(nimsutil.TAR_END_MEMBER)
+        nimsutil.write_manifest(self.path, self.files['DIGEST.txt'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def append(self, files):
+        size, digest = nimsutil.read_manifest(self.path)
+        self.assertTrue(nimsutil.is_appendable(self.path, size))
+        nimsutil.append_tar(self.path, size, tar_entries(files))
+        nimsutil.write_manifest(self.path, files.get('DIGEST.txt', digest))
+        self.files.update(files)
+
+    def expected(self):
+        return dict(('arc/%s' % fn, data) for fn, data in self.files.iteritems())
+
+    def test_new_archive_reads_back(self):
+        self.assertEqual(read_tar(open(self.path, 'rb')), self.expected())
+        self.assertEqual(nimsutil.read_manifest(self.path), (os.path.getsize(self.path), 'P00001.7\n'))
+
+    def test_append_reads_back_with_tarfile(self):
+        self.append({'P00002.7': os.urandom(100000), 'DIGEST.txt': 'P00001.7\nP00002.7\n'})
+        self.append({'P00001.7': 'superseded'})
+        self.assertEqual(read_tar(open(self.path, 'rb')), self.expected())
+
+    def test_append_reads_back_with_gzip(self):
+        self.append({'P00002.7': os.urandom(100000)})
+        with gzip.open(self.path, 'rb') as gz:
+            data = gz.read()
+        self.assertEqual(data[-2 * tarfile.BLOCKSIZE:], '\0' * 2 * tarfile.BLOCKSIZE)
+        self.assertEqual(read_tar(io.BytesIO(data)), self.expected())
+
+    def test_append_reads_back_with_gzip_tools(self):
+        self.append({'P00002.7': os.urandom(100000)})
+        tools = [t for t in ('gzip', 'pigz') if distutils.spawn.find_executable(t)]
+        if not tools:
+            self.skipTest('neither gzip nor pigz is installed')
+        for tool in tools:
+            data = subprocess.check_output([tool, '-dc', self.path])
+            self.assertEqual(read_tar(io.BytesIO(data)), self.expected())
+
+    def test_interrupted_append_is_not_appendable(self):
+        size, digest = nimsutil.read_manifest(self.path)
+        with open(self.path, 'r+b') as archive:     # an append that died part way, before its manifest
+            archive.seek(size - len(nimsutil.TAR_END_MEMBER))
+            archive.write(os.urandom(50000))
+        self.assertFalse(nimsutil.is_appendable(self.path, size))
+
+    def test_manifest_of_replaced_archive_is_ignored(self):
+        shutil.copy(self.path, self.path + '.new')
+        os.rename(self.path + '.new', self.path)
+        self.assertEqual(nimsutil.read_manifest(self.path), None)
+
+    def test_plain_tgz_is_not_appendable(self):
+        plain_path = os.path.join(self.tempdir, 'plain.tgz')
+        with tarfile.open(plain_path, 'w:gz') as archive:
+            archive.add(self.path, 'arc/member')
+        self.assertFalse(nimsutil.is_appendable(plain_path, os.path.getsize(plain_path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
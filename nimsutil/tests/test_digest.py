@@ -0,0 +1,103 @@
+"""Tests for dataset digests: nimsutil.redigest, with and without its cache, and nimsutil.stream_digest."""
+
+import os
+import io
+import json
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import unittest
+
+import nimsutil
+
+
+class TestRedigest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.write('P00001.7', os.urandom(100000))
+        self.tgz_path = os.path.join(self.tempdir, '1_2_3_dicoms.tgz')
+        with nimsutil.compressed_tar(self.tgz_path) as archive:
+            for i in range(3):
+                self.add(archive, 'dicoms/%d.dcm' % i, os.urandom(50000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, filename, data):
+        with open(os.path.join(self.tempdir, filename), 'wb') as fileobj:
+            fileobj.write(data)
+
+    def add(self, archive, name, data):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size, tarinfo.mtime = len(data), 1400000000
+        archive.addfile(tarinfo, io.BytesIO(data))
+
+    def test_cache_does_not_change_the_digest(self):
+        digest = nimsutil.redigest(self.tempdir)
+        self.assertEqual(nimsutil.redigest(self.tempdir, cache=True), digest)
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, nimsutil.DIGEST_CACHE)))
+        self.assertEqual(nimsutil.redigest(self.tempdir, cache=True), digest)
+        self.assertEqual(nimsutil.redigest(self.tempdir), digest)
+
+    def test_hidden_files_are_skipped(self):
+        digest = nimsutil.redigest(self.tempdir)
+        self.write('.1_2_3_pfile.tgz.manifest', 'hidden')
+        nimsutil.redigest(self.tempdir, cache=True)
+        self.assertEqual(nimsutil.redigest(self.tempdir), digest)
+        self.assertEqual(nimsutil.redigest(self.tempdir, cache=True), digest)
+
+    def test_changed_file_is_hashed_again(self):
+        digest = nimsutil.redigest(self.tempdir, cache=True)
+        self.write('P00001.7', 'changed')
+        new_digest = nimsutil.redigest(self.tempdir, cache=True)
+        self.assertNotEqual(new_digest, digest)
+        self.assertEqual(new_digest, nimsutil.redigest(self.tempdir))
+
+    def test_unchanged_file_is_not_read(self):
+        path = os.path.join(self.tempdir, 'P00001.7')
+        os.utime(path, (1400000000, 1400000000))
+        digest = nimsutil.redigest(self.tempdir, cache=True)
+        with open(path, 'r+b') as fileobj:     # change the content behind the cache's back
+            fileobj.write('x' * 100)
+        os.utime(path, (1400000000, 1400000000))
+        self.assertEqual(nimsutil.redigest(self.tempdir, cache=True), digest)
+        self.assertNotEqual(nimsutil.redigest(self.tempdir), digest)
+
+    def test_appended_archive_only_hashes_new_members(self):
+        nimsutil.redigest(self.tempdir, cache=True)
+        with open(os.path.join(self.tempdir, nimsutil.DIGEST_CACHE)) as cache_file:
+            old_members = json.load(cache_file)['1_2_3_dicoms.tgz']['members']
+        with tarfile.open(self.tgz_path) as archive:
+            members = [(m, archive.extractfile(m).read()) for m in archive]
+        with nimsutil.compressed_tar(self.tgz_path) as archive:
+            for member, data in members:
+                archive.addfile(member, io.BytesIO(data))
+            self.add(archive, 'dicoms/3.dcm', os.urandom(50000))
+        hashed = []
+        hash_file = nimsutil.nimsutil.hash_file
+        nimsutil.nimsutil.hash_file = lambda fileobj: hashed.append(fileobj) or hash_file(fileobj)
+        try:
+            digest = nimsutil.redigest(self.tempdir, cache=True)
+        finally:
+            nimsutil.nimsutil.hash_file = hash_file
+        self.assertEqual(len(hashed), 1)
+        self.assertEqual(digest, nimsutil.redigest(self.tempdir))
+        with open(os.path.join(self.tempdir, nimsutil.DIGEST_CACHE)) as cache_file:
+            new_members = json.load(cache_file)['1_2_3_dicoms.tgz']['members']
+        self.assertEqual(new_members[:3], old_members)
+        self.assertEqual(len(new_members), 4)
+
+    def test_stream_digest(self):
+        hash_ = hashlib.sha1()
+        with tarfile.open(self.tgz_path) as archive:
+            for member in archive:
+                hash_.update(archive.extractfile(member).read())
+        hash_.update(open(os.path.join(self.tempdir, 'P00001.7'), 'rb').read())
+        nimsutil.redigest(self.tempdir, cache=True)    # the hidden cache is not part of it
+        self.assertEqual(nimsutil.stream_digest(self.tempdir), hash_.digest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""Tests for BGZF compression with nimsutil.ParallelGzipFile, and reading with nimsutil.BlockGzipReader."""
+
+import os
+import gzip
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+import subprocess
+import multiprocessing
+import distutils.spawn
+
+import nimsutil
+
+
+def write_gzip(path, data, **kwargs):
+    with nimsutil.ParallelGzipFile(path, **kwargs) as gz:
+        for i in range(0, len(data), 100000):   # writes that do not line up with blocks
+            gz.write(data[i:i + 100000])
+
+
+def sample_data(size):
+    return ''.join(os.urandom(1000) + 'x' * 9000 for i in range(size / 10000))
+
+
+class TestParallelGzipFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'data.gz')
+        self.data = sample_data(1000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_reads_back_with_gzip(self):
+        write_gzip(self.path, self.data)
+        with gzip.open(self.path, 'rb') as gz:
+            self.assertEqual(gz.read(), self.data)
+
+    def test_reads_back_with_gzip_tools(self):
+        write_gzip(self.path, self.data)
+        tools = [t for t in ('gzip', 'pigz') if distutils.spawn.find_executable(t)]
+        if not tools:
+            self.skipTest('neither gzip nor pigz is installed')
+        for tool in tools:
+            self.assertEqual(subprocess.check_output([tool, '-dc', self.path]), self.data)
+
+    def test_writes_bgzf_blocks(self):
+        write_gzip(self.path, self.data)
+        with open(self.path, 'rb') as fileobj:
+            data_offsets, file_offsets, size = nimsutil.bgzf_index(fileobj)
+        self.assertEqual(size, len(self.data))
+        self.assertEqual(data_offsets, range(0, len(self.data), nimsutil.BGZF_BLOCK_SIZE))
+        with open(self.path, 'rb') as fileobj:
+            fileobj.seek(-len(nimsutil.BGZF_EOF), 2)
+            self.assertEqual(fileobj.read(), nimsutil.BGZF_EOF)
+
+    def test_without_eof(self):
+        with open(self.path, 'wb') as fileobj:
+            with nimsutil.ParallelGzipFile(fileobj=fileobj, eof=False) as gz:
+                gz.write(self.data)
+            self.assertFalse(fileobj.closed)
+        with open(self.path, 'rb') as fileobj:
+            fileobj.seek(-len(nimsutil.BGZF_EOF), 2)
+            self.assertNotEqual(fileobj.read(), nimsutil.BGZF_EOF)
+        with gzip.open(self.path, 'rb') as gz:
+            self.assertEqual(gz.read(), self.data)
+
+    def test_empty(self):
+        write_gzip(self.path, '')
+        self.assertEqual(open(self.path, 'rb').read(), nimsutil.BGZF_EOF)
+        with gzip.open(self.path, 'rb') as gz:
+            self.assertEqual(gz.read(), '')
+
+    def test_compressed_tar(self):
+        member_path = os.path.join(self.tempdir, 'member')
+        with open(member_path, 'wb') as member:
+            member.write(self.data)
+        tgz_path = os.path.join(self.tempdir, 'data.tgz')
+        with nimsutil.compressed_tar(tgz_path) as archive:
+            archive.add(member_path, 'dir/member')
+        with tarfile.open(tgz_path) as archive:
+            self.assertEqual(archive.extractfile('dir/member').read(), self.data)
+
+    def test_in_forked_child(self):
+        write_gzip(self.path, self.data)    # start the pool in this process
+        child_path = os.path.join(self.tempdir, 'child.gz')
+        child = multiprocessing.Process(target=write_gzip, args=(child_path, self.data))
+        child.start()
+        child.join(60)
+        if child.is_alive():
+            child.terminate()   # hung on the threads of the parent's pool
+        self.assertEqual(child.exitcode, 0)
+        with gzip.open(child_path, 'rb') as gz:
+            self.assertEqual(gz.read(), self.data)
+
+
+class TestBlockGzipReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'data.gz')
+        self.data = sample_data(1000000)
+        write_gzip(self.path, self.data)
+        nimsutil.bgzf_indexes.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_read_all(self):
+        with nimsutil.open_gzip(self.path) as reader:
+            self.assertTrue(isinstance(reader, nimsutil.BlockGzipReader))
+            self.assertEqual(reader.read(), self.data)
+            self.assertEqual(reader.read(), '')
+
+    def test_seek_to_arbitrary_offsets(self):
+        rng = random.Random(0)
+        offsets = [0, 1, nimsutil.BGZF_BLOCK_SIZE - 1, nimsutil.BGZF_BLOCK_SIZE, len(self.data) - 1, len(self.data)]
+        offsets += [rng.randrange(len(self.data)) for i in range(50)]
+        with nimsutil.open_gzip(self.path) as reader:
+            for offset in offsets:
+                size = rng.choice([1, 100, nimsutil.BGZF_BLOCK_SIZE + 1, 300000])
+                reader.seek(offset)
+                self.assertEqual(reader.read(size), self.data[offset:offset + size])
+                self.assertEqual(reader.tell(), min(offset + size, len(self.data)))
+            reader.seek(-10, 2)
+            self.assertEqual(reader.read(), self.data[-10:])
+            reader.seek(5)
+            reader.seek(5, 1)
+            self.assertEqual(reader.read(10), self.data[10:20])
+
+    def test_tarfile_over_reader(self):
+        member_path = os.path.join(self.tempdir, 'member')
+        with open(member_path, 'wb') as member:
+            member.write(self.data)
+        tgz_path = os.path.join(self.tempdir, 'data.tgz')
+        with nimsutil.compressed_tar(tgz_path) as archive:
+            archive.add(member_path, 'dir/member')
+            archive.add(self.path, 'dir/data.gz')
+        with tarfile.open(fileobj=nimsutil.open_gzip(tgz_path), mode='r:') as archive:
+            self.assertEqual(archive.extractfile('dir/data.gz').read(), open(self.path, 'rb').read())
+            self.assertEqual(archive.extractfile('dir/member').read(), self.data)
+
+    def test_gzip_size(self):
+        self.assertEqual(nimsutil.gzip_size(self.path), len(self.data))
+        plain_path = os.path.join(self.tempdir, 'plain.gz')
+        with gzip.open(plain_path, 'wb') as gz:
+            gz.write(self.data)
+        self.assertEqual(nimsutil.gzip_size(plain_path), len(self.data))
+        self.assertFalse(isinstance(nimsutil.open_gzip(plain_path), nimsutil.BlockGzipReader))
+
+    def test_index_is_cached_until_the_file_changes(self):
+        nimsutil.gzip_size(self.path)
+        index = nimsutil.path_bgzf_index(self.path)
+        self.assertTrue(nimsutil.path_bgzf_index(self.path) is index)
+        data = self.data + 'appended'
+        write_gzip(self.path, data)
+        os.utime(self.path, (0, 0))     # a new mtime, whatever the resolution of the filesystem
+        self.assertEqual(nimsutil.gzip_size(self.path), len(data))
+        with nimsutil.open_gzip(self.path) as reader:
+            self.assertEqual(reader.read(), data)
+
+    def test_corrupt_block(self):
+        with open(self.path, 'r+b') as fileobj:
+            data_offsets, file_offsets, size = nimsutil.bgzf_index(fileobj)
+            fileobj.seek(file_offsets[3] - 8)     # the CRC32 in the trailer of block 2
+            crc = fileobj.read(1)
+            fileobj.seek(-1, 1)
+            fileobj.write(chr(ord(crc) ^ 1))
+        with nimsutil.open_gzip(self.path) as reader:
+            reader.seek(data_offsets[1])
+            self.assertEqual(reader.read(10), self.data[data_offsets[1]:data_offsets[1] + 10])
+            reader.seek(data_offsets[2])
+            self.assertRaises(IOError, reader.read, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()